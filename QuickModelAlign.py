@@ -2,9 +2,15 @@
 import os
 import unittest
 import logging
+import concurrent.futures.process
 import copy
+import csv
 import json
 import subprocess
+import sys
+import tempfile
+import urllib.error
+import urllib.request
 import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 import glob
@@ -12,6 +18,26 @@ import vtk.util.numpy_support as vtk_np
 import numpy as np
 from datetime import datetime
 import time
+from QuickModelAlignLib import animation
+from QuickModelAlignLib import batch
+from QuickModelAlignLib import bundle
+from QuickModelAlignLib import cache
+from QuickModelAlignLib import dependencies
+from QuickModelAlignLib import display
+from QuickModelAlignLib import distance
+from QuickModelAlignLib import ingest
+from QuickModelAlignLib import instrumentation
+from QuickModelAlignLib import jobserver
+from QuickModelAlignLib import metrics
+from QuickModelAlignLib import registration
+from QuickModelAlignLib import sdf
+from QuickModelAlignLib import store
+from QuickModelAlignLib import tasks
+from QuickModelAlignLib import templates
+from QuickModelAlignLib import tuning
+
+# Module setup longer than this is logged as a warning
+STARTUP_TARGET_SECONDS = 1.0
 
 #
 # QuickModelAlign
@@ -51,56 +77,16 @@ class QuickModelAlignWidget(ScriptedLoadableModuleWidget):
 
   def setup(self):
     ScriptedLoadableModuleWidget.setup(self)
-    # Ensure that correct version of open3d Python package is installed
-    needRestart = False
-    needInstall = False
-    Open3dVersion = "0.14.1+816263b"
-    try:
-      import open3d as o3d
-      import cpdalp
-      from packaging import version
-      if version.parse(o3d.__version__) != version.parse(Open3dVersion):
-        if not slicer.util.confirmOkCancelDisplay(f"QuickModelAlign requires installation of open3d (version {Open3dVersion}).\nClick OK to upgrade open3d and restart the application."):
-          #self.ui.showBrowserOnEnter = False
-          return
-        needRestart = True
-        needInstall = True
-    except ModuleNotFoundError:
-      needInstall = True
-
-    if needInstall:
-      progressDialog = slicer.util.createProgressDialog(labelText='Upgrading open3d. This may take a minute...', maximum=0)
-      slicer.app.processEvents()
-      import SampleData
-      sampleDataLogic = SampleData.SampleDataLogic()
-      try:
-        if slicer.app.os == 'win':
-          url = "https://app.box.com/shared/static/friq8fhfi8n4syklt1v47rmuf58zro75.whl"
-          wheelName = "open3d-0.14.1+816263b-cp39-cp39-win_amd64.whl"
-          wheelPath = sampleDataLogic.downloadFile(url, slicer.app.cachePath, wheelName)
-        elif slicer.app.os == 'macosx':
-          url = "https://app.box.com/shared/static/ixhac95jrx7xdxtlagwgns7vt9b3mbqu.whl"
-          wheelName = "open3d-0.14.1+816263b-cp39-cp39-macosx_10_15_x86_64.whl"
-          wheelPath = sampleDataLogic.downloadFile(url, slicer.app.cachePath, wheelName)
-        elif slicer.app.os == 'linux':
-          url = "https://app.box.com/shared/static/wyzk0f9jhefrbm4uukzym0sow5bf26yi.whl"
-          wheelName = "open3d-0.14.1+816263b-cp39-cp39-manylinux_2_27_x86_64.whl"
-          wheelPath = sampleDataLogic.downloadFile(url, slicer.app.cachePath, wheelName)
-      except:
-          slicer.util.infoDisplay('Error: please check the url of the open3d wheel in the script')
-          progressDialog.close()
-      slicer.util.pip_install(f'cpdalp')
-      # wheelPath may contain spaces, therefore pass it as a list (that avoids splitting
-      # the argument into multiple command-line arguments when there are spaces in the path)
-      slicer.util.pip_install([wheelPath])
-      import open3d as o3d
-      import cpdalp
-      progressDialog.close()
-    if needRestart:
-      slicer.util.restart()
+    setupStartTime = time.perf_counter()
+    # open3d and cpdalp are only imported once models are processed; here their
+    # installation is only checked, from the cached result of previous sessions if possible
+    self.dependencyStatus = QuickModelAlignLogic().dependencyStatus()
+    self.animation = None
 
     self.showMinimalScreenUI()
     self.updateLayout()
+    # Needed by clearScene before any comparison is run (e.g. when a result bundle is opened)
+    self.view = slicer.app.layoutManager().threeDWidget(0).threeDView()
     self.setUpShortcuts()
 
 
@@ -117,6 +103,16 @@ class QuickModelAlignWidget(ScriptedLoadableModuleWidget):
     alignSingleWidgetLayout = qt.QFormLayout(alignSingleWidget)
     alignSingleWidget.text = "Load your models"
     alignSingleTabLayout.addRow(alignSingleWidget)
+
+    #
+    # Missing or outdated open3d, installed in the background on request
+    #
+    self.dependencyLabel = qt.QLabel()
+    self.dependencyLabel.wordWrap = True
+    alignSingleWidgetLayout.addRow(self.dependencyLabel)
+    self.installDependenciesButton = qt.QPushButton("Install open3d")
+    self.installDependenciesButton.setToolTip("Download and install the open3d version QuickModelAlign requires. Slicer can be used while it installs.")
+    alignSingleWidgetLayout.addRow(self.installDependenciesButton)
   
     #
     # Select source mesh
@@ -155,6 +151,28 @@ class QuickModelAlignWidget(ScriptedLoadableModuleWidget):
     self.startAlignButton = qt.QPushButton("Align my models")
     self.startAlignButton.enabled = False
     alignSingleWidgetLayout.addRow(self.startAlignButton)
+
+    #
+    # Open a saved result bundle, without processing the models again
+    #
+    self.openBundleButton = qt.QPushButton("Open saved result...")
+    self.openBundleButton.setToolTip("Show a comparison saved with \"Save result...\", with its colour map and statistics")
+    alignSingleWidgetLayout.addRow(self.openBundleButton)
+
+    #
+    # Progress of the running processing stage, and Cancel button
+    #
+    self.progressBar = qt.QProgressBar()
+    self.progressBar.minimum = 0
+    self.progressBar.maximum = len(tasks.STAGES)
+    alignSingleWidgetLayout.addRow(self.progressBar)
+    self.progressBar.hide()
+    self.cancelButton = qt.QPushButton("Cancel")
+    alignSingleWidgetLayout.addRow(self.cancelButton)
+    self.cancelButton.hide()
+    self.task = None
+    self.taskTimer = qt.QTimer()
+    self.taskTimer.setInterval(100)
     
     #
     # Clear Button
@@ -175,6 +193,27 @@ class QuickModelAlignWidget(ScriptedLoadableModuleWidget):
     self.layout.addWidget(self.rulerWidget)
     self.rulerWidget.hide()
 
+    #
+    # Comparison results
+    #
+    self.resultsCollapsibleButton = ctk.ctkCollapsibleButton()
+    self.resultsCollapsibleButton.text = "Results"
+    self.layout.addWidget(self.resultsCollapsibleButton)
+    resultsFormLayout = qt.QFormLayout(self.resultsCollapsibleButton)
+    self.metricsLabel = qt.QLabel()
+    self.metricsLabel.wordWrap = True
+    resultsFormLayout.addRow(self.metricsLabel)
+    self.exportMetricsButton = qt.QPushButton("Export results...")
+    self.exportMetricsButton.setToolTip("Save the statistics of the comparison at the current error tolerance to a CSV or JSON file")
+    resultsFormLayout.addRow(self.exportMetricsButton)
+    self.saveBundleButton = qt.QPushButton("Save result...")
+    self.saveBundleButton.setToolTip("Save the aligned models, colour maps and statistics, to review the comparison later without processing the models again")
+    resultsFormLayout.addRow(self.saveBundleButton)
+    self.resultsCollapsibleButton.hide()
+    self.comparisonMetrics = None
+    self.resultBundle = None
+    self.templateCandidates = None
+
     # Connections
     self.sourceModelSelector.connect('validInputChanged(bool)', self.onSelect)
     self.targetModelSelector.connect('validInputChanged(bool)', self.onSelect)
@@ -183,9 +222,16 @@ class QuickModelAlignWidget(ScriptedLoadableModuleWidget):
     self.loadModelsButton.connect('clicked(bool)', self.onLoadModelsButton)
     self.startAlignButton.connect('clicked(bool)', self.onStartAlignButton)
     self.clearButton.connect('clicked(bool)', self.clearScene)
+    self.exportMetricsButton.connect('clicked(bool)', self.onExportMetricsButton)
+    self.saveBundleButton.connect('clicked(bool)', self.onSaveBundleButton)
+    self.openBundleButton.connect('clicked(bool)', self.onOpenBundleButton)
+    self.cancelButton.connect('clicked(bool)', self.onCancelButton)
+    self.installDependenciesButton.connect('clicked(bool)', self.onInstallDependenciesButton)
+    self.tuneParametersButton.connect('clicked(bool)', self.onTuneParametersButton)
+    self.taskTimer.connect('timeout()', self.onTaskTimer)
     
     # initialize the parameter dictionary from single run parameters
-    self.parameterDictionary = {
+    self.parameterDictionary = registration.completeParameters({
       "projectionFactor": self.projectionFactor.value,
       "pointDensity": self.pointDensity.value,
       "errorToleranceValue": self.errorToleranceValue.value,
@@ -193,54 +239,117 @@ class QuickModelAlignWidget(ScriptedLoadableModuleWidget):
       "FPFHSearchRadius" : self.FPFHSearchRadius.value,
       "distanceThreshold" : self.distanceThreshold.value,
       "maxRANSAC" : int(self.maxRANSAC.value),
-      "RANSACConfidence" : int(self.RANSACConfidence.value),
+      "RANSACConfidence" : self.RANSACConfidence.value,
       "ICPDistanceThreshold"  : self.ICPDistanceThreshold.value,
       "alpha" : self.alpha.value,
       "beta" : self.beta.value,
       "CPDIterations" : int(self.CPDIterations.value),
       "CPDTolerence" : self.CPDTolerence.value
-      }
+      })
+
+    self.presetName = None
+    self.updatePresets()
+
+    self.updateDependencyStatus()
+    setupSeconds = time.perf_counter() - setupStartTime
+    if setupSeconds > STARTUP_TARGET_SECONDS:
+      logging.warning(f"QuickModelAlign module setup took {setupSeconds:.2f} seconds (target {STARTUP_TARGET_SECONDS:.1f} seconds)")
+    else:
+      logging.info(f"QuickModelAlign module setup took {setupSeconds:.2f} seconds")
+
+  def updateDependencyStatus(self):
+    ready = self.dependencyStatus["ok"]
+    self.dependencyLabel.text = "" if ready else dependencies.describe(self.dependencyStatus)
+    self.dependencyLabel.visible = not ready
+    self.installDependenciesButton.visible = not ready
+    self.installDependenciesButton.enabled = not ready and not self.task
+    self.onSelect()
+
+  def onInstallDependenciesButton(self):
+    self.installDependenciesButton.enabled = False
+    self.loadModelsButton.enabled = False
+    self.startTask(QuickModelAlignLogic().installDependenciesTask(), self.onDependenciesInstalled, self.updateDependencyStatus)
+
+  def onDependenciesInstalled(self, result):
+    logging.info(result["log"])
+    self.dependencyStatus = QuickModelAlignLogic().dependencyStatus()
+    self.updateDependencyStatus()
+    if not self.dependencyStatus["ok"]:
+      slicer.util.errorDisplay("open3d could not be installed.", detailedText=result["log"])
+    elif "open3d" in sys.modules:
+      # Another open3d version has already been imported in this session
+      if slicer.util.confirmOkCancelDisplay("open3d has been upgraded.\nClick OK to restart the application."):
+        slicer.util.restart()
 
   
   def clearScene(self):
+    if self.task:
+      self.task.cancel()
+      self.task = None
     slicer.mrmlScene.Clear(0)
+    self.meshSession = None
     self.showMinimalScreenUI()
     self.updateLayout()
     self.view.cornerAnnotation().SetText(vtk.vtkCornerAnnotation.LowerEdge,'')
+    self.view.cornerAnnotation().SetText(vtk.vtkCornerAnnotation.UpperLeft,'')
     self.sourceModelSelector.currentPath = ""
     self.targetModelSelector.currentPath = ""
     self.clearButton.hide()
     self.rulerWidget.hide()
-    self.rocking = False
+    self.resultsCollapsibleButton.hide()
+    self.comparisonMetrics = None
+    self.resultBundle = None
+    self.templateCandidates = None
+    if self.animation:
+      self.animation.stop()
+      self.animation = None
 
     
   def onSelect(self):
-    self.loadModelsButton.enabled = bool ( self.sourceModelSelector.currentPath and self.targetModelSelector.currentPath)
+    self.loadModelsButton.enabled = bool ( self.sourceModelSelector.currentPath and self.targetModelSelector.currentPath
+      and self.dependencyStatus["ok"] and not self.task)
 
   def onLoadModelsButton(self):
     logic = QuickModelAlignLogic()
-    sourceModelNode = slicer.util.loadModel(self.sourceModelSelector.currentPath)
-    targetModelNode = slicer.util.loadModel(self.targetModelSelector.currentPath)
+    # Stage timings of this comparison, from loading to the colour maps
+    self.runTrace = instrumentation.Trace(os.path.basename(self.sourceModelSelector.currentPath))
+    # The models are read from disk only here, alignment and colour map reuse the same nodes
+    with self.runTrace.stage("load"):
+      self.meshSession = MeshSession(self.sourceModelSelector.currentPath, self.targetModelSelector.currentPath)
+    self.meshSession.setModelsVisible(False)
+    self.loadModelsButton.enabled = False
+    # The preset applies to the whole comparison, even if another one is selected meanwhile
+    self.presetName = self.selectedPreset()
 
-    self.sourcePoints, self.targetPoints, self.sourceFeatures, \
-      self.targetFeatures, self.voxelSize, self.scaling = logic.runSubsample(sourceModelNode,targetModelNode, self.skipScalingCheckBox.checked, self.parameterDictionary)
+    task = logic.runSubsampleTask(self.meshSession.sourceModelNode, self.meshSession.targetModelNode, self.skipScalingCheckBox.checked, self.parameterDictionary,
+        targetPath=self.targetModelSelector.currentPath, preset=self.presetName)
+    self.startTask(task, self.onModelsSubsampled, self.onLoadModelsAborted)
 
-    sourceModelNode.GetDisplayNode().SetVisibility(False)
-    targetModelNode.GetDisplayNode().SetVisibility(False)
+  def onLoadModelsAborted(self):
+    self.meshSession.removeNodes()
+    self.meshSession = None
+    self.onSelect()
 
-    # Convert to VTK points
-    self.sourceSLM_vtk = logic.convertPointsToVTK(self.sourcePoints.points)
-    self.targetSLM_vtk = logic.convertPointsToVTK(self.targetPoints.points)
-    
-    # Display target points
-    blue=[0,0,1]
-    self.targetCloudNode = logic.displayPointCloud(self.targetSLM_vtk, self.voxelSize/10, 'Target Pointcloud', blue)
-    logic.RAS2LPSTransform(self.targetCloudNode)
-    
-    # Display source points
-    red=[1,0,0]
-    self.sourceCloudNode = logic.displayPointCloud(self.sourceSLM_vtk, self.voxelSize/10, 'Source Pointcloud', red)
-    logic.RAS2LPSTransform(self.sourceCloudNode)
+  def onModelsSubsampled(self, result):
+    logic = QuickModelAlignLogic()
+    self.runTrace.extend(result["trace"])
+    self.sourcePoints, self.targetPoints, self.sourceFeatures, \
+      self.targetFeatures, self.voxelSize, self.scaling = logic.finishSubsampleTask(self.meshSession.sourceModelNode, result)
+
+    # Preview of the downsampled points
+    style = display.POINT_CLOUD_STYLES[self.pointCloudStyleComboBox.currentIndex]
+    with self.runTrace.stage("preview"):
+      # Display target points
+      blue=[0,0,1]
+      self.targetCloudNode = logic.displayPointCloud(self.targetPoints.points, self.voxelSize/10, 'Target Pointcloud', blue,
+        style, self.pointSizeSpinBox.value)
+      logic.RAS2LPSTransform(self.targetCloudNode)
+
+      # Display source points
+      red=[1,0,0]
+      self.sourceCloudNode = logic.displayPointCloud(self.sourcePoints.points, self.voxelSize/10, 'Source Pointcloud', red,
+        style, self.pointSizeSpinBox.value)
+      logic.RAS2LPSTransform(self.sourceCloudNode)
     
     self.updateLayout()
     
@@ -254,40 +363,68 @@ class QuickModelAlignWidget(ScriptedLoadableModuleWidget):
 
 
   def onStartAlignButton(self):
+    self.startAlignButton.enabled = False
     self.alignModels()
-    self.displayAlignedMesh()
-    self.clearButton.show()
-    self.clearButton.enabled = True
-    self.rulerWidget.show()
 
   def alignModels(self):
     logic = QuickModelAlignLogic()
-    self.transformMatrix = logic.estimateTransform(self.sourcePoints, self.targetPoints, self.sourceFeatures, self.targetFeatures, self.voxelSize, self.skipScalingCheckBox.checked, self.parameterDictionary)
+    parameters = dict(self.parameterDictionary, fastPath=self.fastPathCheckBox.checked, multiStartRuns=self.multiStartSpinBox.value)
+    otherIdealModelsDirectory = self.otherIdealModelsSelector.currentPath
+    if otherIdealModelsDirectory and os.path.isdir(otherIdealModelsDirectory):
+      # Align to the selected and the other ideal models concurrently, the best one is compared
+      idealPaths = logic.templateIdealPaths(self.meshSession.targetPath, otherIdealModelsDirectory, self.meshSession.sourcePath)
+      task = logic.templateMatchingTask(self.meshSession.sourceModelNode, idealPaths, self.skipScalingCheckBox.checked, parameters, self.presetName)
+      self.startTask(task, self.onTemplatesMatched, self.onAlignModelsAborted)
+      return
+    task = logic.estimateTransformTask(self.sourcePoints, self.targetPoints, self.sourceFeatures, self.targetFeatures, self.voxelSize, self.skipScalingCheckBox.checked, parameters,
+      self.presetName)
+    self.startTask(task, self.onModelsAligned, self.onAlignModelsAborted)
+
+  def onAlignModelsAborted(self):
+    self.startAlignButton.enabled = True
+
+  def onModelsAligned(self, result):
+    logic = QuickModelAlignLogic()
+    self.transformMatrix = result["transformation"]
+    self.alignmentResult = result
+    self.templateCandidates = None
+    self.runTrace.extend(result["trace"])
+    logic.finishEstimateTransformTask(result)
     self.ICPTransformNode = logic.convertMatrixToTransformNode(self.transformMatrix, 'Rigid Transformation Matrix')
 
-    # Alignment of Tooth Models
-    transform_vtk = self.ICPTransformNode.GetMatrixTransformToParent()
-    self.sourceVTK = logic.convertPointsToVTK(self.sourcePoints.points)
-    self.alignedSourceSLM_vtk = logic.applyTransform(transform_vtk, self.sourceVTK)
-    
-    self.startAlignButton.enabled = False
     self.updateLayout()
+    self.displayAlignedMesh()
+
+  def onTemplatesMatched(self, result):
+    logic = QuickModelAlignLogic()
+    best = result["best"]
+    self.templateCandidates = result["candidates"]
+    self.runTrace.extend(result["trace"])
+    logic.logTemplateRanking(self.templateCandidates)
+    if best["ideal"] != self.meshSession.targetPath:
+      with self.runTrace.stage("load", "ideal"):
+        self.meshSession.replaceTarget(best["ideal"])
+      self.meshSession.targetModelNode.GetDisplayNode().SetVisibility(False)
+    # The scaling depends on the size of the ideal model
+    self.scaling = best["scaling"]
+    self.transformMatrix = best["transformation"]
+    self.alignmentResult = best
+    self.ICPTransformNode = logic.convertMatrixToTransformNode(self.transformMatrix, 'Rigid Transformation Matrix')
+
+    self.updateLayout()
+    # Distances and colour maps are only computed for the best ideal model
+    self.displayAlignedMesh()
 
  
 
   def displayAlignedMesh(self):
-    from open3d import geometry
-    from open3d import utility
     logic = QuickModelAlignLogic()
-    # Display target points
-    self.targetModelNode = slicer.util.loadModel(self.targetModelSelector.currentPath)
-    self.sourceModelNode = slicer.util.loadModel(self.sourceModelSelector.currentPath)
-
-    self.sourceModelNode.GetPolyData().GetPoints().GetData().Modified()
-    self.sourceModelNode.SetAndObserveTransformNodeID(self.ICPTransformNode.GetID())
-    slicer.vtkSlicerTransformLogic().hardenTransform(self.sourceModelNode)
-    logic.RAS2LPSTransform(self.sourceModelNode)
-    logic.RAS2LPSTransform(self.targetModelNode)
+    # Reuse the models loaded by onLoadModelsButton
+    self.sourceModelNode = self.meshSession.sourceModelNode
+    self.targetModelNode = self.meshSession.targetModelNode
+
+    # Scaling, registration and RAS to LPS flip in a single pass over the points of each model
+    self.meshSession.transformModels(logic.alignedSourceMatrix(self.scaling, self.transformMatrix), registration.RAS_TO_LPS)
     toothColor=[1, 1, 1]
     
     # instance of Source Model & Target Model. Calculate the difference and feed
@@ -301,12 +438,87 @@ class QuickModelAlignWidget(ScriptedLoadableModuleWidget):
     m1.GetDisplayNode().SetInterpolation(0)
     m2.GetDisplayNode().SetInterpolation(0)
 
-    self.sourceCloudNode.GetDisplayNode().SetVisibility(False)
-    self.targetCloudNode.GetDisplayNode().SetVisibility(False)
+    # The point clouds are not needed anymore once the models are aligned
+    slicer.mrmlScene.RemoveNode(self.sourceCloudNode)
+    slicer.mrmlScene.RemoveNode(self.targetCloudNode)
+    self.sourceCloudNode = None
+    self.targetCloudNode = None
+
+    triangleBudget = self.triangleBudgetSpinBox.value
+    if any(display.exceedsTriangleBudget(modelNode.GetPolyData(), triangleBudget) for modelNode in self.meshSession.modelNodes()):
+      # Large models are displayed as decimated models, which are built in the background first
+      task = logic.levelOfDetailTask(m1, m2, triangleBudget)
+      self.startTask(task, self.onLevelOfDetailBuilt, self.onLevelOfDetailAborted)
+      return
+
+    self.setUpAnimation()
+    self.ShowInAnimationMode()
+    self.startDistancesTask()
+
+  def onLevelOfDetailBuilt(self, result):
+    logic = QuickModelAlignLogic()
+    self.runTrace.extend(result["trace"])
+    # The full resolution models stay in the scene, hidden, for the final distances and metrics
+    self.meshSession.setModelsVisible(False)
+    toothColor=[1, 1, 1]
+    self.sourceModelNode = logic.displayMesh(result["source"], 'Prepared (display)', toothColor)
+    self.targetModelNode = logic.displayMesh(result["target"], 'Ideal (display)', toothColor)
+    for modelNode in (self.sourceModelNode, self.targetModelNode):
+      modelNode.GetDisplayNode().SetInterpolation(0)
+
+    self.setUpAnimation()
+    self.ShowInAnimationMode()
+    # Preview colour map from the decimated models, until the full resolution distances are computed
+    self.colourModelsByDistance()
+    self.startDistancesTask()
 
+  def onLevelOfDetailAborted(self):
     self.setUpAnimation()
     self.ShowInAnimationMode()
+    self.onDistancesAborted()
+
+  def startDistancesTask(self):
+    # Calculate the difference between the full resolution models in the background,
+    # the models can be inspected in the meantime
+    logic = QuickModelAlignLogic()
+    displayModels = None
+    if self.sourceModelNode is not self.meshSession.sourceModelNode:
+      displayModels = (self.sourceModelNode, self.targetModelNode)
+    task = logic.computeDistancesTask(self.meshSession.sourceModelNode, self.meshSession.targetModelNode,
+      self.meshSession.targetPath if self.useDistanceGridCheckBox.checked else None, self.errorToleranceValue.value, displayModels)
+    self.startTask(task, self.onDistancesComputed, self.onDistancesAborted)
+
+  def onDistancesAborted(self):
+    self.clearButton.show()
+    self.clearButton.enabled = True
+    self.rulerWidget.show()
+
+  def onDistancesComputed(self, result):
+    self.meshSession.sourceModelNode.SetAndObservePolyData(result["source"])
+    self.meshSession.targetModelNode.SetAndObservePolyData(result["target"])
+    if "sourceDisplay" in result:
+      self.sourceModelNode.SetAndObservePolyData(result["sourceDisplay"])
+      self.targetModelNode.SetAndObservePolyData(result["targetDisplay"])
+    self.colourModelsByDistance()
+
+    self.comparisonMetrics = result["metrics"]
+    self.updateMetrics()
+    self.resultsCollapsibleButton.show()
+
+    self.runTrace.extend(result["trace"])
+    QuickModelAlignLogic().writeTrace(self.runTrace)
+    QuickModelAlignLogic().recordComparison(self.meshSession, self.scaling, self.alignmentResult, self.comparisonMetrics,
+      self.errorToleranceValue.value, QuickModelAlignLogic().applyPreset(self.parameterDictionary, self.presetName), self.runTrace)
+    if self.showTimingCheckBox.checked:
+      self.view.cornerAnnotation().SetText(vtk.vtkCornerAnnotation.UpperLeft, self.runTrace.summary())
 
+    self.clearButton.show()
+    self.clearButton.enabled = True
+    self.rulerWidget.show()
+
+  def colourModelsByDistance(self):
+    m1 = self.sourceModelNode
+    m2 = self.targetModelNode
     tolerableErrorMargin = self.errorToleranceValue.value
 
     moduleDir = os.path.dirname(slicer.util.modulePath(self.__module__))
@@ -314,13 +526,7 @@ class QuickModelAlignWidget(ScriptedLoadableModuleWidget):
     self.redColorMapPath = moduleDir +'/Resources/CustomColorMaps/red.txt'
     self.blueColorMapPath = moduleDir +'/Resources/CustomColorMaps/blue.txt'
 
-
     #   Color the Source Model
-    distanceFilter = vtk.vtkDistancePolyDataFilter()
-    distanceFilter.SetInputData(0, m1.GetPolyData())
-    distanceFilter.SetInputData(1, m2.GetPolyData())
-    distanceFilter.Update()
-    m1.SetAndObservePolyData( distanceFilter.GetOutput() )
     m1.GetDisplayNode().SetActiveScalarName('Distance')
     customBlueTxtFilePath = self.blueColorMapPath
     customBlueColorMapTable = slicer.util.loadColorTable(customBlueTxtFilePath, False)
@@ -329,11 +535,6 @@ class QuickModelAlignWidget(ScriptedLoadableModuleWidget):
     m1.GetDisplayNode().SetScalarRange(-tolerableErrorMargin, tolerableErrorMargin)
     
     #   Color the target model
-    distanceFilter2 = vtk.vtkDistancePolyDataFilter()
-    distanceFilter2.SetInputData(0, m2.GetPolyData())
-    distanceFilter2.SetInputData(1, m1.GetPolyData())
-    distanceFilter2.Update()
-    m2.SetAndObservePolyData( distanceFilter2.GetOutput() )
     m2.GetDisplayNode().SetActiveScalarName('Distance')
     customRedTxtFilePath = self.redColorMapPath
     customRedColorMapTable = slicer.util.loadColorTable(customRedTxtFilePath, False)
@@ -341,14 +542,175 @@ class QuickModelAlignWidget(ScriptedLoadableModuleWidget):
     m2.GetDisplayNode().SetScalarRangeFlag(0)
     m2.GetDisplayNode().SetScalarRange(-tolerableErrorMargin, tolerableErrorMargin)
 
+  def startTask(self, task, onFinished, onAborted):
+    """Run a background task, showing its progress. onFinished is called with the result
+    of the task, onAborted if the task failed or was cancelled."""
+    self.task = task
+    self.taskFinishedCallback = onFinished
+    self.taskAbortedCallback = onAborted
+    self.progressBar.value = 0
+    self.progressBar.setFormat("Starting...")
+    self.progressBar.show()
+    self.cancelButton.show()
+    self.cancelButton.enabled = True
+    task.start()
+    self.taskTimer.start()
+
+  def onTaskTimer(self):
+    if not self.task:
+      self.taskTimer.stop()
+      return
+    for stage, detail in self.task.poll():
+      if stage in tasks.STAGES:
+        self.progressBar.value = tasks.STAGES.index(stage)
+      self.progressBar.setFormat(f"{stage} ({detail})..." if detail else f"{stage}...")
+    if not self.task.isDone():
+      return
+    task = self.task
+    self.task = None
+    self.taskTimer.stop()
+    self.progressBar.hide()
+    self.cancelButton.hide()
+    if task.state == "finished":
+      self.taskFinishedCallback(task.result)
+      return
+    if task.state == "failed":
+      logging.error(task.error)
+      slicer.util.errorDisplay("Processing failed.", detailedText=task.error)
+    self.taskAbortedCallback()
+
+  def onCancelButton(self):
+    if self.task:
+      self.cancelButton.enabled = False
+      self.progressBar.setFormat("Cancelling...")
+      self.task.cancel()
+
+
+  def updatePresets(self, selectedName=None):
+    selectedName = selectedName or self.presetComboBox.currentText
+    self.presetComboBox.clear()
+    self.presetComboBox.addItem("Default")
+    self.presetComboBox.addItems(tuning.listPresets(QuickModelAlignLogic().presetDirectory()))
+    index = self.presetComboBox.findText(selectedName)
+    self.presetComboBox.currentIndex = max(index, 0)
+
+  def selectedPreset(self):
+    """Name of the selected parameter preset, None for the default parameters."""
+    return self.presetComboBox.currentText if self.presetComboBox.currentIndex > 0 else None
+
+  def onTuneParametersButton(self):
+    preparedPath = self.sourceModelSelector.currentPath
+    idealPath = self.targetModelSelector.currentPath
+    if not (preparedPath and idealPath):
+      slicer.util.errorDisplay("Select a prepared and an ideal model to tune the parameters on.")
+      return
+    if self.task:
+      return
+    name = qt.QInputDialog.getText(slicer.util.mainWindow(), "Tune parameters", "Preset name:")
+    if not name:
+      return
+    try:
+      # Check the name before minutes of work
+      tuning.presetPath(name)
+    except ValueError as e:
+      slicer.util.errorDisplay(str(e))
+      return
+    self.tunedPresetName = name
+    self.loadModelsButton.enabled = False
+    task = QuickModelAlignLogic().parameterSweepTask([(preparedPath, idealPath)], name)
+    self.startTask(task, self.onParametersTuned, self.onSelect)
+
+  def onParametersTuned(self, result):
+    best = result["best"]
+    if best is None:
+      slicer.util.warningDisplay("No parameter setting aligned the models within %.3f mm, no preset was saved." % result["targetError"])
+    else:
+      self.updatePresets(self.tunedPresetName)
+      slicer.util.infoDisplay("Saved preset \"%s\": %.1f seconds per alignment, error up to %.3f mm." % (
+        self.tunedPresetName, best["meanSeconds"], best["maximumError"]))
+    self.onSelect()
 
   def onChangeTolerance(self):
     #
+    if not self.comparisonMetrics:
+      return
     tolerableErrorMargin = self.errorToleranceValue.value
     m1 = self.sourceModelNode
     m2 = self.targetModelNode
     m1.GetDisplayNode().SetScalarRange(-tolerableErrorMargin, tolerableErrorMargin)
     m2.GetDisplayNode().SetScalarRange(-tolerableErrorMargin, tolerableErrorMargin)
+    self.updateMetrics()
+
+  def updateMetrics(self):
+    # Only binary searches on presorted arrays, cheap enough for every slider move
+    self.metricsLabel.text = self.comparisonMetrics.formatSummary(self.errorToleranceValue.value)
+    if self.templateCandidates:
+      self.metricsLabel.text += "\n\nIdeal models:\n" + templates.formatRanking(self.templateCandidates)
+
+  def onExportMetricsButton(self):
+    path = qt.QFileDialog.getSaveFileName(None, "Export results", "QuickModelAlignResults.csv", "CSV files (*.csv);;JSON files (*.json)")
+    if not path:
+      return
+    extraFields = {
+      "prepared": self.meshSession.sourcePath,
+      "ideal": self.meshSession.targetPath,
+      "transform": " ".join(repr(float(element)) for element in np.asarray(self.transformMatrix).ravel()),
+      }
+    self.comparisonMetrics.export(path, self.errorToleranceValue.value, extraFields)
+
+  def onSaveBundleButton(self):
+    path = qt.QFileDialog.getSaveFileName(None, "Save result", "QuickModelAlignResult" + bundle.BUNDLE_EXTENSION,
+      f"QuickModelAlign results (*{bundle.BUNDLE_EXTENSION})")
+    if not path:
+      return
+    logic = QuickModelAlignLogic()
+    with slicer.util.tryWithErrorDisplay("Failed to save the result.", waitCursor=True):
+      if self.resultBundle:
+        # Opened from a bundle: the full resolution models are not in the scene
+        self.resultBundle.metadata["tolerance"] = self.errorToleranceValue.value
+        self.resultBundle.write(path)
+      else:
+        displayModels = None
+        if self.sourceModelNode is not self.meshSession.sourceModelNode:
+          displayModels = (self.sourceModelNode, self.targetModelNode)
+        logic.saveResultBundle(path, self.meshSession, self.transformMatrix, self.scaling, logic.applyPreset(self.parameterDictionary, self.presetName),
+          self.errorToleranceValue.value, displayModels, self.triangleBudgetSpinBox.value)
+
+  def onOpenBundleButton(self):
+    if self.task:
+      return
+    path = qt.QFileDialog.getOpenFileName(None, "Open saved result", "", f"QuickModelAlign results (*{bundle.BUNDLE_EXTENSION})")
+    if not path:
+      return
+    self.clearScene()
+    logic = QuickModelAlignLogic()
+    self.runTrace = instrumentation.Trace(os.path.basename(path))
+    with slicer.util.tryWithErrorDisplay("Failed to open the result.", waitCursor=True):
+      with self.runTrace.stage("openBundle"):
+        self.resultBundle = logic.openResultBundle(path)
+      self.meshSession = MeshSession(self.resultBundle.metadata["prepared"], self.resultBundle.metadata["ideal"],
+        *logic.displayResultBundle(self.resultBundle))
+      self.sourceModelNode = self.meshSession.sourceModelNode
+      self.targetModelNode = self.meshSession.targetModelNode
+      self.transformMatrix = self.resultBundle.transform
+      self.scaling = self.resultBundle.metadata["scaling"]
+      if self.resultBundle.metadata.get("tolerance") is not None:
+        self.errorToleranceValue.value = self.resultBundle.metadata["tolerance"]
+      with self.runTrace.stage("metrics"):
+        self.comparisonMetrics = self.resultBundle.comparisonMetrics()
+      self.updateLayout()
+      self.setUpAnimation()
+      self.colourModelsByDistance()
+      self.ShowInColourMapMode()
+      self.updateMetrics()
+      self.resultsCollapsibleButton.show()
+      self.clearButton.show()
+      self.clearButton.enabled = True
+      changedInputs = self.resultBundle.changedInputs()
+      if changedInputs:
+        slicer.util.warningDisplay("These models have changed since the result was saved:\n" + "\n".join(changedInputs))
+    if self.showTimingCheckBox.checked:
+      self.view.cornerAnnotation().SetText(vtk.vtkCornerAnnotation.UpperLeft, self.runTrace.summary())
    
 
   def showMinimalScreenUI(self):
@@ -413,14 +775,13 @@ class QuickModelAlignWidget(ScriptedLoadableModuleWidget):
   # ACTIVATED when user presses 1 to show models in animation mode (default)
   def ShowInAnimationMode(self):
 
-    self.rock()
     self.sourceModelNode.GetDisplayNode().SetScalarVisibility(False)
     self.targetModelNode.GetDisplayNode().SetScalarVisibility(False)
     self.sourceModelNode.GetDisplayNode().SetColor([1,1,1])
     self.targetModelNode.GetDisplayNode().SetColor([1,1,1])
     self.sourceModelNode.GetDisplayNode().SetRepresentation(slicer.vtkMRMLDisplayNode.SurfaceRepresentation)
     self.targetModelNode.GetDisplayNode().SetRepresentation(slicer.vtkMRMLDisplayNode.SurfaceRepresentation)
-    self.rockTimer.start()
+    self.animation.start()
 
   # ACTIVATED when user presses 2 to show models in wireframe semi-transparent mode
   def ShowInWireframeMode(self):
@@ -431,11 +792,12 @@ class QuickModelAlignWidget(ScriptedLoadableModuleWidget):
     self.targetModelNode.GetDisplayNode().SetColor([0,0,1])
     self.sourceModelNode.GetDisplayNode().SetRepresentation(slicer.vtkMRMLDisplayNode.WireframeRepresentation)
     self.targetModelNode.GetDisplayNode().SetRepresentation(slicer.vtkMRMLDisplayNode.WireframeRepresentation)
-    self.rockTimer.start()
+    self.animation.start()
 
   # ACTIVATED when user presses 3 to show models in colour map feedback mode
   def ShowInColourMapMode(self):
 
+    self.animation.stop()
     self.sourceModelNode.GetDisplayNode().SetScalarVisibility(True)
     self.targetModelNode.GetDisplayNode().SetScalarVisibility(True)
     self.sourceModelNode.GetDisplayNode().SetOpacity(1)
@@ -444,56 +806,42 @@ class QuickModelAlignWidget(ScriptedLoadableModuleWidget):
     self.targetModelNode.GetDisplayNode().SetRepresentation(slicer.vtkMRMLDisplayNode.SurfaceRepresentation)
     #self.sourceModelNode.GetDisplayNode().SetScalarOpacity(0.1)
     self.view.cornerAnnotation().SetText(vtk.vtkCornerAnnotation.LowerEdge,'Colour Map')
-    self.rockTimer.stop()
 
   def setUpAnimation(self):
-    self.fadeSlider = ctk.ctkSliderWidget()
-    self.fadeSlider.minimum = 0
-    self.fadeSlider.maximum = 1.0
-    self.fadeSlider.value = 0.5
-    self.fadeSlider.singleStep = 0.05
-    self.rockCount = 0
-    self.rocking = True
-    self.rockTimer = None
-    
+    if self.animation:
+      self.animation.stop()
     self.view = slicer.app.layoutManager().threeDWidget(0).threeDView()
     self.view.cornerAnnotation().SetText(vtk.vtkCornerAnnotation.LowerEdge,'Prepared')
-    #self.view.cornerAnnotation().SetText(vtk.vtkCornerAnnotation.LowerEdge,'Prepared')
     self.view.cornerAnnotation().GetTextProperty().SetColor(255,255,255)
+    self.animation = animation.RockingAnimation(self.setAnimationOpacities, self.setAnimationLabel, self.view.forceRender)
     self.view.forceRender()
-    
+
+  def setAnimationOpacities(self, sourceOpacity, targetOpacity):
+    self.sourceModelNode.GetDisplayNode().SetOpacity(sourceOpacity)
+    self.targetModelNode.GetDisplayNode().SetOpacity(targetOpacity)
+
+  def setAnimationLabel(self, text):
+    self.view.cornerAnnotation().SetText(vtk.vtkCornerAnnotation.LowerEdge, text)
 
   def startStopAnimation(self):
+    if self.animation:
+      self.animation.togglePaused()
 
-    if self.rocking == True:
-      #self.rockTimer.stop()
-      self.rocking = False
-    else:
-      #self.rockTimer.start()
-      self.rocking = True
-    
-  def rock(self):
-
-    if self.rocking:
-      if not self.rockTimer:
-        self.rockTimer = qt.QTimer()
-        self.rockTimer.start(80)
-        self.rockTimer.connect('timeout()', self.rock)
-      import math
-      self.fadeSlider.value = 0.5 + math.sin(self.rockCount / 10. ) / 2.
-      self.sourceModelNode.GetDisplayNode().SetOpacity(self.fadeSlider.value)
-      self.targetModelNode.GetDisplayNode().SetOpacity(1-self.fadeSlider.value)
-      
-      if self.fadeSlider.value > 0.5:
-        self.view.cornerAnnotation().SetText(vtk.vtkCornerAnnotation.LowerEdge,'Prepared')
-      else:
-        self.view.cornerAnnotation().SetText(vtk.vtkCornerAnnotation.LowerEdge,'Ideal')
-        
-      self.rockCount += 1
-    
+  def enter(self):
+    # The animation timer only runs while the module is shown
+    if self.animation:
+      self.animation.setShown(True)
+
+  def exit(self):
+    if self.animation:
+      self.animation.setShown(False)
 
   def cleanup(self):
-    pass
+    if self.animation:
+      self.animation.stop()
+    if self.task:
+      self.task.cancel()
+      self.task = None
 
   def addLayoutButton(self, layoutID, buttonAction, toolTip, imageFileName, layoutDiscription):
     layoutManager = slicer.app.layoutManager()
@@ -561,7 +909,80 @@ class QuickModelAlignWidget(ScriptedLoadableModuleWidget):
     errorToleranceValue.maximum = 2
     errorToleranceValue.value = 0.15
     pointDensityFormLayout.addRow("Error Tolerance (mm): ", errorToleranceValue)
-    
+
+    # Precomputed distance field of the ideal model
+    self.useDistanceGridCheckBox = qt.QCheckBox()
+    self.useDistanceGridCheckBox.checked = False
+    self.useDistanceGridCheckBox.setToolTip("If checked, a signed distance grid of the ideal model is computed once (with a resolution derived from the error tolerance) "
+      "and reused for every prepared model compared against it. Speeds up repeated comparisons against the same ideal model. "
+      "Ideal models that are not closed surfaces are always compared exactly.")
+    pointDensityFormLayout.addRow("Reuse ideal distance field: ", self.useDistanceGridCheckBox)
+
+    # Fast path alignment
+    self.fastPathCheckBox = qt.QCheckBox()
+    self.fastPathCheckBox.checked = False
+    self.fastPathCheckBox.setToolTip("If checked, ICP is first tried from the previous alignment, the scanner pose, and centroid and principal axes alignments. "
+      "The slower feature matching (RANSAC) only runs if none of them gives a good fit. Useful when models are scanned in nearly the same pose.")
+    pointDensityFormLayout.addRow("Try fast alignment first: ", self.fastPathCheckBox)
+
+    # Multi-start global registration
+    self.multiStartSpinBox = qt.QSpinBox()
+    self.multiStartSpinBox.minimum = 1
+    self.multiStartSpinBox.maximum = 16
+    self.multiStartSpinBox.value = registration.DEFAULT_PARAMETERS["multiStartRuns"]
+    self.multiStartSpinBox.setToolTip("Number of feature matching (RANSAC) runs started in parallel, each with a different random sampling. "
+      "The best fit is kept, which avoids wrong alignments of symmetric teeth without clicking \"Start Over!\". 1 runs a single RANSAC.")
+    pointDensityFormLayout.addRow("Global registration starts: ", self.multiStartSpinBox)
+
+    # Parameter presets
+    self.presetComboBox = qt.QComboBox()
+    self.presetComboBox.setToolTip("Downsampling and feature parameters used by \"Load my models\" and the alignment. "
+      "Presets are found with \"Tune parameters\" or with QuickModelAlignLib.tuning.")
+    pointDensityFormLayout.addRow("Parameter preset: ", self.presetComboBox)
+    self.tuneParametersButton = qt.QPushButton("Tune parameters on selected models...")
+    self.tuneParametersButton.setToolTip("Try a grid of downsampling and feature parameters on the selected prepared and ideal models, "
+      "and save the fastest setting that aligns them accurately as a new preset. Takes a few minutes.")
+    pointDensityFormLayout.addRow(self.tuneParametersButton)
+
+    # Level of detail of the aligned models
+    self.triangleBudgetSpinBox = qt.QSpinBox()
+    self.triangleBudgetSpinBox.minimum = 0
+    self.triangleBudgetSpinBox.maximum = 100000000
+    self.triangleBudgetSpinBox.singleStep = 100000
+    self.triangleBudgetSpinBox.value = display.TRIANGLE_BUDGET
+    self.triangleBudgetSpinBox.specialValueText = "Full resolution"
+    self.triangleBudgetSpinBox.setToolTip("Models with more triangles are displayed as simplified models, so that rotating the view and the animation stay fluid. "
+      "Distances and results are always computed on the full resolution models. Set to 0 to display full resolution models.")
+    pointDensityFormLayout.addRow("Display triangle budget: ", self.triangleBudgetSpinBox)
+
+    # Point cloud preview
+    self.pointCloudStyleComboBox = qt.QComboBox()
+    self.pointCloudStyleComboBox.addItems(["Points", "Spheres"])
+    self.pointCloudStyleComboBox.setToolTip("How the downsampled models are previewed after loading. Points are much faster to display and use far less memory. "
+      f"At most {display.POINT_BUDGET} points of each model are shown.")
+    pointDensityFormLayout.addRow("Point cloud display: ", self.pointCloudStyleComboBox)
+    self.pointSizeSpinBox = qt.QSpinBox()
+    self.pointSizeSpinBox.minimum = 1
+    self.pointSizeSpinBox.maximum = 20
+    self.pointSizeSpinBox.value = 4
+    self.pointSizeSpinBox.suffix = " px"
+    self.pointSizeSpinBox.setToolTip("Size of the points of the point cloud display, in screen pixels")
+    pointDensityFormLayout.addRow("Point size: ", self.pointSizeSpinBox)
+
+    # Timing summary
+    self.showTimingCheckBox = qt.QCheckBox()
+    self.showTimingCheckBox.checked = False
+    self.showTimingCheckBox.setToolTip("If checked, the time taken by each processing stage is shown in the 3D view. "
+      "A detailed timing and memory trace of every comparison is written to the QuickModelAlign/traces folder of the Slicer temporary directory.")
+    pointDensityFormLayout.addRow("Show timing in 3D view: ", self.showTimingCheckBox)
+
+    # Multi-template matching
+    self.otherIdealModelsSelector = ctk.ctkPathLineEdit()
+    self.otherIdealModelsSelector.filters = ctk.ctkPathLineEdit().Dirs
+    self.otherIdealModelsSelector.setToolTip("Folder of alternative ideal models (*.ply). If set, the prepared model is aligned to the selected ideal model "
+      "and to each of these at the same time, and compared with the one it fits best (highest fitness, then lowest RMSE).")
+    pointDensityFormLayout.addRow("Other ideal models: ", self.otherIdealModelsSelector)
+
     # Point Density slider
     pointDensity = ctk.ctkSliderWidget()
     pointDensity.singleStep = 0.1
@@ -623,7 +1044,7 @@ class QuickModelAlignWidget(ScriptedLoadableModuleWidget):
     # Maximum RANSAC validation steps
     RANSACConfidence = ctk.ctkDoubleSpinBox()
     RANSACConfidence.singleStep = 0.001
-    RANSACConfidence.setDecimals(0)
+    RANSACConfidence.setDecimals(3)
     RANSACConfidence.minimum = 0
     RANSACConfidence.maximum = 1
     RANSACConfidence.value = 0.999
@@ -681,25 +1102,124 @@ class QuickModelAlignWidget(ScriptedLoadableModuleWidget):
     return projectionFactor, pointDensity, errorToleranceValue, normalSearchRadius, FPFHSearchRadius, distanceThreshold, maxRANSAC, RANSACConfidence, ICPDistanceThreshold, alpha, beta, CPDIterations, CPDTolerence
 
  
+#
+# MeshSession
+#
+
+class MeshSession:
+  """
+  Prepared (source) and ideal (target) models of one comparison.
+  Each mesh file is read from disk once; downsampling, display, transform hardening
+  and the distance computation all work on the polydata of these model nodes.
+  """
+
+  def __init__(self, sourcePath, targetPath, sourceModelNode=None, targetModelNode=None):
+    """
+    The models are loaded from sourcePath and targetPath, unless model nodes are given
+    (e.g. the display models of a result bundle).
+    """
+    self.sourcePath = sourcePath
+    self.targetPath = targetPath
+    self.sourceModelNode = sourceModelNode or slicer.util.loadModel(sourcePath)
+    self.targetModelNode = targetModelNode or slicer.util.loadModel(targetPath)
+
+  def modelNodes(self):
+    return [self.sourceModelNode, self.targetModelNode]
+
+  def setModelsVisible(self, visible):
+    for modelNode in self.modelNodes():
+      modelNode.GetDisplayNode().SetVisibility(visible)
+
+  def transformModels(self, sourceMatrix, targetMatrix):
+    """Apply 4x4 numpy matrices to the points of the models, in place."""
+    registration.transformPolyDataInPlace(self.sourceModelNode.GetPolyData(), sourceMatrix)
+    registration.transformPolyDataInPlace(self.targetModelNode.GetPolyData(), targetMatrix)
+
+  def replaceTarget(self, targetPath):
+    """Compare against another ideal model file (e.g. the best match of multi-template matching)."""
+    slicer.mrmlScene.RemoveNode(self.targetModelNode)
+    self.targetPath = targetPath
+    self.targetModelNode = slicer.util.loadModel(targetPath)
+
+  def removeNodes(self):
+    for modelNode in self.modelNodes():
+      slicer.mrmlScene.RemoveNode(modelNode)
+    self.sourceModelNode = None
+    self.targetModelNode = None
+
+
 #
 # QuickModelAlignLogic
 #
 
 class QuickModelAlignLogic(ScriptedLoadableModuleLogic):
 
+  # Shared by all logic instances, so that hit/miss counters accumulate over the session
+  _featureCache = None
+  # Previous alignment, used by the fast path
+  _warmStart = registration.WarmStart()
+  # HTTP job API (see jobserver.JobServer), started on request
+  _jobServer = None
+
+  def featureCache(self):
+    if QuickModelAlignLogic._featureCache is None:
+      QuickModelAlignLogic._featureCache = cache.FeatureCache(os.path.join(slicer.app.cachePath, 'QuickModelAlign', 'features'))
+    return QuickModelAlignLogic._featureCache
+
+  def dependencyStatus(self):
+    """
+    Installation status of open3d and cpdalp (see dependencies.checkDependencies), without importing them.
+    The status is stored in the application settings and reused until the installed packages change.
+    """
+    settings = qt.QSettings()
+    try:
+      cached = json.loads(settings.value('QuickModelAlign/DependencyStatus', '') or 'null')
+    except ValueError:
+      cached = None
+    status = dependencies.checkDependencies(cached)
+    if not status["cached"]:
+      settings.setValue('QuickModelAlign/DependencyStatus', json.dumps(status))
+    return status
+
+  def startJobServer(self, port=jobserver.DEFAULT_PORT, host="127.0.0.1", workers=None, token=None):
+    """
+    Serve comparisons to other lab stations over HTTP (see jobserver). Jobs run in worker
+    processes, Slicer stays responsive. Listens on localhost only unless host is given.
+    Jobs work in the LPS coordinates of the model files, so they use the batch feature cache
+    (cache.defaultCacheDirectory) rather than the RAS features of featureCache().
+    """
+    if QuickModelAlignLogic._jobServer is None:
+      QuickModelAlignLogic._jobServer = jobserver.JobServer(os.path.join(slicer.app.cachePath, 'QuickModelAlign', 'jobs'), host, port,
+        workers, token, cacheDirectory=cache.defaultCacheDirectory())
+      QuickModelAlignLogic._jobServer.start()
+    return QuickModelAlignLogic._jobServer
+
+  def stopJobServer(self):
+    if QuickModelAlignLogic._jobServer is not None:
+      QuickModelAlignLogic._jobServer.stop()
+      QuickModelAlignLogic._jobServer = None
+
+  def installDependenciesTask(self):
+    """Background task that downloads and installs open3d and cpdalp."""
+    return tasks.ThreadTask(dependencies.installDependencies, os.path.join(slicer.app.cachePath, 'QuickModelAlign'))
 
   def RAS2LPSTransform(self, modelNode):
-    matrix=vtk.vtkMatrix4x4()
-    matrix.Identity()
-    matrix.SetElement(0,0,-1)
-    matrix.SetElement(1,1,-1)
-    transform=vtk.vtkTransform()
-    transform.SetMatrix(matrix)
-    transformNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLTransformNode', 'RAS2LPS')
-    transformNode.SetAndObserveTransformToParent( transform )
-    modelNode.SetAndObserveTransformNodeID(transformNode.GetID())
-    slicer.vtkSlicerTransformLogic().hardenTransform(modelNode)
-    slicer.mrmlScene.RemoveNode(transformNode)
+    self.transformModelInPlace(modelNode, registration.RAS_TO_LPS)
+
+  def transformModelInPlace(self, modelNode, matrix):
+    """
+    Apply a 4x4 numpy matrix to the points and normals of a model, in place and without
+    creating transform nodes. Compose several transforms with registration.composeTransforms
+    to apply them in a single pass.
+    """
+    registration.transformPolyDataInPlace(modelNode.GetPolyData(), matrix)
+
+  def alignedSourceMatrix(self, scaling, transformation):
+    """
+    Single matrix taking the source model as loaded to the displayed aligned model: scaling,
+    then the registration result, then the RAS to LPS flip.
+    """
+    return registration.composeTransforms(registration.scalingMatrix(scaling), transformation, registration.RAS_TO_LPS)
 
   def convertMatrixToVTK(self, matrix):
     matrix_vtk = vtk.vtkMatrix4x4()
@@ -740,15 +1260,14 @@ class QuickModelAlignLogic(ScriptedLoadableModuleLogic):
     return polydata_vtk
 
 
-  def displayPointCloud(self, polydata, pointRadius, nodeName, nodeColor):
-    #set up glyph for visualizing point cloud
-    sphereSource = vtk.vtkSphereSource()
-    sphereSource.SetRadius(pointRadius)
-    glyph = vtk.vtkGlyph3D()
-    glyph.SetSourceConnection(sphereSource.GetOutputPort())
-    glyph.SetInputData(polydata)
-    glyph.ScalingOff()
-    glyph.Update()
+  def displayPointCloud(self, points, pointRadius, nodeName, nodeColor, style="points", pointSize=4, budget=display.POINT_BUDGET):
+    """
+    Show a point cloud preview. At most ``budget`` points are shown; "points" style draws them
+    as ``pointSize`` pixel points, "spheres" style as spheres of ``pointRadius``.
+    """
+    polydata = display.pointCloudPolyData(points, budget)
+    if style == "spheres":
+      polydata = display.sphereGlyphPolyData(polydata, pointRadius)
 
     #display
     # modelNode=slicer.mrmlScene.GetFirstNodeByName(nodeName)
@@ -756,11 +1275,44 @@ class QuickModelAlignLogic(ScriptedLoadableModuleLogic):
     modelNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode', nodeName)
     modelNode.CreateDefaultDisplayNodes()
 
-    modelNode.SetAndObservePolyData(glyph.GetOutput())
-    modelNode.GetDisplayNode().SetColor(nodeColor)
+    modelNode.SetAndObservePolyData(polydata)
+    displayNode = modelNode.GetDisplayNode()
+    displayNode.SetColor(nodeColor)
+    if style == "points":
+      displayNode.SetPointSize(pointSize)
+      # Flat colour, vertices have no normals to light
+      displayNode.SetAmbient(1.0)
+      displayNode.SetDiffuse(0.0)
     return modelNode
 
 
+  def saveResultBundle(self, path, meshSession, transformMatrix, scaling, parameters, tolerance, displayModels=None,
+      triangleBudget=display.TRIANGLE_BUDGET):
+    """
+    Save a finished comparison as a result bundle (see bundle.ResultBundle).
+    :param meshSession: session whose models have 'Distance' arrays
+    :param displayModels: optional decimated (source, target) display models with 'Distance' arrays
+    """
+    sourceDisplay, targetDisplay = [model.GetPolyData() for model in displayModels] if displayModels else (None, None)
+    resultBundle = bundle.ResultBundle.fromPolyData(meshSession.sourceModelNode.GetPolyData(), meshSession.targetModelNode.GetPolyData(),
+      transformMatrix, scaling, meshSession.sourcePath, meshSession.targetPath, parameters, tolerance,
+      sourceDisplay, targetDisplay, triangleBudget)
+    resultBundle.write(path)
+    return resultBundle
+
+  def openResultBundle(self, path):
+    return bundle.ResultBundle.read(path)
+
+  def displayResultBundle(self, resultBundle):
+    """Model nodes of the display meshes of a result bundle, with their 'Distance' arrays."""
+    sourcePolyData, targetPolyData = resultBundle.displayPolyData()
+    toothColor = [1, 1, 1]
+    sourceModelNode = self.displayMesh(sourcePolyData, 'Prepared (saved)', toothColor)
+    targetModelNode = self.displayMesh(targetPolyData, 'Ideal (saved)', toothColor)
+    for modelNode in (sourceModelNode, targetModelNode):
+      modelNode.GetDisplayNode().SetInterpolation(0)
+    return sourceModelNode, targetModelNode
+
   def displayMesh(self, polydata, nodeName, nodeColor):
     modelNode=slicer.mrmlScene.GetFirstNodeByName(nodeName)
     if modelNode is None:  # if there is no node with this name, create with display node
@@ -771,94 +1323,235 @@ class QuickModelAlignLogic(ScriptedLoadableModuleLogic):
     modelNode.GetDisplayNode().SetColor(nodeColor)
     return modelNode
 
-  def estimateTransform(self, sourcePoints, targetPoints, sourceFeatures, targetFeatures, voxelSize, skipScaling, parameters):
-    ransac = self.execute_global_registration(sourcePoints, targetPoints, sourceFeatures, targetFeatures, voxelSize,
-      parameters["distanceThreshold"], parameters["maxRANSAC"], parameters["RANSACConfidence"], skipScaling)
-    # Refine the initial registration using an Iterative Closest Point (ICP) registration
-    #import time
-    icp = self.refine_registration(sourcePoints, targetPoints, sourceFeatures, targetFeatures, voxelSize, ransac, parameters["ICPDistanceThreshold"])
+  def presetDirectory(self):
+    # Shared with the command line tools, so that presets tuned with QuickModelAlignLib.tuning are listed
+    return tuning.defaultPresetDirectory()
+
+  def applyPreset(self, parameters, preset=None):
+    """
+    Parameters with the entries of the named preset (see tuning.savePreset) applied.
+    Without a preset, a copy of ``parameters`` is returned.
+    """
+    return tuning.applyPreset(parameters, preset, self.presetDirectory())
+
+  def parameterSweepTask(self, pairs, presetName, targetError=tuning.DEFAULT_TARGET_ERROR):
+    """
+    Background parameter sweep (see tuning.runSweep) on (prepared path, ideal path) pairs; the fastest
+    setting within ``targetError`` is saved as the preset ``presetName``.
+    :return: a tasks.ThreadTask, not started yet. The worker processes are owned by the thread.
+    """
+    return tasks.ThreadTask(tuning.runSweep, pairs, None, targetError, None, None, presetName, self.presetDirectory())
+
+  def estimateTransform(self, sourcePoints, targetPoints, sourceFeatures, targetFeatures, voxelSize, skipScaling, parameters, preset=None):
+    parameters = self.applyPreset(parameters, preset)
+    icp = registration.registerPointClouds(sourcePoints, targetPoints, sourceFeatures, targetFeatures, voxelSize, skipScaling, parameters,
+      warmStart=QuickModelAlignLogic._warmStart)
     return icp.transformation
 
-  def runSubsample(self, sourceModel, targetModel, skipScaling, parameters):
-    from open3d import io
-    from open3d import geometry
-    from open3d import utility
-    print(":: Loading point clouds and downsampling")
+  def runSubsample(self, sourceModel, targetModel, skipScaling, parameters, targetPath=None, preset=None):
+    """
+    Downsample the models and compute their FPFH features.
+    :param targetPath: file the target model was loaded from. If given, the preprocessed
+      target is read from (or stored in) the on-disk feature cache.
+    :param preset: optional name of a parameter preset applied over ``parameters``
+    The models are not modified, the returned scaling is applied to the source model together
+    with the registration result (see alignedSourceMatrix).
+    """
+    parameters = self.applyPreset(parameters, preset)
     sourcePoints = slicer.util.arrayFromModelPoints(sourceModel)
-    source = geometry.PointCloud()
-    source.points = utility.Vector3dVector(sourcePoints)
     targetPoints = slicer.util.arrayFromModelPoints(targetModel)
-    target = geometry.PointCloud()
-    target.points = utility.Vector3dVector(targetPoints)
-    sourceSize = np.linalg.norm(np.asarray(source.get_max_bound()) - np.asarray(source.get_min_bound()))
-    targetSize = np.linalg.norm(np.asarray(target.get_max_bound()) - np.asarray(target.get_min_bound()))
-    voxel_size = targetSize/(55*parameters["pointDensity"])
-    scaling = (targetSize)/sourceSize
-    if skipScaling != 0:
-        scaling = 1
-    source.scale(scaling, center = (0,0,0))
-    points = slicer.util.arrayFromModelPoints(sourceModel)
-    points[:] = np.asarray(source.points)
-    sourceModel.GetPolyData().GetPoints().GetData().Modified()
-    source_down, source_fpfh = self.preprocess_point_cloud(source, voxel_size, parameters["normalSearchRadius"], parameters["FPFHSearchRadius"])
-    target_down, target_fpfh = self.preprocess_point_cloud(target, voxel_size, parameters["normalSearchRadius"], parameters["FPFHSearchRadius"])
+    featureCache = self.featureCache() if targetPath else None
+    source_down, target_down, source_fpfh, target_fpfh, voxel_size, scaling = registration.runSubsample(sourcePoints, targetPoints, skipScaling, parameters,
+      targetPath, featureCache)
+    if featureCache:
+      featureCache.logStatistics()
     return source_down, target_down, source_fpfh, target_fpfh, voxel_size, scaling
 
 
-  def preprocess_point_cloud(self, pcd, voxel_size, radius_normal_factor, radius_feature_factor):
-    from open3d import geometry
-    from open3d import pipelines
-    registration = pipelines.registration
-    print(":: Downsample with a voxel size %.3f." % voxel_size)
-    pcd_down = pcd.voxel_down_sample(voxel_size)
-    radius_normal = voxel_size * radius_normal_factor
-    print(":: Estimate normal with search radius %.3f." % radius_normal)
-    pcd_down.estimate_normals(
-        geometry.KDTreeSearchParamHybrid(radius=radius_normal, max_nn=30))
-    radius_feature = voxel_size * radius_feature_factor
-    print(":: Compute FPFH feature with search radius %.3f." % radius_feature)
-    pcd_fpfh = registration.compute_fpfh_feature(
-        pcd_down,
-        geometry.KDTreeSearchParamHybrid(radius=radius_feature, max_nn=100))
-    return pcd_down, pcd_fpfh
+  def runSubsampleTask(self, sourceModel, targetModel, skipScaling, parameters, targetPath=None, preset=None):
+    """
+    Background counterpart of runSubsample: downsampling and feature computation run in a
+    separate process that can be cancelled. Pass the result of the finished task to
+    finishSubsampleTask.
+    :return: a tasks.ProcessTask, not started yet
+    """
+    parameters = self.applyPreset(parameters, preset)
+    sourcePoints = slicer.util.arrayFromModelPoints(sourceModel)
+    targetPoints = slicer.util.arrayFromModelPoints(targetModel)
+    cacheDirectory = self.featureCache().directory if targetPath else None
+    return tasks.ProcessTask(tasks.subsampleTask, sourcePoints, targetPoints, skipScaling, parameters, targetPath, cacheDirectory)
 
+  def finishSubsampleTask(self, sourceModel, result):
+    """
+    Apply the result of a runSubsampleTask: rebuild the point clouds.
+    :return: same as runSubsample
+    """
+    if result["cacheStatistics"]:
+      logging.info("Feature cache: %(hits)d hits, %(misses)d misses" % result["cacheStatistics"])
+    scaling = result["scaling"]
+    source_down, source_fpfh = registration.preprocessedFromArrays(**result["source"])
+    target_down, target_fpfh = registration.preprocessedFromArrays(**result["target"])
+    return source_down, target_down, source_fpfh, target_fpfh, result["voxelSize"], scaling
+
+  def estimateTransformTask(self, sourcePoints, targetPoints, sourceFeatures, targetFeatures, voxelSize, skipScaling, parameters, preset=None):
+    """
+    Background counterpart of estimateTransform, running RANSAC and ICP in a separate process.
+    :return: a tasks.ProcessTask, not started yet. Its result holds the 'transformation' matrix.
+    """
+    parameters = self.applyPreset(parameters, preset)
+    return tasks.ProcessTask(tasks.registrationTask, registration.preprocessedToArrays(sourcePoints, sourceFeatures),
+      registration.preprocessedToArrays(targetPoints, targetFeatures), voxelSize, skipScaling, parameters, QuickModelAlignLogic._warmStart)
 
-  def execute_global_registration(self, source_down, target_down, source_fpfh,
-                                target_fpfh, voxel_size, distance_threshold_factor, maxIter, confidence, skipScaling):
-    from open3d import pipelines
-    registration = pipelines.registration
-    distance_threshold = voxel_size * distance_threshold_factor
-    print(":: RANSAC registration on downsampled point clouds.")
-    print("   Since the downsampling voxel size is %.3f," % voxel_size)
-    print("   we use a liberal distance threshold %.3f." % distance_threshold)
+  def templateIdealPaths(self, targetPath, directory, sourcePath=None):
+    """
+    Ideal models of multi-template matching: the selected ideal model, then the *.ply files of
+    ``directory`` other than the selected prepared and ideal models.
+    """
+    excluded = {os.path.abspath(path) for path in (targetPath, sourcePath) if path}
+    return [targetPath] + [path for path in sorted(glob.glob(os.path.join(directory, '*.ply'))) if os.path.abspath(path) not in excluded]
+
+  def templateMatchingTask(self, sourceModel, idealPaths, skipScaling, parameters, preset=None):
+    """
+    Background multi-template matching (see templates.matchTemplates): the source model is aligned
+    to every ideal model file in a pool of worker processes. The ideal models are converted from
+    their file coordinates (LPS) to RAS, like models loaded in the scene, so that the transforms
+    apply to the model nodes and the feature cache is shared with runSubsampleTask.
+    :return: a tasks.ThreadTask, not started yet
+    """
+    parameters = self.applyPreset(parameters, preset)
+    sourcePoints = slicer.util.arrayFromModelPoints(sourceModel)
+    return tasks.ThreadTask(tasks.templateMatchingTask, sourcePoints, idealPaths, skipScaling, parameters,
+      self.featureCache().directory, registration.RAS_TO_LPS)
+
+  def logTemplateRanking(self, candidates):
+    for candidate in candidates:
+      if candidate["status"] != "ok":
+        logging.warning("Template matching: %s failed\n%s" % (candidate["ideal"], candidate.get("traceback", candidate["error"])))
+    logging.info("Template matching:\n" + templates.formatRanking(candidates))
+
+  def traceDirectory(self):
+    return os.path.join(slicer.app.temporaryPath, 'QuickModelAlign', 'traces')
+
+  def writeTrace(self, trace):
+    """
+    Write the instrumentation trace of a comparison as JSON to traceDirectory.
+    :return: path of the written file
+    """
+    os.makedirs(self.traceDirectory(), exist_ok=True)
+    path = os.path.join(self.traceDirectory(), datetime.now().strftime('run-%Y%m%d-%H%M%S.json'))
+    trace.write(path)
+    logging.info("Timing trace written to %s" % path)
+    return path
+
+  def resultsStorePath(self):
+    return os.path.join(os.path.dirname(slicer.app.slicerUserSettingsFilePath), 'QuickModelAlign', 'results.sqlite')
+
+  def recordComparison(self, meshSession, scaling, alignmentResult, comparisonMetrics, tolerance, parameters, trace):
+    """
+    Add a finished interactive comparison to the results store (see store.ResultsStore).
+    Failures are logged only, they must not interrupt the review of the comparison.
+    """
+    stageSeconds = trace.stageSeconds()
+    result = {
+      "prepared": meshSession.sourcePath,
+      "preparedSHA256": cache.fileHash(meshSession.sourcePath),
+      "ideal": meshSession.targetPath,
+      "idealSHA256": cache.fileHash(meshSession.targetPath),
+      "scaling": float(scaling),
+      "fitness": alignmentResult["fitness"],
+      "inlierRMSE": alignmentResult["inlierRMSE"],
+      "globalRegistration": alignmentResult["globalRegistration"],
+      "transform": np.asarray(alignmentResult["transformation"]).tolist(),
+      "toleranceMetrics": comparisonMetrics.summary(tolerance),
+      "seconds": sum(stageSeconds.values()),
+      "stageSeconds": stageSeconds,
+      "peakRSSBytes": trace.peakRSSBytes(),
+      "allocatedBytes": trace.allocatedBytes(),
+      }
+    try:
+      with store.ResultsStore(self.resultsStorePath()) as resultsStore:
+        resultsStore.addRun(result, parameters, origin="interactive")
+    except Exception as e:
+      logging.warning(f"Comparison could not be added to the results store: {e}")
+
+  def finishEstimateTransformTask(self, result):
+    """
+    Keep the fast path state of a finished estimateTransformTask and log how the alignment was found.
+    """
+    QuickModelAlignLogic._warmStart = result["warmStart"]
+    logging.info("Registration: global %(engine)s fitness %(fitness).3f in %(seconds).2f seconds" % result["globalRegistration"]
+      + ", ICP fitness %.3f, inlier RMSE %.4f" % (result["fitness"], result["inlierRMSE"]))
+    for index, level in enumerate(result["ICP"]):
+      logging.info("ICP level %d (voxel size %.3f): about %d iterations, %.2f seconds" % (index + 1, level["voxelSize"], level["estimatedIterations"], level["seconds"]))
+    fastPath = result["fastPath"]
+    if fastPath and fastPath["secondsSaved"] is not None:
+      logging.info("Fast path %s, %.2f seconds saved" % ("accepted" if fastPath["accepted"] else "rejected", fastPath["secondsSaved"]))
+
+  @staticmethod
+  def sharedPolyData(model):
+    """
+    Shallow copy of the polydata of a model for a background thread: the point and cell
+    arrays are shared rather than copied, and the thread only adds arrays to its copy.
+    The model is only transformed again after the task has finished or been cancelled,
+    and results of cancelled tasks are discarded.
+    """
+    polyData = vtk.vtkPolyData()
+    polyData.ShallowCopy(model.GetPolyData())
+    return polyData
+
+  def levelOfDetailTask(self, sourceModel, targetModel, triangleBudget):
+    """
+    Decimated copies of the two models for display, built in a background thread.
+    :return: a tasks.ThreadTask, not started yet. Its result is the decimated source and
+      target polydata with a preview 'Distance' point array.
+    """
+    sourcePolyData, targetPolyData = self.sharedPolyData(sourceModel), self.sharedPolyData(targetModel)
+    return tasks.ThreadTask(tasks.levelOfDetailTask, sourcePolyData, targetPolyData, triangleBudget)
 
-    result = registration.registration_ransac_based_on_feature_matching(
-        source_down, target_down, source_fpfh, target_fpfh, True,
-        distance_threshold,
-        registration.TransformationEstimationPointToPoint(False),
-        3, [
-            registration.CorrespondenceCheckerBasedOnEdgeLength(
-                0.9),
-            registration.CorrespondenceCheckerBasedOnDistance(
-                distance_threshold)
-        ], registration.RANSACConvergenceCriteria(100000, 0.999))
+  def computeDistancesTask(self, sourceModel, targetModel, targetPath=None, tolerance=None, displayModels=None):
+    """
+    Signed distances between the two models, computed in a background thread.
+    The thread works on shallow copies, so the models can be displayed in the meantime.
+    :param targetPath: if set, source to target distances are interpolated from the precomputed
+      signed distance grid of this target file (computed and cached on first use)
+    :param tolerance: error tolerance the grid resolution is derived from
+    :param displayModels: optional decimated (source, target) display models, the distances
+      are carried over to them
+    :return: a tasks.ThreadTask, not started yet. Its result is the source and target
+      polydata with a 'Distance' point array.
+    """
+    sourcePolyData, targetPolyData = self.sharedPolyData(sourceModel), self.sharedPolyData(targetModel)
+    cacheDirectory = self.featureCache().directory if targetPath else None
+    # The display models are only read, and replaced rather than modified when the task finishes
+    sourceDisplay, targetDisplay = [model.GetPolyData() for model in displayModels] if displayModels else (None, None)
+    return tasks.ThreadTask(tasks.distancesTask, sourcePolyData, targetPolyData, targetPath, tolerance, cacheDirectory,
+      sourceDisplay, targetDisplay)
 
+  def preprocess_point_cloud(self, pcd, voxel_size, radius_normal_factor, radius_feature_factor):
+    return registration.preprocess_point_cloud(pcd, voxel_size, radius_normal_factor, radius_feature_factor)
 
-    return result
 
+  def execute_global_registration(self, source_down, target_down, source_fpfh,
+                                target_fpfh, voxel_size, distance_threshold_factor, maxIter, confidence, skipScaling):
+    return registration.execute_global_registration(source_down, target_down, source_fpfh,
+      target_fpfh, voxel_size, distance_threshold_factor, maxIter, confidence, skipScaling)
 
 
   def refine_registration(self, source, target, source_fpfh, target_fpfh, voxel_size, result_ransac, ICPThreshold_factor):
-    from open3d import pipelines
-    registration = pipelines.registration
-    distance_threshold = voxel_size * ICPThreshold_factor
-    print(":: Point-to-plane ICP registration is applied on original point")
-    print("   clouds to refine the alignment. This time we use a strict")
-    print("   distance threshold %.3f." % distance_threshold)
-    result = registration.registration_icp(
-        source, target, distance_threshold, result_ransac.transformation,
-        registration.TransformationEstimationPointToPlane())
-    return result
+    return registration.refine_registration(source, target, source_fpfh, target_fpfh, voxel_size, result_ransac, ICPThreshold_factor)
+
+
+  def runBatch(self, idealPath, prepared, outputPath=None, workers=None, parameters=None, skipScaling=True):
+    """
+    Align every prepared model to one ideal model, without GUI.
+    :param idealPath: ideal (target) model file
+    :param prepared: directory of prepared (source) model files, or a list of file paths
+    :param outputPath: .csv or .json file the transforms and distance metrics are written to
+    :param workers: number of worker processes, defaults to the number of CPU cores
+    :param parameters: parameter dictionary as used by the widget, missing entries use the defaults
+    :return: list of result dictionaries, one per prepared model
+    """
+    return batch.runBatch(idealPath, prepared, outputPath, workers, parameters, skipScaling)
 
 
 
@@ -894,3 +1587,478 @@ class QuickModelAlignLogic(ScriptedLoadableModuleLogic):
     stopTime = time.time()
     logging.info(f'Processing completed in {stopTime-startTime:.2f} seconds')
 
+
+
+#
+# QuickModelAlignTest
+#
+
+class QuickModelAlignTest(ScriptedLoadableModuleTest):
+  """
+  This is the test case for your scripted module.
+  Uses ScriptedLoadableModuleTest base class, available at:
+  https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
+  """
+
+  def setUp(self):
+    """ Do whatever is needed to reset the state - typically a scene clear will be enough.
+    """
+    slicer.mrmlScene.Clear(0)
+
+  def runTest(self):
+    """Run as few or as many tests as needed here.
+    """
+    self.setUp()
+    self.test_DistanceEngineMatchesVTK()
+    self.setUp()
+    self.test_DistanceGrid()
+    self.setUp()
+    self.test_DistanceTaskCancellation()
+    self.setUp()
+    self.test_SortedDistancesMatchBruteForce()
+    self.setUp()
+    self.test_FeatureCacheRoundTripAndEviction()
+    self.setUp()
+    self.test_ResultBundleRoundTrip()
+    self.setUp()
+    self.test_ResultsStoreQueries()
+    self.setUp()
+    self.test_BatchResults()
+    self.setUp()
+    self.test_IngestQueue()
+    self.setUp()
+    self.test_JobServer()
+
+  def mixedSizeMesh(self):
+    """Latitude-longitude sphere (thin triangles at the poles, long ones at the equator) and
+    one triangle about a hundred times larger below it."""
+    sphere = vtk.vtkSphereSource()
+    sphere.SetRadius(10.0)
+    sphere.SetThetaResolution(120)
+    sphere.SetPhiResolution(16)
+    sphere.Update()
+    vertices, triangles = distance.trianglesFromPolyData(sphere.GetOutput())
+    vertices = np.vstack([vertices, [[-200.0, -200.0, -15.0], [200.0, -200.0, -15.0], [0.0, 200.0, -15.0]]])
+    triangles = np.vstack([triangles, [[len(vertices) - 3, len(vertices) - 2, len(vertices) - 1]]])
+    return distance.polyDataFromTriangles(vertices, triangles)
+
+  def test_DistanceEngineMatchesVTK(self):
+    self.delayDisplay("Starting the distance engine test")
+    reference = self.mixedSizeMesh()
+    vertices, _ = distance.trianglesFromPolyData(reference)
+    rng = np.random.default_rng(0)
+    # Points near the sphere and anywhere around it, as a triangle soup so that vtkDistancePolyDataFilter accepts them
+    points = np.vstack([vertices[:-3] + rng.normal(scale=0.5, size=(len(vertices) - 3, 3)), rng.uniform(-20, 20, size=(2001, 3))])
+    points = points[:len(points) - len(points) % 3]
+    polydata = distance.polyDataFromTriangles(points, np.arange(len(points)).reshape(-1, 3))
+
+    engineDistances = distance.distanceArray(distance.computeSignedDistance(polydata, reference))
+    vtkDistances = distance.distanceArray(distance.computeSignedDistanceVTK(polydata, reference))
+    self.assertLess(np.abs(np.abs(engineDistances) - np.abs(vtkDistances)).max(), 1e-9)
+    farFromSurface = np.abs(vtkDistances) > 1e-6
+    np.testing.assert_array_equal(np.sign(engineDistances[farFromSurface]), np.sign(vtkDistances[farFromSurface]))
+    self.delayDisplay("Distance engine test passed")
+
+  def test_DistanceGrid(self):
+    self.delayDisplay("Starting the distance grid test")
+    sphere = vtk.vtkSphereSource()
+    sphere.SetRadius(10.0)
+    sphere.SetThetaResolution(48)
+    sphere.SetPhiResolution(48)
+    sphere.Update()
+    ideal = sphere.GetOutput()
+    engine = distance.SurfaceDistanceEngine(ideal)
+    tolerance = 0.5
+    grid = sdf.SignedDistanceGrid.build(ideal, sdf.gridSpacingForTolerance(tolerance), 3 * tolerance, engine)
+    self.assertLessEqual(grid.maximumInterpolationError, tolerance / 2 + 1e-12)
+    # Only the bricks around the surface are stored
+    self.assertLess(grid.nbytes, 0.5 * np.prod(grid.dimensions) * 4)
+
+    rng = np.random.default_rng(4)
+    directions = rng.normal(size=(20000, 3))
+    directions /= np.linalg.norm(directions, axis=1)[:, np.newaxis]
+    points = directions * rng.uniform(10.0 - 2 * tolerance, 10.0 + 2 * tolerance, size=(len(directions), 1))
+    values, valid = grid.interpolate(points)
+    self.assertGreater(valid.mean(), 0.9)
+    exact = engine.signedDistance(points)
+    self.assertLessEqual(np.abs(values[valid] - exact[valid]).max(), grid.maximumInterpolationError + 1e-6)
+    # Points away from the band fall back to the engine
+    farPoints = np.vstack([points[:100], [[0.0, 0.0, 0.0], [30.0, 0.0, 0.0]]])
+    np.testing.assert_allclose(grid.signedDistance(farPoints, engine)[-2:], engine.signedDistance(farPoints[-2:]))
+    self.assertTrue(np.isnan(grid.signedDistance(farPoints)[-2:]).all())
+    with self.assertRaises(sdf.GridTooLargeError):
+      sdf.SignedDistanceGrid.build(ideal, sdf.gridSpacingForTolerance(tolerance), 3 * tolerance, engine, maxVoxels=1000)
+
+    with tempfile.TemporaryDirectory() as directory:
+      idealPath = os.path.join(directory, "ideal.ply")
+      self.writeSphere(idealPath, radius=10.0, resolution=48)
+      featureCache = cache.FeatureCache(os.path.join(directory, "features"))
+      built = sdf.loadOrBuildGrid(ideal, idealPath, tolerance, featureCache, engine=engine)
+      loaded = sdf.loadOrBuildGrid(ideal, idealPath, tolerance, featureCache, engine=engine)
+      np.testing.assert_array_equal(loaded.interpolate(points)[0], built.interpolate(points)[0])
+      # Open meshes have no grid: the interpolation bound does not hold across their borders
+      vertices, triangles = distance.trianglesFromPolyData(ideal)
+      openMesh = distance.polyDataFromTriangles(vertices, triangles[1:])
+      self.assertIsNone(sdf.loadOrBuildGrid(openMesh, idealPath, tolerance))
+    self.delayDisplay("Distance grid test passed")
+
+  def test_DistanceTaskCancellation(self):
+    self.delayDisplay("Starting the distance task cancellation test")
+    spheres = []
+    for radius, resolution in ((9.5, 300), (10.0, 200)):
+      sphere = vtk.vtkSphereSource()
+      sphere.SetRadius(radius)
+      sphere.SetThetaResolution(resolution)
+      sphere.SetPhiResolution(resolution)
+      sphere.Update()
+      spheres.append(sphere.GetOutput())
+    startTime = time.perf_counter()
+    distance.computeSignedDistance(*spheres)
+    directionSeconds = time.perf_counter() - startTime
+    task = tasks.ThreadTask(tasks.distancesTask, *spheres)
+    task.start()
+    # Cancelled once the first direction (distance.computeSignedDistance of the prepared model) has started
+    while ("distances", "prepared") not in task.poll():
+      self.assertFalse(task.isDone())
+      time.sleep(0.01)
+    time.sleep(0.1 * directionSeconds)
+    cancelTime = time.perf_counter()
+    task.cancel()
+    task.thread.join(30.0)
+    self.assertFalse(task.thread.is_alive())
+    stopSeconds = time.perf_counter() - cancelTime
+    # Without the stop check the thread would only notice the cancellation after the whole direction
+    self.assertLess(stopSeconds, 0.5 * directionSeconds)
+    messages = []
+    while not task.messageQueue.empty():
+      messages.append(task.messageQueue.get_nowait())
+    # Stopped within the first direction: the second one was never started, and no result was produced
+    self.assertEqual(messages, [("cancelled", None)])
+    self.assertEqual(task.state, "cancelled")
+    self.assertIsNone(task.result)
+    self.delayDisplay("Distance task cancellation test passed")
+
+  def test_SortedDistancesMatchBruteForce(self):
+    self.delayDisplay("Starting the sorted distances test")
+    rng = np.random.default_rng(1)
+    # Rounded, so that thresholds fall on repeated distances
+    distances = np.round(rng.normal(scale=0.3, size=5000), 2)
+    areas = rng.uniform(0.01, 0.1, size=len(distances))
+    sortedDistances = metrics.SortedDistances(distances, areas)
+    for threshold in (-1.0, -0.15, 0.0, 0.05, 0.15, distances.max(), 2.0):
+      above = distances > threshold
+      below = distances < threshold
+      np.testing.assert_allclose(sortedDistances.areaAbove(threshold), (areas[above].sum(), (areas * distances)[above].sum()), atol=1e-9)
+      np.testing.assert_allclose(sortedDistances.areaBelow(threshold), (areas[below].sum(), (areas * distances)[below].sum()), atol=1e-9)
+    order = np.argsort(np.abs(distances), kind="stable")
+    cumulativeArea = np.cumsum(areas[order])
+    for percent in (0, 50, 95, 100):
+      expected = np.abs(distances[order])[np.flatnonzero(cumulativeArea >= cumulativeArea[-1] * percent / 100.0 - 1e-12)[0]]
+      self.assertAlmostEqual(sortedDistances.absolutePercentile(percent), expected)
+    self.assertAlmostEqual(sortedDistances.rms, np.sqrt(np.sum(areas * distances**2) / areas.sum()))
+    self.assertEqual(sortedDistances.maximumAbsolute, np.abs(distances).max())
+    self.delayDisplay("Sorted distances test passed")
+
+  def test_FeatureCacheRoundTripAndEviction(self):
+    self.delayDisplay("Starting the feature cache test")
+    with tempfile.TemporaryDirectory() as directory:
+      meshPath = os.path.join(directory, "ideal.ply")
+      with open(meshPath, "wb") as f:
+        f.write(b"mesh content")
+      featureCache = cache.FeatureCache(os.path.join(directory, "features"))
+      parameters = registration.completeParameters()
+      key = featureCache.key(meshPath, parameters)
+      self.assertEqual(key, featureCache.key(meshPath, dict(parameters, maxRANSAC=1)))
+      self.assertNotEqual(key, featureCache.key(meshPath, dict(parameters, pointDensity=parameters["pointDensity"] + 0.1)))
+      self.assertIsNone(featureCache.load(key))
+
+      rng = np.random.default_rng(2)
+      arrays = {"points": rng.normal(size=(1000, 3)), "features": rng.normal(size=(33, 1000))}
+      featureCache.store(key, **arrays)
+      entry = featureCache.load(key)
+      self.assertEqual(set(entry), set(arrays))
+      for name in arrays:
+        np.testing.assert_array_equal(entry[name], arrays[name])
+      self.assertEqual((featureCache.statistics()["hits"], featureCache.statistics()["misses"]), (1, 1))
+
+      # With room for two entries, storing a third evicts the least recently used one
+      keys = [key] + [featureCache.key(meshPath, dict(parameters, pointDensity=density)) for density in (0.5, 0.6)]
+      featureCache.store(keys[1], **arrays)
+      os.utime(featureCache.entryPath(keys[0]), (1000, 1000))
+      os.utime(featureCache.entryPath(keys[1]), (2000, 2000))
+      self.assertIsNotNone(featureCache.load(keys[0]))
+      featureCache.maxBytes = 2.5 * os.path.getsize(featureCache.entryPath(keys[0]))
+      featureCache.store(keys[2], **arrays)
+      self.assertTrue(os.path.exists(featureCache.entryPath(keys[0])))
+      self.assertFalse(os.path.exists(featureCache.entryPath(keys[1])))
+      self.assertTrue(os.path.exists(featureCache.entryPath(keys[2])))
+    self.delayDisplay("Feature cache test passed")
+
+  def test_ResultBundleRoundTrip(self):
+    self.delayDisplay("Starting the result bundle test")
+    rng = np.random.default_rng(3)
+    displayMeshes = []
+    for vertexCount in (300, 200):
+      vertices = rng.normal(size=(vertexCount, 3))
+      displayMeshes.append((vertices, rng.integers(0, vertexCount, size=(2 * vertexCount, 3)), rng.normal(scale=0.2, size=vertexCount)))
+    transform = np.eye(4)
+    transform[:3, 3] = (1.0, -2.0, 0.5)
+    metadata = {"formatVersion": bundle.FORMAT_VERSION, "prepared": "prepared.ply", "ideal": "ideal.ply", "scaling": 1.02,
+      "parameters": {"pointDensity": 0.8}, "tolerance": 0.15}
+    original = bundle.ResultBundle(metadata, transform, rng.normal(scale=0.2, size=4000), rng.uniform(0.01, 0.1, size=4000),
+      rng.normal(scale=0.2, size=3000), rng.uniform(0.01, 0.1, size=3000), *displayMeshes)
+    with tempfile.TemporaryDirectory() as directory:
+      path = os.path.join(directory, "result" + bundle.BUNDLE_EXTENSION)
+      original.write(path)
+      restored = bundle.ResultBundle.read(path)
+      self.assertEqual(restored.metadata, dict(metadata, distanceType="float32"))
+      np.testing.assert_array_equal(restored.transform, transform)
+      for name in ("sourceDistances", "sourceAreas", "targetDistances", "targetAreas"):
+        np.testing.assert_allclose(getattr(restored, name), getattr(original, name), rtol=1e-6, atol=1e-7)
+      for restoredMesh, originalMesh in ((restored.sourceDisplay, original.sourceDisplay), (restored.targetDisplay, original.targetDisplay)):
+        np.testing.assert_allclose(restoredMesh[0], originalMesh[0], rtol=1e-6, atol=1e-6)
+        np.testing.assert_array_equal(restoredMesh[1], originalMesh[1])
+        np.testing.assert_allclose(restoredMesh[2], originalMesh[2], rtol=1e-6, atol=1e-7)
+      originalSummary = original.comparisonMetrics().summary(0.15)
+      restoredSummary = restored.comparisonMetrics().summary(0.15)
+      for name, value in originalSummary.items():
+        self.assertAlmostEqual(restoredSummary[name], value, places=4)
+      sourceDisplay, targetDisplay = restored.displayPolyData()
+      self.assertEqual(sourceDisplay.GetNumberOfPoints(), 300)
+      self.assertEqual(targetDisplay.GetNumberOfPolys(), 400)
+
+      original.write(path, distanceType="float16")
+      restored = bundle.ResultBundle.read(path)
+      self.assertEqual(restored.metadata["distanceType"], "float16")
+      np.testing.assert_allclose(restored.sourceDistances, original.sourceDistances, atol=1e-3 * np.abs(original.sourceDistances).max())
+      with self.assertRaises(ValueError):
+        original.write(path, distanceType="int8")
+    self.delayDisplay("Result bundle test passed")
+
+  def test_ResultsStoreQueries(self):
+    self.delayDisplay("Starting the results store test")
+    def result(prepared, created, deficientVolume, seconds, status="ok", stageSeconds=None):
+      return {"prepared": prepared, "ideal": "ideal.ply", "created": created, "status": status, "seconds": seconds,
+        "transform": np.eye(4).tolist(), "toleranceMetrics": {"tolerance": 0.15, "deficientVolume": deficientVolume,
+        "overPreparedAreaPercent": 10 * deficientVolume}, "stageSeconds": stageSeconds or {}}
+    results = [
+      result("/data/alice.ply", "2024-03-01T10:00:00", 1.5, 10.0, stageSeconds={"RANSAC": 4.0, "ICP": 1.0}),
+      result("/data/bob.ply", "2024-03-01T11:00:00", 3.0, 20.0, stageSeconds={"RANSAC": 6.0}),
+      result("/data/alice.ply", "2024-03-02T09:00:00", 0.5, 30.0, stageSeconds={"RANSAC": 2.0}),
+      result("/data/carol.ply", "2024-03-02T10:00:00", 9.0, 40.0, status="failed"),
+      ]
+    with tempfile.TemporaryDirectory() as directory:
+      with store.ResultsStore(os.path.join(directory, "results.sqlite")) as resultsStore:
+        runIds = resultsStore.addRuns(results, {"pointDensity": 0.8})
+        self.assertEqual(len(runIds), 4)
+        self.assertEqual(resultsStore.runCount(), 4)
+
+        history = resultsStore.studentHistory("alice")
+        self.assertEqual([run["created"] for run in history], ["2024-03-01T10:00:00", "2024-03-02T09:00:00"])
+        self.assertEqual(json.loads(history[0]["parameters"]), {"pointDensity": 0.8})
+
+        # Failed runs are not ranked
+        worst = resultsStore.worstOverPreparations("ideal.ply", limit=2)
+        self.assertEqual([run["student"] for run in worst], ["bob", "alice"])
+        self.assertEqual(worst[1]["deficientVolume"], 1.5)
+        self.assertEqual(len(resultsStore.worstOverPreparations("ideal.ply", orderBy="overPreparedAreaPercent")), 3)
+        self.assertEqual(resultsStore.worstOverPreparations("other.ply"), [])
+        with self.assertRaises(ValueError):
+          resultsStore.worstOverPreparations("ideal.ply", orderBy="seconds")
+
+        trend = resultsStore.timingTrend("day")
+        self.assertEqual([(row["period"], row["runs"]) for row in trend], [("2024-03-01", 2), ("2024-03-02", 2)])
+        self.assertAlmostEqual(trend[0]["meanSeconds"], 15.0)
+        self.assertAlmostEqual(trend[1]["maximumSeconds"], 40.0)
+        stageTrend = resultsStore.timingTrend("month", stage="RANSAC")
+        self.assertEqual(len(stageTrend), 1)
+        self.assertEqual(stageTrend[0]["runs"], 3)
+        self.assertAlmostEqual(stageTrend[0]["meanSeconds"], 4.0)
+        with self.assertRaises(ValueError):
+          resultsStore.timingTrend("year")
+    self.delayDisplay("Results store test passed")
+
+  def test_BatchResults(self):
+    self.delayDisplay("Starting the batch test")
+    with tempfile.TemporaryDirectory() as directory:
+      idealPath = os.path.join(directory, "ideal.ply")
+      self.writeSphere(idealPath)
+      preparedPaths = [os.path.join(directory, name) for name in ("alice.ply", "bob.ply")]
+      for path in preparedPaths:
+        self.writeSphere(path, radius=4.9)
+      storePath = os.path.join(directory, "results.sqlite")
+      csvPath = os.path.join(directory, "results.csv")
+      results = batch.runBatch(idealPath, preparedPaths, csvPath, workers=1, cacheDirectory="", storePath=storePath)
+      self.assertEqual([result["status"] for result in results], ["ok", "ok"])
+      self.assertEqual([result["prepared"] for result in results], preparedPaths)
+      with open(csvPath, newline="") as f:
+        rows = list(csv.DictReader(f))
+      self.assertEqual([row["prepared"] for row in rows], preparedPaths)
+      for row, result in zip(rows, results):
+        # Plain numbers that read back exactly
+        self.assertEqual([float(element) for element in row["transform"].split()], np.asarray(result["transform"]).ravel().tolist())
+        self.assertAlmostEqual(float(row["toleranceMetrics_deficientVolume"]), result["toleranceMetrics"]["deficientVolume"])
+      jsonPath = os.path.join(directory, "results.json")
+      batch.writeResults(results, jsonPath)
+      with open(jsonPath) as f:
+        self.assertEqual(json.load(f), json.loads(json.dumps(results)))
+
+      # The ideal model cannot be loaded in the worker initializer, which breaks the pool: every model is
+      # reported as failed, and the output and the store are still written
+      brokenCsvPath = os.path.join(directory, "broken.csv")
+      results = batch.runBatch(os.path.join(directory, "missing.ply"), preparedPaths, brokenCsvPath, workers=1, cacheDirectory="",
+        storePath=storePath)
+      self.assertEqual([result["status"] for result in results], ["failed", "failed"])
+      self.assertTrue(all(result["error"].startswith("BrokenProcessPool") for result in results))
+      with open(brokenCsvPath, newline="") as f:
+        self.assertEqual([row["status"] for row in csv.DictReader(f)], ["failed", "failed"])
+      with store.ResultsStore(storePath) as resultsStore:
+        self.assertEqual(resultsStore.runCount(), 4)
+    self.delayDisplay("Batch test passed")
+
+  def test_IngestQueue(self):
+    self.delayDisplay("Starting the ingest queue test")
+    class BreakingExecutor:
+      """Accepts one job, then fails like a pool whose worker died."""
+      def submit(self, *args):
+        if getattr(self, "submitted", False):
+          raise concurrent.futures.process.BrokenProcessPool("A worker process terminated abruptly")
+        self.submitted = True
+        return concurrent.futures.Future()
+    with tempfile.TemporaryDirectory() as directory:
+      watchDirectory = os.path.join(directory, "scans")
+      os.makedirs(watchDirectory)
+      for name, content in (("a.ply", b"scan a"), ("b.ply", b"scan b"), ("copy.ply", b"scan a")):
+        with open(os.path.join(watchDirectory, name), "wb") as f:
+          f.write(content)
+      queuePath = os.path.join(directory, "ingest.sqlite")
+      service = ingest.IngestService(watchDirectory, [("*", os.path.join(directory, "ideal.ply"))], queuePath,
+        os.path.join(directory, "results.sqlite"), workers=1, maxAttempts=3, retryDelaySeconds=10.0)
+      # Files are queued once unchanged between two scans; the copy has the content of a job already queued
+      self.assertEqual(service.scan(), 0)
+      self.assertEqual(service.scan(), 2)
+      for entry in os.scandir(watchDirectory):
+        self.assertTrue(service.queue.isKnownFile(entry.path, entry.stat().st_size, entry.stat().st_mtime_ns))
+      self.assertEqual(service.scan(), 0)
+
+      # Jobs taken but not submitted to a broken pool are queued again, without counting an attempt
+      with self.assertRaises(concurrent.futures.process.BrokenProcessPool):
+        service._submit(BreakingExecutor())
+      self.assertEqual(len(service.inFlight), 1)
+      self.assertEqual(service.queue.counts(), {"queued": 1, "running": 1, "done": 0, "failed": 0})
+      queuedJob = service.queue.take(1)[0]
+      self.assertEqual(queuedJob["attempts"], 1)
+
+      # Failed jobs are retried after a delay that doubles with every attempt, until maxAttempts
+      job = next(iter(service.inFlight.values()))
+      for attempt, delay in ((1, 10.0), (2, 20.0)):
+        self.assertEqual(job["attempts"], attempt)
+        failedTime = time.time()
+        service._jobFailed(job, "RuntimeError: failed")
+        notBefore = service.queue.connection.execute("SELECT notBefore FROM jobs WHERE id = ?", (job["id"],)).fetchone()[0]
+        self.assertAlmostEqual(notBefore - failedTime, delay, delta=1.0)
+        self.assertEqual(service.queue.take(1), [])
+        with service.queue.connection:
+          service.queue.connection.execute("UPDATE jobs SET notBefore = 0 WHERE id = ?", (job["id"],))
+        job = service.queue.take(1)[0]
+      service._jobFailed(job, "RuntimeError: failed")
+      self.assertEqual(service.queue.counts(), {"queued": 0, "running": 1, "done": 0, "failed": 1})
+      service.queue.close()
+      service.resultsStore.close()
+
+      # Jobs running when the service stopped are queued again at the next start
+      queue = ingest.JobQueue(queuePath)
+      self.assertEqual(queue.requeueInterrupted(), 1)
+      restartedJob = queue.take(10)
+      self.assertEqual([(job["id"], job["attempts"]) for job in restartedJob], [(queuedJob["id"], 2)])
+      queue.close()
+    self.delayDisplay("Ingest queue test passed")
+
+  def writeSphere(self, path, radius=5.0, resolution=24):
+    sphere = vtk.vtkSphereSource()
+    sphere.SetRadius(radius)
+    sphere.SetThetaResolution(resolution)
+    sphere.SetPhiResolution(resolution)
+    writer = vtk.vtkPLYWriter()
+    writer.SetInputConnection(sphere.GetOutputPort())
+    writer.SetFileName(path)
+    writer.SetFileTypeToBinary()
+    writer.Write()
+
+  def test_JobServer(self):
+    self.delayDisplay("Starting the job server test")
+    def request(method, path, body=None, token="secret"):
+      """HTTP status and JSON response of a request to the job server."""
+      headers = {"Authorization": f"Bearer {token}"} if token else {}
+      if isinstance(body, (dict, list)):
+        body = json.dumps(body).encode()
+      httpRequest = urllib.request.Request(jobServer.url + path, data=body, method=method, headers=headers)
+      try:
+        with urllib.request.urlopen(httpRequest, timeout=60) as response:
+          return response.status, json.loads(response.read())
+      except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+    def waitForJob(jobId):
+      startTime = time.time()
+      while time.time() - startTime < 600:
+        status, job = request("GET", f"/jobs/{jobId}")
+        self.assertEqual(status, 200)
+        self.assertIn(job["state"], ("queued", "running", "done", "failed"))
+        if job["state"] in ("done", "failed"):
+          return job
+        time.sleep(0.2)
+      self.fail(f"Job {jobId} did not finish")
+
+    with tempfile.TemporaryDirectory() as directory:
+      meshPath = os.path.join(directory, "sphere.ply")
+      self.writeSphere(meshPath)
+      with open(meshPath, "rb") as f:
+        meshBytes = f.read()
+      jobServer = jobserver.JobServer(os.path.join(directory, "jobs"), port=0, workers=1, token="secret",
+        cacheDirectory=os.path.join(directory, "features"))
+      jobServer.start()
+      try:
+        self.assertEqual(request("GET", "/jobs", token=None)[0], 401)
+        self.assertEqual(request("GET", "/jobs", token="wrong")[0], 401)
+
+        # Uploads are streamed to disk and named by their content
+        status, upload = request("PUT", "/uploads?name=prepared.ply", meshBytes)
+        self.assertEqual(status, 201)
+        self.assertEqual(upload["bytes"], len(meshBytes))
+        with open(jobServer.uploadPath(upload["upload"]), "rb") as f:
+          self.assertEqual(f.read(), meshBytes)
+        self.assertEqual(request("PUT", "/uploads?name=ideal.ply", meshBytes)[1]["upload"], upload["upload"])
+        self.assertEqual(request("PUT", "/uploads?name=notes.txt", b"text")[0], 400)
+
+        meshId = upload["upload"]
+        self.assertEqual(request("POST", "/jobs", {"prepared": "0" * 64 + ".ply", "ideal": meshId})[0], 400)
+        self.assertEqual(request("POST", "/jobs", {"prepared": meshId, "ideal": meshId, "parameters": {"noSuchParameter": 1}})[0], 400)
+        self.assertEqual(request("POST", "/jobs", [meshId, meshId])[0], 400)
+        self.assertEqual(request("POST", "/jobs", b"{not json")[0], 400)
+        self.assertEqual(request("GET", "/jobs/unknown")[0], 404)
+
+        status, job = request("POST", "/jobs", {"prepared": meshId, "ideal": meshId})
+        self.assertEqual(status, 202)
+        self.assertIn(job["id"], [job["id"] for job in request("GET", "/jobs")[1]])
+        job = waitForJob(job["id"])
+        # The comparison needs open3d in the worker processes; without it the job fails
+        if job["state"] == "done":
+          status, result = request("GET", f"/jobs/{job['id']}/result")
+          self.assertEqual(status, 200)
+          self.assertEqual(len(result["transform"]), 4)
+        else:
+          self.assertEqual(request("GET", f"/jobs/{job['id']}/result")[0], 409)
+
+        # A worker killed (e.g. out of memory) must not break the following jobs
+        for process in list(jobServer.executor._processes.values()):
+          process.kill()
+        time.sleep(1.0)
+        status, job = request("POST", "/jobs", {"prepared": meshId, "ideal": meshId})
+        self.assertEqual(status, 202)
+        waitForJob(job["id"])
+        status, job = request("POST", "/jobs", {"prepared": meshId, "ideal": meshId})
+        self.assertEqual(status, 202)
+        waitForJob(job["id"])
+      finally:
+        jobServer.stop()
+    self.delayDisplay("Job server test passed")
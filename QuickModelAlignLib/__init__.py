@@ -0,0 +1,6 @@
+"""Slicer-independent building blocks of the QuickModelAlign module.
+
+The modules in this package only depend on numpy, vtk and open3d so they can be
+used from the Slicer GUI, from ``PythonSlicer``/``Slicer --no-main-window`` or
+from a plain Python interpreter.
+"""
@@ -0,0 +1,128 @@
+"""Rocking animation between the prepared and ideal models.
+
+The opacity of the prepared model follows a sine between 0 and 1 (the ideal model the
+opposite), precomputed over one cycle. The phase is taken from the clock rather than
+from a tick count, so the cycle keeps its duration whatever the tick rate is.
+
+The timer only runs while the animation is shown and not paused: a paused animation,
+a display mode without animation or a hidden module cause no wakeups at all. The tick
+interval adapts to the measured render time, so that slow (e.g. software) renderers
+are not saturated, and the corner label is only updated when the opacity crosses 0.5.
+"""
+import time
+
+import numpy as np
+
+
+# Duration of one prepared -> ideal -> prepared cycle, as the former 80 ms timer stepping 0.1 rad
+CYCLE_SECONDS = 2 * np.pi * 10 * 0.08
+
+# Number of precomputed opacities over one cycle
+CURVE_SAMPLES = 256
+
+# The tick interval is this multiple of the render time, within the interval limits below
+RENDER_TIME_FACTOR = 4.0
+MIN_INTERVAL_MS = 40
+MAX_INTERVAL_MS = 250
+
+# Weight of the latest render time in the smoothed render time
+RENDER_TIME_SMOOTHING = 0.2
+
+
+def opacityCurve(samples=CURVE_SAMPLES):
+  """Opacities of the prepared model over one cycle, starting at 0.5 and rising."""
+  return 0.5 + np.sin(2 * np.pi * np.arange(samples) / samples) / 2
+
+
+class RockingAnimation:
+  """Drives the opacities of two models from a timer.
+
+  :param setOpacities: callable ``setOpacities(preparedOpacity, idealOpacity)``
+  :param setLabel: callable ``setLabel(text)``, called with "Prepared" or "Ideal" when
+    the most visible model changes
+  :param render: callable that renders the view; its duration sets the tick interval
+  :param timer: object with the qt.QTimer interface, a new qt.QTimer by default
+  """
+
+  def __init__(self, setOpacities, setLabel, render, timer=None, cycleSeconds=CYCLE_SECONDS, clock=time.perf_counter):
+    if timer is None:
+      import qt
+      timer = qt.QTimer()
+    self.setOpacities = setOpacities
+    self.setLabel = setLabel
+    self.render = render
+    self.timer = timer
+    self.timer.setSingleShot(False)
+    self.timer.connect("timeout()", self.tick)
+    self.cycleSeconds = cycleSeconds
+    self.clock = clock
+    self.preparedOpacities = opacityCurve()
+    self.idealOpacities = 1.0 - self.preparedOpacities
+    self.labels = np.where(self.preparedOpacities > 0.5, "Prepared", "Ideal")
+    self.active = False
+    self.paused = False
+    self.shown = True
+    self.label = None
+    self.renderSeconds = None
+    # Phase (in seconds) of the animation while the timer is stopped
+    self._phaseSeconds = 0.0
+    self._startTime = None
+
+  @property
+  def interval(self):
+    """Current tick interval in milliseconds."""
+    if self.renderSeconds is None:
+      return MIN_INTERVAL_MS
+    return int(min(max(RENDER_TIME_FACTOR * self.renderSeconds * 1000, MIN_INTERVAL_MS), MAX_INTERVAL_MS))
+
+  def isRunning(self):
+    return self._startTime is not None
+
+  def start(self):
+    """Animate the models, unless the animation is paused or hidden."""
+    self.active = True
+    self.label = None
+    self.tick()
+    self._update()
+
+  def stop(self):
+    """Stop animating, e.g. for a display mode without animation. The phase is kept."""
+    self.active = False
+    self._update()
+
+  def togglePaused(self):
+    self.paused = not self.paused
+    self._update()
+
+  def setShown(self, shown):
+    """Stop the timer while the view is hidden and resume it when it is shown again."""
+    self.shown = shown
+    self._update()
+
+  def _update(self):
+    shouldRun = self.active and not self.paused and self.shown
+    if shouldRun and not self.isRunning():
+      self._startTime = self.clock() - self._phaseSeconds
+      self.timer.start(self.interval)
+    elif not shouldRun and self.isRunning():
+      self._phaseSeconds = self.clock() - self._startTime
+      self._startTime = None
+      self.timer.stop()
+
+  def tick(self):
+    phaseSeconds = self.clock() - self._startTime if self.isRunning() else self._phaseSeconds
+    index = int(phaseSeconds / self.cycleSeconds * len(self.preparedOpacities)) % len(self.preparedOpacities)
+    renderStart = self.clock()
+    self.setOpacities(float(self.preparedOpacities[index]), float(self.idealOpacities[index]))
+    label = str(self.labels[index])
+    if label != self.label:
+      self.label = label
+      self.setLabel(label)
+    self.render()
+    renderSeconds = self.clock() - renderStart
+    if self.renderSeconds is None:
+      self.renderSeconds = renderSeconds
+    else:
+      self.renderSeconds += RENDER_TIME_SMOOTHING * (renderSeconds - self.renderSeconds)
+    if self.isRunning() and self.interval != self.timer.interval:
+      self.timer.setInterval(self.interval)
@@ -0,0 +1,335 @@
+"""Headless batch alignment of many prepared models against one ideal model.
+
+Example, from a shell::
+
+  PythonSlicer -m QuickModelAlignLib.batch ideal.ply submissions/ -o results.csv -j 8
+
+or from the Slicer Python console (also with ``Slicer --no-main-window``)::
+
+  import QuickModelAlignLib.batch
+  QuickModelAlignLib.batch.runBatch("ideal.ply", "submissions/", "results.json")
+
+Every prepared model is aligned to the ideal model with the same pipeline as the
+module GUI (downsampling + FPFH, RANSAC, ICP, signed distances in both
+directions). Pairs are distributed over a pool of single-threaded worker
+processes; each worker preprocesses the ideal model only once.
+"""
+import argparse
+import concurrent.futures
+import csv
+import glob
+import json
+import logging
+import os
+import sys
+import time
+import traceback
+from datetime import datetime
+
+import numpy as np
+
+from QuickModelAlignLib import cache
+from QuickModelAlignLib import display
+from QuickModelAlignLib import distance
+from QuickModelAlignLib import instrumentation
+from QuickModelAlignLib import metrics
+from QuickModelAlignLib import parallel
+from QuickModelAlignLib import registration
+from QuickModelAlignLib import sdf
+from QuickModelAlignLib import store
+from QuickModelAlignLib import tuning
+
+
+# Results are written to the results store in transactions of this many models
+STORE_BATCH_SIZE = 32
+
+
+# Per worker-process state, filled by _initializeWorker
+_workerState = {}
+
+
+class IdealModel:
+  """Ideal (target) model with its downsampled point cloud and FPFH features."""
+
+  def __init__(self, path, parameters, cacheDirectory=None):
+    self.path = path
+    self.parameters = parameters
+    self.hash = cache.fileHash(path)
+    self.polydata = registration.readPolyData(path)
+    self.points = registration.pointsFromPolyData(self.polydata)
+    featureCache = cache.FeatureCache(cacheDirectory) if cacheDirectory else None
+    self.pointsDown, self.features, self.voxelSize = registration.preprocessTarget(self.points, parameters, path, featureCache)
+    self._distanceEngine = None
+    # Fast path state, shared by the models aligned in this process
+    self.warmStart = registration.WarmStart()
+    self.distanceGrid = None
+    if parameters.get("useDistanceGrid"):
+      self.distanceGrid = sdf.loadOrBuildGrid(self.polydata, path, parameters["errorToleranceValue"], featureCache, engine=self.distanceEngine())
+    self.cacheStatistics = featureCache.statistics() if featureCache else None
+
+  def distanceEngine(self):
+    """Spatial index of the ideal surface, built on first use and reused for every prepared model."""
+    if self._distanceEngine is None and distance.kdTreeAvailable():
+      self._distanceEngine = distance.SurfaceDistanceEngine(self.polydata)
+    return self._distanceEngine
+
+
+def alignToIdeal(preparedPath, ideal, skipScaling=True, displayDirectory=None, triangleBudget=display.TRIANGLE_BUDGET):
+  """Align one prepared model to a preprocessed IdealModel and measure their differences.
+
+  :param displayDirectory: if set, the aligned prepared model and the ideal model are written
+    there as "prepared.ply" and "ideal.ply", decimated to ``triangleBudget`` and coloured by distance
+  :return: dictionary with the transform, registration quality and distance statistics
+  """
+  parameters = ideal.parameters
+  created = datetime.now().isoformat(timespec="seconds")
+  startTime = time.perf_counter()
+  trace = instrumentation.Trace(os.path.basename(preparedPath))
+  with instrumentation.stage(trace, "read", "prepared") as record:
+    sourcePolydata = registration.readPolyData(preparedPath)
+    record["points"] = sourcePolydata.GetNumberOfPoints()
+    record["allocatedBytes"] = sourcePolydata.GetActualMemorySize() * 1024
+  sourcePoints = registration.pointsFromPolyData(sourcePolydata)
+  scaling = registration.computeScaling(sourcePoints, ideal.points, skipScaling)
+  sourceDown, sourceFeatures = registration.preprocess_point_cloud(
+    registration.makePointCloud(sourcePoints, scaling, trace, "prepared"), ideal.voxelSize, parameters["normalSearchRadius"], parameters["FPFHSearchRadius"],
+    label="prepared", trace=trace)
+  report = {}
+  icp = registration.registerPointClouds(sourceDown, ideal.pointsDown, sourceFeatures, ideal.features, ideal.voxelSize, skipScaling, parameters,
+    report=report, warmStart=ideal.warmStart, trace=trace)
+  transformMatrix = np.asarray(icp.transformation)
+
+  # Scaling and registration in a single in place pass over the full resolution points
+  alignedSource = registration.transformPolyDataInPlace(sourcePolydata,
+    registration.composeTransforms(registration.scalingMatrix(scaling), transformMatrix))
+  tolerance = parameters["errorToleranceValue"]
+  # The distance engine of the ideal model is shared by all prepared models
+  with instrumentation.stage(trace, "distances", "prepared", points=alignedSource.GetNumberOfPoints(),
+      distanceGrid=ideal.distanceGrid is not None, allocatedBytes=16 * alignedSource.GetNumberOfPoints()):
+    sourceWithDistance = distance.computeSignedDistance(alignedSource, ideal.polydata, ideal.distanceEngine(), ideal.distanceGrid)
+  with instrumentation.stage(trace, "distances", "ideal", points=ideal.polydata.GetNumberOfPoints(),
+      allocatedBytes=distance.signedDistanceBytes(ideal.polydata.GetNumberOfPoints(), alignedSource)):
+    targetWithDistance = distance.computeSignedDistance(ideal.polydata, alignedSource)
+  sourceDistances = distance.distanceArray(sourceWithDistance)
+  targetDistances = distance.distanceArray(targetWithDistance)
+  with instrumentation.stage(trace, "metrics", allocatedBytes=metrics.comparisonBytes(sourceWithDistance, targetWithDistance)):
+    toleranceMetrics = metrics.ComparisonMetrics.fromPolyData(sourceWithDistance, targetWithDistance).summary(tolerance)
+  displayMeshes = None
+  if displayDirectory:
+    with instrumentation.stage(trace, "displayMeshes"):
+      displayMeshes = {
+        "prepared": display.writeColouredMesh(sourceWithDistance, os.path.join(displayDirectory, "prepared.ply"), tolerance,
+          display.PREPARED_COLOUR_MAP, triangleBudget),
+        "ideal": display.writeColouredMesh(targetWithDistance, os.path.join(displayDirectory, "ideal.ply"), tolerance,
+          display.IDEAL_COLOUR_MAP, triangleBudget),
+        }
+
+  result = {
+    "prepared": preparedPath,
+    "preparedSHA256": cache.fileHash(preparedPath),
+    "ideal": ideal.path,
+    "idealSHA256": ideal.hash,
+    "created": created,
+    "status": "ok",
+    "scaling": float(scaling),
+    "voxelSize": float(ideal.voxelSize),
+    "fitness": float(icp.fitness),
+    "inlierRMSE": float(icp.inlier_rmse),
+    "globalRegistration": report["globalRegistration"],
+    "fastPath": report.get("fastPath"),
+    "ICP": report["ICP"],
+    "transform": transformMatrix.tolist(),
+    "sourceToTarget": distance.summarizeDistances(sourceDistances, tolerance),
+    "targetToSource": distance.summarizeDistances(targetDistances, tolerance),
+    "toleranceMetrics": toleranceMetrics,
+    "seconds": time.perf_counter() - startTime,
+    "stageSeconds": trace.stageSeconds(),
+    "peakRSSBytes": trace.peakRSSBytes(),
+    "allocatedBytes": trace.allocatedBytes(),
+    "trace": trace.toDict(),
+    }
+  if displayMeshes:
+    result["displayMeshes"] = displayMeshes
+  return result
+
+
+def _initializeWorker(idealPath, parameters, cacheDirectory):
+  parallel.limitThreadsPerProcess()
+  _workerState["ideal"] = IdealModel(idealPath, parameters, cacheDirectory)
+
+
+def _alignInWorker(preparedPath, skipScaling):
+  try:
+    return alignToIdeal(preparedPath, _workerState["ideal"], skipScaling)
+  except Exception as e:
+    return {
+      "prepared": preparedPath,
+      "ideal": _workerState["ideal"].path,
+      "status": "failed",
+      "error": "%s: %s" % (type(e).__name__, e),
+      "traceback": traceback.format_exc(),
+      }
+
+
+def findPreparedModels(preparedDirectory, pattern="*.ply", excludePaths=()):
+  excluded = {os.path.abspath(path) for path in excludePaths}
+  paths = sorted(glob.glob(os.path.join(preparedDirectory, pattern)))
+  return [path for path in paths if os.path.abspath(path) not in excluded]
+
+
+def runBatch(idealPath, prepared, outputPath=None, workers=None, parameters=None, skipScaling=True, pattern="*.ply",
+    cacheDirectory=None, storePath=None):
+  """Align all prepared models to the ideal model.
+
+  :param idealPath: ideal (target) mesh file
+  :param prepared: directory of prepared meshes, or a list of mesh file paths
+  :param outputPath: optional .csv or .json file the results are written to
+  :param workers: number of worker processes (default: number of CPU cores)
+  :param parameters: registration parameters, missing entries use the module defaults
+  :param cacheDirectory: feature cache location; the ideal model is preprocessed once here and
+    the workers read it from the cache. Pass an empty string to disable caching.
+  :param storePath: optional results store (SQLite file, see store.ResultsStore) the results are added to
+  :return: list of result dictionaries, in the order of the prepared models
+  """
+  parameters = registration.completeParameters(parameters)
+  if isinstance(prepared, str):
+    preparedPaths = findPreparedModels(prepared, pattern, excludePaths=[idealPath])
+  else:
+    preparedPaths = list(prepared)
+  if not preparedPaths:
+    raise ValueError("No prepared models to align")
+  workers = min(workers or parallel.defaultWorkerCount(), len(preparedPaths))
+  if cacheDirectory is None:
+    cacheDirectory = cache.defaultCacheDirectory()
+  if cacheDirectory:
+    # Warm the cache so that the workers do not all preprocess the ideal model concurrently
+    ideal = IdealModel(idealPath, parameters, cacheDirectory)
+    logging.info(f"Ideal model feature cache: {ideal.cacheStatistics}")
+    del ideal
+
+  logging.info(f"Aligning {len(preparedPaths)} models to {idealPath} using {workers} worker processes")
+  startTime = time.perf_counter()
+  results = [None] * len(preparedPaths)
+  resultsStore = store.ResultsStore(storePath) if storePath else None
+  pendingResults = []
+  with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=parallel.processContext(),
+      initializer=_initializeWorker, initargs=(idealPath, parameters, cacheDirectory)) as executor:
+    futures = {executor.submit(_alignInWorker, path, skipScaling): index for index, path in enumerate(preparedPaths)}
+    for future in concurrent.futures.as_completed(futures):
+      try:
+        result = future.result()
+      except Exception as e:
+        # The worker pool broke (a worker died, or the ideal model could not be loaded in the initializer);
+        # the models still in it are reported as failed and the other results are kept
+        result = {
+          "prepared": preparedPaths[futures[future]],
+          "ideal": idealPath,
+          "status": "failed",
+          "error": "%s: %s" % (type(e).__name__, e),
+          }
+      results[futures[future]] = result
+      logging.info(f"{result['status']}: {result['prepared']}")
+      if resultsStore:
+        pendingResults.append(result)
+        if len(pendingResults) >= STORE_BATCH_SIZE:
+          resultsStore.addRuns(pendingResults, parameters)
+          pendingResults = []
+  if resultsStore:
+    resultsStore.addRuns(pendingResults, parameters)
+    resultsStore.close()
+  logging.info(f"Batch completed in {time.perf_counter()-startTime:.2f} seconds")
+
+  if outputPath:
+    writeResults(results, outputPath)
+  return results
+
+
+def _flattenResult(result):
+  row = {}
+  for key, value in result.items():
+    if key in ("traceback", "trace"):
+      continue
+    if isinstance(value, dict):
+      for subKey, subValue in value.items():
+        # Lists (such as the fast path attempts) are only written to JSON output
+        if not isinstance(subValue, list):
+          row[f"{key}_{subKey}"] = subValue
+    elif key == "transform":
+      row[key] = " ".join(repr(float(element)) for element in np.asarray(value).ravel())
+    elif isinstance(value, list):
+      # Per-level details are only written to JSON output
+      continue
+    else:
+      row[key] = value
+  return row
+
+
+def writeResults(results, outputPath):
+  """Write batch results as JSON (.json) or as one CSV row per prepared model (any other extension)."""
+  if os.path.splitext(outputPath)[1].lower() == ".json":
+    with open(outputPath, "w") as f:
+      json.dump(results, f, indent=2)
+    return
+  rows = [_flattenResult(result) for result in results]
+  fieldNames = []
+  for row in rows:
+    fieldNames += [name for name in row if name not in fieldNames]
+  with open(outputPath, "w", newline="") as f:
+    writer = csv.DictWriter(f, fieldnames=fieldNames)
+    writer.writeheader()
+    writer.writerows(rows)
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(prog="QuickModelAlignLib.batch", description="Align a directory of prepared models to one ideal model.")
+  parser.add_argument("ideal", help="ideal (target) model file")
+  parser.add_argument("prepared", help="directory containing the prepared (source) models")
+  parser.add_argument("-o", "--output", default="QuickModelAlignResults.csv", help="output .csv or .json file")
+  parser.add_argument("-j", "--workers", type=int, default=None, help="number of worker processes (default: number of CPU cores)")
+  parser.add_argument("-p", "--parameters", default=None, help="JSON file with registration parameters")
+  parser.add_argument("--preset", default=None, help="named parameter preset (see QuickModelAlignLib.tuning), applied before --parameters")
+  parser.add_argument("--pattern", default="*.ply", help="file name pattern of the prepared models")
+  parser.add_argument("--scaling", action="store_true", help="scale prepared models to the size of the ideal model")
+  parser.add_argument("--cache-dir", default=None, help="feature cache directory (default: user cache directory)")
+  parser.add_argument("--no-cache", action="store_true", help="do not cache the preprocessed ideal model")
+  parser.add_argument("--distance-grid", action="store_true",
+    help="interpolate distances to the ideal model from a precomputed signed distance grid (spacing derived from the error tolerance; not used for open surfaces)")
+  parser.add_argument("--engine", choices=registration.GLOBAL_REGISTRATION_ENGINES, default=None,
+    help="global registration engine (default: RANSAC)")
+  parser.add_argument("--time-budget", type=float, default=None, help="wall-clock limit of the RANSAC stage per model, in seconds")
+  parser.add_argument("--starts", type=int, default=None,
+    help="global registrations run in parallel per model, the best is kept (multi-start; default: 1)")
+  parser.add_argument("--fast-path", action="store_true",
+    help="try ICP from the previous, identity, centroid and principal axes poses before the global registration")
+  parser.add_argument("--seed", type=int, default=None, help="random seed of the global registration, for repeatable results (ignored by open3d 0.14)")
+  parser.add_argument("--store", default=None, help="SQLite results store the results are added to (created if needed)")
+  args = parser.parse_args(argv)
+
+  logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+  parameters = tuning.applyPreset({}, args.preset)
+  if args.parameters:
+    with open(args.parameters) as f:
+      parameters.update(json.load(f))
+  if args.distance_grid:
+    parameters["useDistanceGrid"] = True
+  if args.engine is not None:
+    parameters["globalRegistrationEngine"] = args.engine
+  if args.time_budget is not None:
+    parameters["globalRegistrationTimeBudget"] = args.time_budget
+  if args.starts is not None:
+    parameters["multiStartRuns"] = args.starts
+  if args.fast_path:
+    parameters["fastPath"] = True
+  if args.seed is not None:
+    parameters["randomSeed"] = args.seed
+  cacheDirectory = "" if args.no_cache else args.cache_dir
+  results = runBatch(args.ideal, args.prepared, args.output, args.workers, parameters, skipScaling=not args.scaling, pattern=args.pattern,
+    cacheDirectory=cacheDirectory, storePath=args.store)
+  failed = [result for result in results if result["status"] != "ok"]
+  for result in failed:
+    logging.error(f"{result['prepared']}: {result['error']}")
+  return 1 if failed else 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,456 @@
+"""Benchmark of the registration and comparison pipeline on synthetic teeth with known ground truth.
+
+Example, from a shell (no GPU or display needed)::
+
+  PythonSlicer -m QuickModelAlignLib.benchmark -o benchmark.json
+  PythonSlicer -m QuickModelAlignLib.benchmark --sizes 10000 100000 -o new.json --compare benchmark.json
+
+For every mesh size an ideal tooth-like mesh is generated (a crown with four cusps of
+different heights on a tapered root, so that its pose is unambiguous). The prepared
+model is the same mesh with a simulated cavity preparation and scanner noise, moved
+by a known rigid transform and scaled. Every stage of the pipeline is timed, and the
+result is compared with the ground truth:
+
+- rotation and translation error of the estimated transform, and the RMS displacement
+  of the prepared model vertices between the estimated and the true transform,
+- scaling error (when scaling is not skipped),
+- error of the distance maps in both directions, relative to the distances computed
+  from the prepared model in its true pose.
+
+The signed distance computation is also timed on its own against
+vtkDistancePolyDataFilter as the baseline, on meshes of ``--distance-sizes`` vertices
+(DISTANCE_MESHES): the tooth, a latitude-longitude (UV) sphere, whose triangles shrink
+towards the poles, and the UV sphere with one large triangle added beside it. The engine
+time includes building its spatial index.
+
+Results are written as JSON. ``--compare`` prints the change of the stage times and
+accuracy relative to a previous result file, e.g. one recorded on another commit.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from QuickModelAlignLib import distance
+from QuickModelAlignLib import instrumentation
+from QuickModelAlignLib import metrics
+from QuickModelAlignLib import registration
+
+
+DEFAULT_SIZES = (10000, 100000, 500000, 2000000)
+
+# Vertex counts of the distance benchmark, kept smaller as vtkDistancePolyDataFilter is timed as well
+DEFAULT_DISTANCE_SIZES = (10000, 100000)
+
+# Reference meshes of the distance benchmark (see distanceMeshes)
+DISTANCE_MESHES = ("tooth", "UV sphere", "mixed sizes")
+
+# Rigid transforms (rotation axis, angle in degrees, translation in mm), scale and
+# scaling setting of the benchmark cases
+CASES = (
+  {"name": "small pose change", "axis": (0.2, 0.3, 1.0), "angle": 8.0, "translation": (0.8, -0.5, 0.3), "scale": 1.0, "skipScaling": True},
+  {"name": "large pose change", "axis": (1.0, -0.4, 0.6), "angle": 120.0, "translation": (12.0, -7.0, 4.0), "scale": 1.0, "skipScaling": True},
+  {"name": "scale change", "axis": (-0.3, 1.0, 0.2), "angle": 35.0, "translation": (4.0, 2.0, -3.0), "scale": 1.04, "skipScaling": False},
+  )
+
+# Cusps of the synthetic crown: direction on the unit sphere, height (mm) and width (radians)
+CUSPS = (
+  ((0.45, 0.40, 0.80), 1.1, 0.35),
+  ((-0.45, 0.40, 0.80), 0.8, 0.35),
+  ((0.45, -0.40, 0.80), 0.9, 0.30),
+  ((-0.45, -0.40, 0.80), 0.6, 0.30),
+  )
+
+
+def sphereMesh(vertexCount):
+  """Triangulated unit sphere with approximately ``vertexCount`` vertices of even spacing.
+
+  The faces of a cube are divided into grids and projected onto the sphere (equal-angle
+  mapping), so that triangle sizes vary much less than on a latitude-longitude sphere.
+
+  :return: vertices (N x 3), triangles (M x 3)
+  """
+  divisions = max(int(round(np.sqrt((vertexCount - 2) / 6.0))), 2)
+  grid = np.tan(np.linspace(-np.pi / 4, np.pi / 4, divisions + 1))
+  u, v = np.meshgrid(grid, grid, indexing="ij")
+  u, v = u.ravel(), v.ravel()
+  index = np.arange((divisions + 1) ** 2).reshape(divisions + 1, divisions + 1)
+  a, b = index[:-1, :-1].ravel(), index[1:, :-1].ravel()
+  c, d = index[:-1, 1:].ravel(), index[1:, 1:].ravel()
+  faceTriangles = np.concatenate([np.stack([a, b, d], axis=1), np.stack([a, d, c], axis=1)])
+  vertices = []
+  triangles = []
+  for axis in range(3):
+    for sign in (-1.0, 1.0):
+      faceVertices = np.empty((len(u), 3))
+      faceVertices[:, axis] = sign
+      faceVertices[:, (axis + 1) % 3] = u
+      faceVertices[:, (axis + 2) % 3] = v
+      # (u, v, axis) is right-handed, so the grid triangles face outwards on the positive side
+      orientedTriangles = faceTriangles if sign > 0 else faceTriangles[:, ::-1]
+      triangles.append(orientedTriangles + len(vertices) * len(u))
+      vertices.append(faceVertices / np.linalg.norm(faceVertices, axis=1, keepdims=True))
+  # Merge the vertices shared by the cube edges
+  vertices, inverse = np.unique(np.round(np.concatenate(vertices), 12), axis=0, return_inverse=True)
+  return vertices, inverse.ravel()[np.concatenate(triangles)]
+
+
+def toothVertices(sphereVertices):
+  """Deform unit sphere vertices into a tooth: crown with cusps on a tapered root (mm)."""
+  vertices = sphereVertices * (5.0, 4.5, 4.0)
+  root = sphereVertices[:, 2] < 0
+  vertices[root, 2] = sphereVertices[root, 2] * 8.0
+  vertices[root, :2] *= (1.0 + 0.55 * sphereVertices[root, 2])[:, None]
+  for direction, height, width in CUSPS:
+    direction = np.asarray(direction) / np.linalg.norm(direction)
+    angle = np.arccos(np.clip(sphereVertices @ direction, -1, 1))
+    vertices += (height * np.exp(-0.5 * (angle / width) ** 2))[:, None] * sphereVertices
+  return vertices
+
+
+def vertexNormals(vertices, triangles):
+  """Area weighted, outward vertex normals of a closed mesh."""
+  corners = vertices[triangles]
+  faceNormals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+  normals = np.zeros_like(vertices)
+  for corner in range(3):
+    np.add.at(normals, triangles[:, corner], faceNormals)
+  return normals / np.linalg.norm(normals, axis=1, keepdims=True)
+
+
+def prepareCavity(vertices, triangles, center, radius=2.5, depth=1.0):
+  """Simulated cavity preparation: push the surface around ``center`` inwards by up to ``depth`` mm."""
+  normals = vertexNormals(vertices, triangles)
+  distances = np.linalg.norm(vertices - center, axis=1)
+  profile = np.where(distances < radius, (1.0 - (distances / radius) ** 2) ** 2, 0.0)
+  return vertices - (depth * profile)[:, None] * normals
+
+
+def rotationMatrix(axis, angle):
+  """Rotation by ``angle`` degrees about ``axis`` (Rodrigues' formula)."""
+  axis = np.asarray(axis, dtype=np.float64)
+  axis /= np.linalg.norm(axis)
+  angle = np.radians(angle)
+  cross = np.array([[0, -axis[2], axis[1]], [axis[2], 0, -axis[0]], [-axis[1], axis[0], 0]])
+  return np.eye(3) + np.sin(angle) * cross + (1 - np.cos(angle)) * cross @ cross
+
+
+def syntheticPair(vertexCount, case, noise=0.01, seed=0):
+  """Ideal and prepared tooth meshes of one benchmark case.
+
+  The prepared mesh in file coordinates is ``scale * (R @ p + t)`` of the prepared
+  mesh ``p`` in the ideal model frame.
+
+  :return: dictionary with the ideal, prepared (in its true pose) and moved prepared
+    polydata, and the true rotation, translation and scale
+  """
+  rng = np.random.default_rng(seed)
+  sphereVertices, triangles = sphereMesh(vertexCount)
+  idealVertices = toothVertices(sphereVertices)
+  # Cavity between the cusps, slightly off-center
+  occlusal = idealVertices[np.argmin(np.linalg.norm(sphereVertices - np.array([0.15, 0.05, 1.0]) / np.linalg.norm([0.15, 0.05, 1.0]), axis=1))]
+  preparedVertices = prepareCavity(idealVertices, triangles, occlusal)
+  preparedVertices = preparedVertices + rng.normal(scale=noise, size=preparedVertices.shape)
+  rotation = rotationMatrix(case["axis"], case["angle"])
+  translation = np.asarray(case["translation"], dtype=np.float64)
+  movedVertices = case["scale"] * (preparedVertices @ rotation.T + translation)
+  return {
+    "ideal": distance.polyDataFromTriangles(idealVertices, triangles),
+    "prepared": distance.polyDataFromTriangles(preparedVertices, triangles),
+    "moved": distance.polyDataFromTriangles(movedVertices, triangles),
+    "rotation": rotation,
+    "translation": translation,
+    "scale": case["scale"],
+    }
+
+
+def uvSphereMesh(vertexCount, radius=5.0):
+  """Latitude-longitude sphere of approximately ``vertexCount`` vertices (vtkSphereSource),
+  with twice as many meridians as parallels.
+
+  :return: vertices (N x 3), triangles (M x 3)
+  """
+  import vtk
+  parallels = max(int(round(np.sqrt(vertexCount / 2.0))), 4)
+  source = vtk.vtkSphereSource()
+  source.SetRadius(radius)
+  source.SetThetaResolution(2 * parallels)
+  source.SetPhiResolution(parallels)
+  source.Update()
+  return distance.trianglesFromPolyData(source.GetOutput())
+
+
+def distanceMeshes(mesh, vertexCount, noise=0.05, seed=0):
+  """Reference polydata and query polydata of one distance benchmark mesh.
+
+  The queries are the reference vertices displaced by Gaussian noise of ``noise`` mm,
+  except for the tooth, where they are the prepared model in its true pose.
+  """
+  if mesh == "tooth":
+    pair = syntheticPair(vertexCount, CASES[0], seed=seed)
+    return pair["ideal"], pair["prepared"]
+  if mesh not in DISTANCE_MESHES:
+    raise ValueError(f"Unknown distance benchmark mesh: {mesh}")
+  vertices, triangles = uvSphereMesh(vertexCount)
+  if mesh == "mixed sizes":
+    # One triangle far larger than the others, below the sphere
+    vertices = np.vstack([vertices, [[-200.0, -200.0, -8.0], [200.0, -200.0, -8.0], [0.0, 200.0, -8.0]]])
+    triangles = np.vstack([triangles, [[len(vertices) - 3, len(vertices) - 2, len(vertices) - 1]]])
+  rng = np.random.default_rng(seed)
+  queries = vertices + rng.normal(scale=noise, size=vertices.shape)
+  return distance.polyDataFromTriangles(vertices, triangles), distance.polyDataFromTriangles(queries, triangles)
+
+
+def runDistanceCase(mesh, vertexCount, seed=0):
+  """Time the signed distances of one mesh with distance.computeSignedDistance and with
+  vtkDistancePolyDataFilter, and compare their values."""
+  reference, queries = distanceMeshes(mesh, vertexCount, seed=seed)
+  startTime = time.perf_counter()
+  engineDistances = distance.distanceArray(distance.computeSignedDistance(queries, reference))
+  engineSeconds = time.perf_counter() - startTime
+  startTime = time.perf_counter()
+  vtkDistances = distance.distanceArray(distance.computeSignedDistanceVTK(queries, reference))
+  vtkSeconds = time.perf_counter() - startTime
+  nonZero = np.abs(vtkDistances) > 1e-6
+  return {
+    "vertices": int(reference.GetNumberOfPoints()),
+    "triangles": int(reference.GetNumberOfCells()),
+    "mesh": mesh,
+    "seed": seed,
+    "engineSeconds": engineSeconds,
+    "vtkSeconds": vtkSeconds,
+    "speedup": vtkSeconds / engineSeconds if engineSeconds > 0 else None,
+    "maxAbsoluteValueDifference": float(np.max(np.abs(np.abs(engineDistances) - np.abs(vtkDistances)))),
+    "signAgreement": float(np.mean(np.sign(engineDistances[nonZero]) == np.sign(vtkDistances[nonZero]))) if nonZero.any() else 1.0,
+    }
+
+
+def transformationError(estimated, rotation, translation, points):
+  """Errors of ``estimated`` (4x4, maps the scaled moved points to the ideal frame)
+  relative to the inverse of the true rigid transform."""
+  estimated = np.asarray(estimated)
+  trueTransform = np.eye(4)
+  trueTransform[:3, :3] = rotation.T
+  trueTransform[:3, 3] = -rotation.T @ translation
+  cosine = (np.trace(estimated[:3, :3].T @ trueTransform[:3, :3]) - 1) / 2
+  displacement = points @ (estimated[:3, :3] - trueTransform[:3, :3]).T + (estimated[:3, 3] - trueTransform[:3, 3])
+  return {
+    "rotationErrorDegrees": float(np.degrees(np.arccos(np.clip(cosine, -1, 1)))),
+    "translationError": float(np.linalg.norm(estimated[:3, 3] - trueTransform[:3, 3])),
+    "registrationErrorRMS": float(np.sqrt(np.mean(np.sum(displacement ** 2, axis=1)))),
+    }
+
+
+def distanceError(computed, groundTruth):
+  difference = computed - groundTruth
+  return {
+    "rms": float(np.sqrt(np.mean(difference ** 2))),
+    "maxAbsolute": float(np.max(np.abs(difference))),
+    "p95Absolute": float(np.percentile(np.abs(difference), 95)),
+    }
+
+
+def runCase(vertexCount, case, parameters, seed=0):
+  """Run the pipeline (as batch.alignToIdeal does) on one synthetic pair and score it."""
+  pair = syntheticPair(vertexCount, case, seed=seed)
+  ideal = pair["ideal"]
+  idealPoints = registration.pointsFromPolyData(ideal)
+  source = pair["moved"]
+  sourcePoints = registration.pointsFromPolyData(source)
+  stages = {}
+  trace = instrumentation.Trace(case["name"])
+
+  startTime = time.perf_counter()
+  source_down, target_down, source_fpfh, target_fpfh, voxel_size, scaling = registration.runSubsample(
+    sourcePoints, idealPoints, case["skipScaling"], parameters, trace=trace)
+  stages["preprocess"] = time.perf_counter() - startTime
+
+  startTime = time.perf_counter()
+  report = {}
+  icp = registration.registerPointClouds(source_down, target_down, source_fpfh, target_fpfh, voxel_size, case["skipScaling"], parameters,
+    report=report, trace=trace)
+  stages["registration"] = time.perf_counter() - startTime
+  stages["globalRegistration"] = report["globalRegistration"]["seconds"]
+  stages["ICP"] = sum(level["seconds"] for level in report["ICP"])
+  transformMatrix = np.asarray(icp.transformation)
+
+  startTime = time.perf_counter()
+  # Scaled points in the frame the registration maps from, for scoring it
+  scaledSourcePoints = sourcePoints * scaling
+  aligned = registration.transformPolyDataInPlace(source, registration.composeTransforms(registration.scalingMatrix(scaling), transformMatrix))
+  sourceWithDistance, targetWithDistance = distance.computeSignedDistances(aligned, ideal, trace=trace)
+  stages["distances"] = time.perf_counter() - startTime
+
+  startTime = time.perf_counter()
+  comparison = metrics.ComparisonMetrics.fromPolyData(sourceWithDistance, targetWithDistance)
+  comparison.summary(parameters["errorToleranceValue"])
+  stages["metrics"] = time.perf_counter() - startTime
+
+  # Ground truth distance maps, from the prepared model in its true pose
+  trueSourceDistances = distance.distanceArray(distance.computeSignedDistance(pair["prepared"], ideal))
+  trueTargetDistances = distance.distanceArray(distance.computeSignedDistance(ideal, pair["prepared"]))
+
+  result = {
+    "vertices": int(ideal.GetNumberOfPoints()),
+    "case": case["name"],
+    "seed": seed,
+    "stages": stages,
+    "totalSeconds": float(sum(stages[name] for name in ("preprocess", "registration", "distances", "metrics"))),
+    "downsampledPoints": len(source_down.points),
+    "fitness": float(icp.fitness),
+    "inlierRMSE": float(icp.inlier_rmse),
+    "globalRegistration": report["globalRegistration"],
+    "ICP": report["ICP"],
+    "peakRSSBytes": trace.peakRSSBytes(),
+    "allocatedBytes": trace.allocatedBytes(),
+    "trace": trace.toDict(),
+    "scalingError": float(scaling * pair["scale"] - 1.0),
+    "sourceDistanceError": distanceError(distance.distanceArray(sourceWithDistance), trueSourceDistances),
+    "targetDistanceError": distanceError(distance.distanceArray(targetWithDistance), trueTargetDistances),
+    }
+  result.update(transformationError(transformMatrix, pair["rotation"], pair["translation"], scaledSourcePoints))
+  return result
+
+
+def environment():
+  """Versions and machine description recorded with the results."""
+  description = {
+    "python": platform.python_version(),
+    "platform": platform.platform(),
+    "processor": platform.processor(),
+    "cpuCount": os.cpu_count(),
+    "numpy": np.__version__,
+    }
+  try:
+    import open3d
+    description["open3d"] = open3d.__version__
+  except ImportError:
+    pass
+  try:
+    import vtk
+    description["vtk"] = vtk.vtkVersion.GetVTKVersion()
+  except ImportError:
+    pass
+  try:
+    description["commit"] = subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+      capture_output=True, text=True, check=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    description["commit"] = None
+  return description
+
+
+def runBenchmark(sizes=DEFAULT_SIZES, cases=CASES, parameters=None, repeat=1, outputPath=None, distanceSizes=DEFAULT_DISTANCE_SIZES):
+  """Run every case at every size ``repeat`` times, and every distance benchmark mesh at
+  every distance size.
+
+  :return: dictionary with the environment, parameters and the lists of case results
+    ("results") and distance results ("distanceResults")
+  """
+  parameters = registration.completeParameters(parameters)
+  if parameters["randomSeed"] < 0:
+    parameters["randomSeed"] = 0
+  results = []
+  for size in sizes:
+    for case in cases:
+      for run in range(repeat):
+        logging.info(f"Benchmark: {size} vertices, {case['name']}, run {run + 1}/{repeat}")
+        result = runCase(size, case, parameters, seed=run)
+        logging.info("  %.2f seconds, rotation error %.3f degrees, distance error RMS %.4f mm" % (
+          result["totalSeconds"], result["rotationErrorDegrees"], result["sourceDistanceError"]["rms"]))
+        results.append(result)
+  distanceResults = []
+  for size in distanceSizes:
+    for mesh in DISTANCE_MESHES:
+      for run in range(repeat):
+        logging.info(f"Distance benchmark: {size} vertices, {mesh}, run {run + 1}/{repeat}")
+        result = runDistanceCase(mesh, size, seed=run)
+        logging.info("  engine %.2f seconds, vtkDistancePolyDataFilter %.2f seconds, largest difference %.2g mm" % (
+          result["engineSeconds"], result["vtkSeconds"], result["maxAbsoluteValueDifference"]))
+        distanceResults.append(result)
+  benchmark = {
+    "environment": environment(),
+    "parameters": parameters,
+    "results": results,
+    "distanceResults": distanceResults,
+    }
+  if outputPath:
+    with open(outputPath, "w") as f:
+      json.dump(benchmark, f, indent=2)
+  return benchmark
+
+
+def _medians(benchmark):
+  """Median stage times and accuracy of each (vertex count, case), over the repeated runs."""
+  groups = {}
+  for result in benchmark["results"]:
+    groups.setdefault((result["vertices"], result["case"]), []).append(result)
+  medians = {}
+  for key, results in groups.items():
+    values = {f"{stage} (s)": statistics.median(result["stages"][stage] for result in results) for stage in results[0]["stages"]}
+    values["total (s)"] = statistics.median(result["totalSeconds"] for result in results)
+    values["rotation error (deg)"] = statistics.median(result["rotationErrorDegrees"] for result in results)
+    values["registration error RMS (mm)"] = statistics.median(result["registrationErrorRMS"] for result in results)
+    values["distance error RMS (mm)"] = statistics.median(result["sourceDistanceError"]["rms"] for result in results)
+    medians[key] = values
+  distanceGroups = {}
+  for result in benchmark.get("distanceResults", []):
+    distanceGroups.setdefault((result["vertices"], "distances, " + result["mesh"]), []).append(result)
+  for key, results in distanceGroups.items():
+    medians[key] = {
+      "engine (s)": statistics.median(result["engineSeconds"] for result in results),
+      "vtkDistancePolyDataFilter (s)": statistics.median(result["vtkSeconds"] for result in results),
+      }
+  return medians
+
+
+def compare(benchmark, baseline):
+  """Lines describing the change of every median value relative to ``baseline``."""
+  current = _medians(benchmark)
+  previous = _medians(baseline)
+  lines = []
+  for key in sorted(current):
+    if key not in previous:
+      continue
+    lines.append("%d vertices, %s:" % key)
+    for name, value in current[key].items():
+      if name not in previous[key]:
+        continue
+      before = previous[key][name]
+      change = "%+.1f %%" % (100.0 * (value - before) / before) if before else "n/a"
+      lines.append("  %-30s %12.4f -> %12.4f  (%s)" % (name, before, value, change))
+  return lines
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(prog="QuickModelAlignLib.benchmark", description="Benchmark the alignment and comparison pipeline on synthetic teeth.")
+  parser.add_argument("-o", "--output", default="QuickModelAlignBenchmark.json", help="output .json file")
+  parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES), help="approximate vertex counts of the generated meshes")
+  parser.add_argument("--distance-sizes", type=int, nargs="*", default=list(DEFAULT_DISTANCE_SIZES),
+    help="approximate vertex counts of the distance benchmark meshes (none to skip it)")
+  parser.add_argument("--repeat", type=int, default=1, help="runs of every case, the comparison uses the median")
+  parser.add_argument("-p", "--parameters", default=None, help="JSON file with registration parameters")
+  parser.add_argument("--compare", default=None, help="previous benchmark .json file to compare with")
+  args = parser.parse_args(argv)
+
+  logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+  parameters = {}
+  if args.parameters:
+    with open(args.parameters) as f:
+      parameters = json.load(f)
+  benchmark = runBenchmark(args.sizes, CASES, parameters, args.repeat, args.output, args.distance_sizes)
+  if args.compare:
+    with open(args.compare) as f:
+      baseline = json.load(f)
+    print("\n".join(compare(benchmark, baseline)))
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
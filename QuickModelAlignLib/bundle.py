@@ -0,0 +1,153 @@
+"""Result bundles: the outcome of one comparison in a single compressed file.
+
+A bundle holds everything needed to review a comparison without running the
+pipeline again:
+
+- the registration transform, scaling and parameters, and the tolerance used,
+- the paths and SHA-256 hashes of the prepared and ideal mesh files, so that
+  a bundle can be checked against the files it was computed from,
+- the per-vertex distances and vertex areas of the full resolution meshes, from
+  which the tolerance statistics are restored (metrics.ComparisonMetrics),
+- display meshes (decimated to a triangle budget) in their aligned pose, with
+  their distances, for the colour map.
+
+Bundles are ``.npz`` archives written with ``numpy.savez_compressed``, with the
+scalar information as a JSON string under "metadata". Distances and areas are
+stored as float32 by default; float16 halves their size, at a precision of about
+0.1 % of the largest distance.
+"""
+import json
+import os
+import tempfile
+from datetime import datetime
+
+import numpy as np
+
+from QuickModelAlignLib import cache
+from QuickModelAlignLib import display
+from QuickModelAlignLib import distance
+from QuickModelAlignLib import metrics
+
+
+BUNDLE_EXTENSION = ".qmab"
+
+FORMAT_VERSION = 1
+
+DISTANCE_TYPES = ("float32", "float16")
+
+
+class ResultBundle:
+  """Transform, metadata, full resolution distances and display meshes of one comparison."""
+
+  def __init__(self, metadata, transform, sourceDistances, sourceAreas, targetDistances, targetAreas,
+      sourceDisplay, targetDisplay):
+    """
+    :param metadata: JSON serializable dictionary (see fromPolyData)
+    :param sourceDisplay: (vertices, triangles, distances) arrays of the prepared display mesh
+    :param targetDisplay: the same for the ideal display mesh
+    """
+    self.metadata = metadata
+    self.transform = np.asarray(transform, dtype=np.float64)
+    self.sourceDistances = sourceDistances
+    self.sourceAreas = sourceAreas
+    self.targetDistances = targetDistances
+    self.targetAreas = targetAreas
+    self.sourceDisplay = sourceDisplay
+    self.targetDisplay = targetDisplay
+
+  @classmethod
+  def fromPolyData(cls, sourcePolydata, targetPolydata, transform, scaling, sourcePath, targetPath,
+      parameters=None, tolerance=None, sourceDisplay=None, targetDisplay=None, triangleBudget=display.TRIANGLE_BUDGET):
+    """Bundle of a finished comparison.
+
+    :param sourcePolydata: aligned full resolution prepared mesh with a 'Distance' point array
+    :param targetPolydata: full resolution ideal mesh with a 'Distance' point array
+    :param transform: 4x4 registration matrix
+    :param sourcePath: prepared mesh file, hashed to identify the input
+    :param targetPath: ideal mesh file
+    :param sourceDisplay: level of detail meshes with 'Distance' arrays, if already built;
+      otherwise the full resolution meshes are decimated to ``triangleBudget``
+    """
+    metadata = {
+      "formatVersion": FORMAT_VERSION,
+      "created": datetime.now().isoformat(timespec="seconds"),
+      "prepared": sourcePath,
+      "ideal": targetPath,
+      "preparedSHA256": cache.fileHash(sourcePath) if sourcePath and os.path.isfile(sourcePath) else None,
+      "idealSHA256": cache.fileHash(targetPath) if targetPath and os.path.isfile(targetPath) else None,
+      "scaling": float(scaling),
+      "parameters": parameters or {},
+      "tolerance": None if tolerance is None else float(tolerance),
+      }
+    areas = []
+    for polydata in (sourcePolydata, targetPolydata):
+      vertices, triangles = distance.trianglesFromPolyData(polydata)
+      areas.append(metrics.vertexAreas(vertices, triangles))
+    displayMeshes = []
+    for polydata, displayPolydata in ((sourcePolydata, sourceDisplay), (targetPolydata, targetDisplay)):
+      if displayPolydata is None:
+        displayPolydata = display.transferDistances(polydata, display.decimateToBudget(polydata, triangleBudget))
+      vertices, triangles = distance.trianglesFromPolyData(displayPolydata)
+      displayMeshes.append((vertices, triangles, distance.distanceArray(displayPolydata)))
+    return cls(metadata, transform, distance.distanceArray(sourcePolydata), areas[0],
+      distance.distanceArray(targetPolydata), areas[1], *displayMeshes)
+
+  def write(self, path, distanceType="float32"):
+    """Write the bundle to ``path``, atomically.
+
+    :param distanceType: "float32" or "float16", storage type of distances and areas
+    """
+    if distanceType not in DISTANCE_TYPES:
+      raise ValueError(f"Unsupported distance type: {distanceType}")
+    arrays = {
+      "metadata": np.array(json.dumps(dict(self.metadata, distanceType=distanceType))),
+      "transform": self.transform,
+      "sourceDistances": self.sourceDistances.astype(distanceType),
+      "sourceAreas": self.sourceAreas.astype(distanceType),
+      "targetDistances": self.targetDistances.astype(distanceType),
+      "targetAreas": self.targetAreas.astype(distanceType),
+      }
+    for name, (vertices, triangles, distances) in (("sourceDisplay", self.sourceDisplay), ("targetDisplay", self.targetDisplay)):
+      arrays[name + "Vertices"] = vertices.astype(np.float32)
+      arrays[name + "Triangles"] = triangles.astype(np.int32 if len(vertices) < 2**31 else np.int64)
+      arrays[name + "Distances"] = distances.astype(distanceType)
+    # Write to a temporary file and rename, so that an interrupted export leaves no partial bundle
+    fileHandle, temporaryPath = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    try:
+      with os.fdopen(fileHandle, "wb") as f:
+        np.savez_compressed(f, **arrays)
+      os.replace(temporaryPath, path)
+    except Exception:
+      if os.path.exists(temporaryPath):
+        os.remove(temporaryPath)
+      raise
+
+  @classmethod
+  def read(cls, path):
+    with np.load(path) as archive:
+      arrays = {name: archive[name] for name in archive.files}
+    metadata = json.loads(str(arrays["metadata"]))
+    if metadata.get("formatVersion", 0) > FORMAT_VERSION:
+      raise ValueError(f"{path} was written by a newer version of QuickModelAlign (bundle format {metadata['formatVersion']})")
+    displayMeshes = [tuple(arrays[name + suffix] for suffix in ("Vertices", "Triangles", "Distances"))
+      for name in ("sourceDisplay", "targetDisplay")]
+    return cls(metadata, arrays["transform"], arrays["sourceDistances"], arrays["sourceAreas"],
+      arrays["targetDistances"], arrays["targetAreas"], *displayMeshes)
+
+  def comparisonMetrics(self):
+    """Tolerance statistics of the full resolution meshes."""
+    return metrics.ComparisonMetrics(self.sourceDistances, self.sourceAreas, self.targetDistances, self.targetAreas)
+
+  def displayPolyData(self):
+    """Prepared and ideal display meshes, aligned, with 'Distance' point arrays."""
+    return tuple(distance.addDistanceArray(distance.polyDataFromTriangles(vertices, triangles), distances)
+      for vertices, triangles, distances in (self.sourceDisplay, self.targetDisplay))
+
+  def changedInputs(self):
+    """Input files that no longer match the hashes stored in the bundle (missing files are not reported)."""
+    changed = []
+    for name in ("prepared", "ideal"):
+      path, storedHash = self.metadata.get(name), self.metadata.get(name + "SHA256")
+      if path and storedHash and os.path.isfile(path) and cache.fileHash(path) != storedHash:
+        changed.append(path)
+    return changed
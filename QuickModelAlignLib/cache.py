@@ -0,0 +1,145 @@
+"""Content-addressed on-disk cache of preprocessed (downsampled + FPFH) point clouds.
+
+Entries are keyed by the SHA-256 of the mesh file and the parameters that
+influence preprocessing, and stored as uncompressed ``.npz`` files holding the
+downsampled points, their normals and the FPFH feature matrix. Other per-mesh
+arrays, such as signed distance grids, are stored with their own key parameters.
+The cache is bounded in size; the least recently used entries are evicted first.
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+
+# Parameters that change the result of preprocess_point_cloud for a given mesh
+KEY_PARAMETERS = ("pointDensity", "normalSearchRadius", "FPFHSearchRadius")
+
+DEFAULT_MAX_BYTES = 1024**3
+
+
+def defaultCacheDirectory():
+  """Cache location used outside of Slicer (``QUICKMODELALIGN_CACHE_DIR`` overrides it)."""
+  directory = os.environ.get("QUICKMODELALIGN_CACHE_DIR")
+  if directory:
+    return directory
+  if os.name == "nt":
+    base = os.environ.get("LOCALAPPDATA", os.path.expanduser("~"))
+  else:
+    base = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+  return os.path.join(base, "QuickModelAlign", "features")
+
+
+# Hashes of already hashed files, keyed by (path, size, modification time)
+_fileHashes = {}
+_fileHashesLock = threading.Lock()
+
+
+def fileHash(path, blockSize=1024*1024):
+  """SHA-256 of the content of a file. Results are memoized while the file is unchanged."""
+  stat = os.stat(path)
+  fileId = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+  with _fileHashesLock:
+    if fileId in _fileHashes:
+      return _fileHashes[fileId]
+  digest = hashlib.sha256()
+  with open(path, "rb") as f:
+    for block in iter(lambda: f.read(blockSize), b""):
+      digest.update(block)
+  with _fileHashesLock:
+    _fileHashes[fileId] = digest.hexdigest()
+  return _fileHashes[fileId]
+
+
+class FeatureCache:
+  """Size-bounded LRU cache of downsampled point clouds and their FPFH features."""
+
+  def __init__(self, directory=None, maxBytes=DEFAULT_MAX_BYTES):
+    self.directory = directory or defaultCacheDirectory()
+    self.maxBytes = maxBytes
+    self.hits = 0
+    self.misses = 0
+    os.makedirs(self.directory, exist_ok=True)
+
+  def key(self, path, parameters, names=KEY_PARAMETERS):
+    """Cache key of the mesh file ``path`` preprocessed with the ``names`` entries of ``parameters``."""
+    keyParameters = {name: parameters[name] if isinstance(parameters[name], str) else float(parameters[name]) for name in names}
+    digest = hashlib.sha256()
+    digest.update(fileHash(path).encode())
+    digest.update(json.dumps(keyParameters, sort_keys=True).encode())
+    return digest.hexdigest()
+
+  def entryPath(self, key):
+    return os.path.join(self.directory, key + ".npz")
+
+  def load(self, key):
+    """Return a dictionary of the cached arrays, or None if ``key`` is not cached."""
+    entryPath = self.entryPath(key)
+    try:
+      with np.load(entryPath) as entry:
+        arrays = {name: entry[name] for name in entry.files}
+    except (OSError, ValueError, KeyError):
+      self.misses += 1
+      return None
+    # Mark the entry as recently used
+    try:
+      os.utime(entryPath)
+    except OSError:
+      pass
+    self.hits += 1
+    return arrays
+
+  def store(self, key, **arrays):
+    # Write to a temporary file and rename, so that concurrent readers never see partial entries
+    fileHandle, temporaryPath = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+    try:
+      with os.fdopen(fileHandle, "wb") as f:
+        np.savez(f, **arrays)
+      os.replace(temporaryPath, self.entryPath(key))
+    except Exception:
+      if os.path.exists(temporaryPath):
+        os.remove(temporaryPath)
+      raise
+    self.evict()
+
+  def evict(self):
+    """Remove least recently used entries until the cache fits in maxBytes."""
+    entries = []
+    for name in os.listdir(self.directory):
+      if not name.endswith(".npz"):
+        continue
+      try:
+        stat = os.stat(os.path.join(self.directory, name))
+      except OSError:
+        continue
+      entries.append((stat.st_mtime, stat.st_size, name))
+    totalBytes = sum(entry[1] for entry in entries)
+    for _, size, name in sorted(entries):
+      if totalBytes <= self.maxBytes:
+        break
+      try:
+        os.remove(os.path.join(self.directory, name))
+        totalBytes -= size
+      except OSError:
+        pass
+
+  def clear(self):
+    for name in os.listdir(self.directory):
+      if name.endswith(".npz"):
+        os.remove(os.path.join(self.directory, name))
+
+  def statistics(self):
+    requests = self.hits + self.misses
+    return {
+      "hits": self.hits,
+      "misses": self.misses,
+      "hitRate": float(self.hits)/requests if requests else 0.0,
+      }
+
+  def logStatistics(self):
+    statistics = self.statistics()
+    logging.info("Feature cache: %d hits, %d misses" % (statistics["hits"], statistics["misses"]))
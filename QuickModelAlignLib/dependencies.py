@@ -0,0 +1,135 @@
+"""Checking and installing the Python packages the pipeline needs (open3d and cpdalp).
+
+The check does not import the packages: importing open3d takes seconds, and it is
+only needed once a model is actually processed. Installed versions are read from the
+package metadata, and the result of a check is cached together with a fingerprint of
+the installed files, so that later sessions only have to compare the fingerprint.
+
+Installation downloads the open3d wheel QuickModelAlign is tested with and runs pip
+in a separate process, so it can be run as a background task.
+"""
+import importlib.metadata
+import importlib.util
+import os
+import subprocess
+import sys
+import urllib.request
+
+from QuickModelAlignLib import parallel
+
+
+REQUIRED_OPEN3D_VERSION = "0.14.1+816263b"
+
+# Operating system (as slicer.app.os) -> wheel URL, wheel file name
+OPEN3D_WHEELS = {
+  "win": ("https://app.box.com/shared/static/friq8fhfi8n4syklt1v47rmuf58zro75.whl",
+    "open3d-0.14.1+816263b-cp39-cp39-win_amd64.whl"),
+  "macosx": ("https://app.box.com/shared/static/ixhac95jrx7xdxtlagwgns7vt9b3mbqu.whl",
+    "open3d-0.14.1+816263b-cp39-cp39-macosx_10_15_x86_64.whl"),
+  "linux": ("https://app.box.com/shared/static/wyzk0f9jhefrbm4uukzym0sow5bf26yi.whl",
+    "open3d-0.14.1+816263b-cp39-cp39-manylinux_2_27_x86_64.whl"),
+  }
+
+PACKAGES = ("open3d", "cpdalp")
+
+
+def fingerprint():
+  """Cheap identifier of the installed packages: location and modification time of
+  their top level module. It changes when a package is installed, upgraded or removed."""
+  parts = [sys.executable]
+  for package in PACKAGES:
+    spec = importlib.util.find_spec(package)
+    origin = spec.origin if spec is not None else None
+    if origin and os.path.exists(origin):
+      parts.append(f"{package}={origin}:{os.stat(origin).st_mtime_ns}")
+    else:
+      parts.append(f"{package}=")
+  return "|".join(parts)
+
+
+def installedVersion(package):
+  try:
+    return importlib.metadata.version(package)
+  except importlib.metadata.PackageNotFoundError:
+    return None
+
+
+def _sameVersion(installed, required):
+  try:
+    from packaging import version
+  except ImportError:
+    return installed == required
+  return version.parse(installed) == version.parse(required)
+
+
+def checkDependencies(cached=None):
+  """Status of the required packages, as a dictionary that can be stored between sessions.
+
+  :param cached: status returned by a previous call; it is reused if the installed
+    packages have not changed since
+  :return: dictionary with "fingerprint", the "open3d" and "cpdalp" versions (None if
+    not installed), "ok", and "cached" (whether ``cached`` was reused)
+  """
+  currentFingerprint = fingerprint()
+  if cached and cached.get("fingerprint") == currentFingerprint:
+    return dict(cached, cached=True)
+  status = {"fingerprint": currentFingerprint}
+  for package in PACKAGES:
+    status[package] = installedVersion(package)
+  status["ok"] = bool(status["cpdalp"] and status["open3d"] and _sameVersion(status["open3d"], REQUIRED_OPEN3D_VERSION))
+  status["cached"] = False
+  return status
+
+
+def describe(status):
+  """Short explanation of what is missing, for the user interface."""
+  if status["ok"]:
+    return f"open3d {status['open3d']} installed"
+  if status["open3d"] and not _sameVersion(status["open3d"], REQUIRED_OPEN3D_VERSION):
+    return f"open3d {status['open3d']} is installed, QuickModelAlign requires version {REQUIRED_OPEN3D_VERSION}"
+  missing = [package for package in PACKAGES if not status[package]]
+  return "QuickModelAlign requires " + " and ".join(missing) + ", which are not installed"
+
+
+def currentOperatingSystem():
+  """Name of the operating system as slicer.app.os: "win", "macosx" or "linux"."""
+  if sys.platform.startswith("win"):
+    return "win"
+  if sys.platform == "darwin":
+    return "macosx"
+  return "linux"
+
+
+def wheelForPlatform(operatingSystem=None):
+  """URL and file name of the open3d wheel for ``operatingSystem`` (defaults to the current one)."""
+  operatingSystem = operatingSystem or currentOperatingSystem()
+  if operatingSystem not in OPEN3D_WHEELS:
+    raise RuntimeError(f"No open3d wheel is available for {operatingSystem}")
+  return OPEN3D_WHEELS[operatingSystem]
+
+
+def installDependencies(downloadDirectory, progress=None):
+  """Download the open3d wheel and pip install it together with cpdalp.
+
+  Runs pip with the interpreter of worker processes (PythonSlicer inside Slicer), so it
+  does not block the calling process and can be used as a ThreadTask function.
+
+  :return: dictionary with the installed "wheel" path and the pip "log"
+  """
+  url, wheelName = wheelForPlatform()
+  os.makedirs(downloadDirectory, exist_ok=True)
+  wheelPath = os.path.join(downloadDirectory, wheelName)
+  if not os.path.exists(wheelPath):
+    if progress is not None:
+      progress("install", "downloading open3d")
+    partialPath = wheelPath + ".part"
+    urllib.request.urlretrieve(url, partialPath)
+    os.replace(partialPath, wheelPath)
+  if progress is not None:
+    progress("install", "pip")
+  # wheelPath may contain spaces, it is passed as a single argument
+  completed = subprocess.run([parallel.pythonExecutable(), "-m", "pip", "install", "cpdalp", wheelPath],
+    stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+  if completed.returncode != 0:
+    raise RuntimeError(f"pip install failed (exit code {completed.returncode}):\n{completed.stdout}")
+  return {"wheel": wheelPath, "log": completed.stdout}
@@ -0,0 +1,182 @@
+"""Lightweight display geometry for previews and interaction.
+
+Point clouds are shown as vertex cells, which the renderer draws as screen space
+points of a configurable size: a few bytes per point, instead of the hundreds of
+triangles per point of a sphere glyph. Clouds larger than a point budget are randomly
+subsampled (level of detail), so that the preview appears immediately even for dense
+inputs. The subsampling is deterministic, the same cloud always gives the same preview.
+
+Meshes larger than a triangle budget are displayed as quadric decimated level of
+detail (LOD) meshes, so that rotating the view and the opacity animation stay fluid.
+Distances are always computed on the full resolution meshes, and carried to the LOD
+meshes from the nearest full resolution vertex for the colour maps.
+"""
+import os
+
+import numpy as np
+
+from QuickModelAlignLib import distance
+
+
+# Largest number of points shown per point cloud preview
+POINT_BUDGET = 100000
+
+# "points" renders vertices, "spheres" one sphere glyph per (budgeted) point
+POINT_CLOUD_STYLES = ("points", "spheres")
+
+# Largest number of triangles displayed per mesh, larger meshes are decimated. 0 displays full resolution.
+TRIANGLE_BUDGET = 500000
+
+# Colour tables of the colour map mode: blue for the prepared model, red for the ideal model
+COLOUR_MAP_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Resources", "CustomColorMaps")
+PREPARED_COLOUR_MAP = os.path.join(COLOUR_MAP_DIRECTORY, "blue.txt")
+IDEAL_COLOUR_MAP = os.path.join(COLOUR_MAP_DIRECTORY, "red.txt")
+
+
+def levelOfDetailIndices(count, budget, seed=0):
+  """Sorted indices of ``budget`` of ``count`` points, or None if all points fit the budget."""
+  if not budget or budget <= 0 or count <= budget:
+    return None
+  return np.sort(np.random.default_rng(seed).choice(count, int(budget), replace=False))
+
+
+def pointCloudPolyData(points, budget=POINT_BUDGET):
+  """Polydata with one vertex cell per point, subsampled to at most ``budget`` points.
+
+  :param points: N x 3 array (or open3d Vector3dVector)
+  """
+  import vtk
+  import vtk.util.numpy_support as vtk_np
+  points = np.asarray(points)
+  indices = levelOfDetailIndices(len(points), budget)
+  if indices is not None:
+    points = points[indices]
+  vtkPoints = vtk.vtkPoints()
+  vtkPoints.SetData(vtk_np.numpy_to_vtk(np.ascontiguousarray(points, dtype=np.float32), deep=True))
+  vertices = vtk.vtkCellArray()
+  if hasattr(vertices, "GetConnectivityArray"):
+    vertices.SetData(vtk_np.numpy_to_vtkIdTypeArray(np.arange(len(points) + 1, dtype=np.int64), deep=True),
+      vtk_np.numpy_to_vtkIdTypeArray(np.arange(len(points), dtype=np.int64), deep=True))
+  else:
+    # VTK 8 cell array layout: (1, i) per vertex
+    cellData = np.stack([np.ones(len(points), dtype=np.int64), np.arange(len(points), dtype=np.int64)], axis=1).ravel()
+    vertices.SetCells(len(points), vtk_np.numpy_to_vtkIdTypeArray(cellData, deep=True))
+  polydata = vtk.vtkPolyData()
+  polydata.SetPoints(vtkPoints)
+  polydata.SetVerts(vertices)
+  return polydata
+
+
+def sphereGlyphPolyData(polydata, radius):
+  """One sphere per point of ``polydata``, the former point cloud display."""
+  import vtk
+  sphereSource = vtk.vtkSphereSource()
+  sphereSource.SetRadius(radius)
+  glyph = vtk.vtkGlyph3D()
+  glyph.SetSourceConnection(sphereSource.GetOutputPort())
+  glyph.SetInputData(polydata)
+  glyph.ScalingOff()
+  glyph.Update()
+  return glyph.GetOutput()
+
+
+def exceedsTriangleBudget(polydata, triangleBudget):
+  return bool(triangleBudget) and polydata.GetNumberOfPolys() > triangleBudget
+
+
+def decimateToBudget(polydata, triangleBudget=TRIANGLE_BUDGET):
+  """Quadric decimation of a triangle mesh to about ``triangleBudget`` triangles.
+
+  Meshes within the budget (or a budget of 0) are returned unchanged.
+  """
+  if not exceedsTriangleBudget(polydata, triangleBudget):
+    return polydata
+  import vtk
+  decimation = vtk.vtkQuadricDecimation()
+  decimation.SetInputData(polydata)
+  decimation.SetTargetReduction(1.0 - triangleBudget / polydata.GetNumberOfPolys())
+  decimation.VolumePreservationOn()
+  decimation.Update()
+  output = vtk.vtkPolyData()
+  output.ShallowCopy(decimation.GetOutput())
+  return output
+
+
+def nearestVertexIndices(vertices, points):
+  """Index of the vertex closest to each of ``points``."""
+  if distance.kdTreeAvailable():
+    import scipy.spatial
+    return scipy.spatial.cKDTree(vertices).query(points, k=1)[1]
+  import vtk
+  import vtk.util.numpy_support as vtk_np
+  polydata = vtk.vtkPolyData()
+  vtkPoints = vtk.vtkPoints()
+  vtkPoints.SetData(vtk_np.numpy_to_vtk(np.ascontiguousarray(vertices, dtype=np.float64), deep=True))
+  polydata.SetPoints(vtkPoints)
+  locator = vtk.vtkStaticPointLocator()
+  locator.SetDataSet(polydata)
+  locator.BuildLocator()
+  return np.array([locator.FindClosestPoint(point) for point in points], dtype=np.int64)
+
+
+def transferDistancesBytes(polydata, displayPolydata):
+  """Bytes allocated by transferDistances: KD-tree of the full resolution vertices (float64
+  copy and index) and the distances of the display mesh."""
+  return 32 * int(polydata.GetNumberOfPoints()) + 16 * int(displayPolydata.GetNumberOfPoints())
+
+
+def transferDistances(polydata, displayPolydata):
+  """Copy of the level of detail mesh ``displayPolydata`` with the 'Distance' point array of
+  the full resolution mesh ``polydata``, taken from the nearest full resolution vertex."""
+  import vtk.util.numpy_support as vtk_np
+  if displayPolydata is polydata:
+    return polydata
+  vertices = vtk_np.vtk_to_numpy(polydata.GetPoints().GetData())
+  displayVertices = vtk_np.vtk_to_numpy(displayPolydata.GetPoints().GetData())
+  distances = distance.distanceArray(polydata)[nearestVertexIndices(vertices, displayVertices)]
+  return distance.addDistanceArray(displayPolydata, distances)
+
+
+def readColourTable(path):
+  """RGBA colours (uint8, one row per entry) of a Slicer colour table file."""
+  colours = []
+  with open(path) as f:
+    for line in f:
+      fields = line.split()
+      if fields and not fields[0].startswith("#"):
+        colours.append([int(value) for value in fields[-4:]])
+  return np.array(colours, dtype=np.uint8)
+
+
+def distanceColours(distances, tolerance, colourTable):
+  """RGB colours of ``distances`` as shown by the colour map mode: the colour table spans
+  [-tolerance, tolerance], distances beyond are clamped to its ends."""
+  if tolerance <= 0:
+    indices = np.where(distances < 0, 0, len(colourTable) - 1)
+  else:
+    scaled = (np.asarray(distances) + tolerance) / (2 * tolerance) * (len(colourTable) - 1)
+    indices = np.clip(np.rint(scaled), 0, len(colourTable) - 1).astype(np.int64)
+  return colourTable[indices, :3]
+
+
+def writeColouredMesh(polydata, path, tolerance, colourMapPath, triangleBudget=TRIANGLE_BUDGET):
+  """Write a mesh with a 'Distance' point array as a binary PLY file with per-vertex colours,
+  decimated to ``triangleBudget`` triangles, for viewers without colour maps."""
+  import vtk
+  import vtk.util.numpy_support as vtk_np
+  displayPolydata = transferDistances(polydata, decimateToBudget(polydata, triangleBudget))
+  colours = vtk_np.numpy_to_vtk(distanceColours(distance.distanceArray(displayPolydata), tolerance, readColourTable(colourMapPath)), deep=True,
+    array_type=vtk.VTK_UNSIGNED_CHAR)
+  colours.SetName("RGB")
+  output = vtk.vtkPolyData()
+  output.ShallowCopy(displayPolydata)
+  output.GetPointData().AddArray(colours)
+  writer = vtk.vtkPLYWriter()
+  writer.SetFileName(path)
+  writer.SetInputData(output)
+  writer.SetFileTypeToBinary()
+  writer.SetArrayName("RGB")
+  writer.SetColorModeToDefault()
+  if not writer.Write():
+    raise IOError(f"Failed to write {path}")
+  return path
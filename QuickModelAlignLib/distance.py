@@ -0,0 +1,457 @@
+"""Signed surface distances between two aligned meshes.
+
+The default method uses SurfaceDistanceEngine: a bounding volume hierarchy of the
+triangles of the reference mesh, built once, and exact point-triangle distances evaluated
+in vectorized, multi-threaded chunks. The sign is taken from the interpolated surface
+normal at the closest point (positive outside, as vtkDistancePolyDataFilter).
+When scipy is not available the vtkDistancePolyDataFilter is used instead.
+"""
+import concurrent.futures
+import os
+
+import numpy as np
+
+from QuickModelAlignLib import instrumentation
+
+
+DISTANCE_ARRAY_NAME = "Distance"
+
+# Largest number of (point, candidate triangle) pairs evaluated at once per chunk
+MAX_CANDIDATE_PAIRS = 8192 * 8
+
+# Triangles per leaf of the bounding volume hierarchy of SurfaceDistanceEngine
+LEAF_SIZE = 4
+
+# Triangles whose corners are gathered at once when building per-triangle quantities
+TRIANGLE_BLOCK_SIZE = 65536
+
+# Threads of SurfaceDistanceEngine.signedDistance in this process (None: one per core).
+# Worker processes set it through setWorkerLimit so that N processes use N cores in total
+_workerLimit = None
+
+
+class DistanceCancelled(Exception):
+  """Raised by SurfaceDistanceEngine.signedDistance when its ``stop`` callable returns true."""
+
+
+def setWorkerLimit(workers):
+  """Limit the distance threads of this process to ``workers`` (None removes the limit)."""
+  global _workerLimit
+  _workerLimit = None if workers is None else max(1, int(workers))
+
+
+def workerCount():
+  """Threads used for distance computations in this process."""
+  return _workerLimit or os.cpu_count() or 1
+
+
+def kdTreeAvailable():
+  try:
+    import scipy.spatial
+    return True
+  except ImportError:
+    return False
+
+
+def trianglesFromPolyData(polydata):
+  """Return the vertices (N x 3, float64) and triangles (M x 3, int64) of a surface mesh."""
+  import vtk
+  import vtk.util.numpy_support as vtk_np
+  polys = polydata.GetPolys()
+  if polys.GetNumberOfCells() == 0:
+    raise ValueError("Mesh has no surface cells")
+  if polys.GetMaxCellSize() != 3 or polydata.GetNumberOfStrips() > 0:
+    triangleFilter = vtk.vtkTriangleFilter()
+    triangleFilter.SetInputData(polydata)
+    triangleFilter.PassVertsOff()
+    triangleFilter.PassLinesOff()
+    triangleFilter.Update()
+    polys = triangleFilter.GetOutput().GetPolys()
+  if hasattr(polys, "GetConnectivityArray"):
+    connectivity = vtk_np.vtk_to_numpy(polys.GetConnectivityArray())
+  else:
+    # VTK 8 cell array layout: (3, i, j, k) per triangle
+    connectivity = vtk_np.vtk_to_numpy(polys.GetData()).reshape(-1, 4)[:, 1:]
+  triangles = np.asarray(connectivity, dtype=np.int64).reshape(-1, 3)
+  vertices = np.asarray(vtk_np.vtk_to_numpy(polydata.GetPoints().GetData()), dtype=np.float64)
+  return vertices, triangles
+
+
+def polyDataFromTriangles(vertices, triangles):
+  """Triangle mesh polydata from vertices (N x 3, float32 points are kept as float32) and triangles (M x 3)."""
+  import vtk
+  import vtk.util.numpy_support as vtk_np
+  vertices = np.asarray(vertices)
+  points = vtk.vtkPoints()
+  points.SetData(vtk_np.numpy_to_vtk(np.ascontiguousarray(vertices, dtype=np.float32 if vertices.dtype == np.float32 else np.float64), deep=True))
+  cells = vtk.vtkCellArray()
+  if hasattr(cells, "GetConnectivityArray"):
+    offsets = np.arange(0, 3 * len(triangles) + 1, 3, dtype=np.int64)
+    cells.SetData(vtk_np.numpy_to_vtkIdTypeArray(offsets, deep=True),
+      vtk_np.numpy_to_vtkIdTypeArray(np.ascontiguousarray(triangles, dtype=np.int64).ravel(), deep=True))
+  else:
+    # VTK 8 cell array layout: (3, i, j, k) per triangle
+    cellData = np.hstack([np.full((len(triangles), 1), 3, dtype=np.int64), triangles]).ravel()
+    cells.SetCells(len(triangles), vtk_np.numpy_to_vtkIdTypeArray(cellData, deep=True))
+  polydata = vtk.vtkPolyData()
+  polydata.SetPoints(points)
+  polydata.SetPolys(cells)
+  return polydata
+
+
+def closestPointsOnTriangles(points, a, b, c):
+  """Closest points on triangles (a, b, c) to ``points``, all arrays of shape (..., 3).
+
+  Vectorized version of the region based algorithm of Ericson, Real-Time Collision
+  Detection, section 5.1.5.
+
+  :return: barycentric coordinates (..., 3) of the closest points
+  """
+  ab = b - a
+  ac = c - a
+  ap = points - a
+  bp = points - b
+  cp = points - c
+  d1 = np.einsum("...i,...i", ab, ap)
+  d2 = np.einsum("...i,...i", ac, ap)
+  d3 = np.einsum("...i,...i", ab, bp)
+  d4 = np.einsum("...i,...i", ac, bp)
+  d5 = np.einsum("...i,...i", ab, cp)
+  d6 = np.einsum("...i,...i", ac, cp)
+  va = d3*d6 - d5*d4
+  vb = d5*d2 - d1*d6
+  vc = d1*d4 - d3*d2
+
+  def safeDivide(numerator, denominator):
+    return numerator / np.where(denominator == 0, 1.0, denominator)
+
+  # Interior of the face, then override with the edge and vertex regions in
+  # reverse order of precedence, so that the first matching region wins
+  denominator = va + vb + vc
+  v = safeDivide(vb, denominator)
+  w = safeDivide(vc, denominator)
+  u = 1.0 - v - w
+  zero = np.zeros_like(u)
+  one = np.ones_like(u)
+  tBC = safeDivide(d4 - d3, (d4 - d3) + (d5 - d6))
+  tAC = safeDivide(d2, d2 - d6)
+  tAB = safeDivide(d1, d1 - d3)
+  regions = [
+    ((va <= 0) & ((d4 - d3) >= 0) & ((d5 - d6) >= 0), (zero, one - tBC, tBC)),  # edge BC
+    ((vb <= 0) & (d2 >= 0) & (d6 <= 0), (one - tAC, zero, tAC)),  # edge AC
+    ((d6 >= 0) & (d5 <= d6), (zero, zero, one)),  # vertex C
+    ((vc <= 0) & (d1 >= 0) & (d3 <= 0), (one - tAB, tAB, zero)),  # edge AB
+    ((d3 >= 0) & (d4 <= d3), (zero, one, zero)),  # vertex B
+    ((d1 <= 0) & (d2 <= 0), (one, zero, zero)),  # vertex A
+    ]
+  for mask, (regionU, regionV, regionW) in regions:
+    u = np.where(mask, regionU, u)
+    v = np.where(mask, regionV, v)
+    w = np.where(mask, regionW, w)
+  return np.stack([u, v, w], axis=-1)
+
+
+def _medianSplitOrder(centers, depth, leafSize):
+  """Order of ``centers`` (N x 3) that splits them recursively at the median of the longest
+  axis of their bounding box, ``depth`` times, into groups of ``leafSize``.
+
+  The order is padded to ``leafSize * 2**depth`` entries with entries that sort after every
+  center, so that every level splits fixed ranges in two halves with one partition per range.
+  """
+  count = len(centers)
+  order = np.append(np.arange(count), np.full(leafSize * 2**depth - count, count))
+  # Coordinates per axis, contiguous for the gathers; padding entries repeat the last center
+  coordinates = [np.append(centers[:, axis], centers[-1, axis]).astype(np.float32) for axis in range(3)]
+  for level in range(depth):
+    ranges = order.reshape(2**level, -1)
+    rangeCoordinates = np.stack([axisCoordinates[ranges] for axisCoordinates in coordinates])
+    longestAxis = np.argmax(rangeCoordinates.max(axis=2) - rangeCoordinates.min(axis=2), axis=0)
+    keys = np.take_along_axis(rangeCoordinates, longestAxis[np.newaxis, :, np.newaxis], axis=0)[0]
+    keys[ranges == count] = np.inf
+    half = ranges.shape[1] // 2
+    order = np.take_along_axis(ranges, np.argpartition(keys, half - 1, axis=1), axis=1).ravel()
+  return order[order < count]
+
+
+def _boxSquaredDistances(points, lower, upper):
+  """Squared distance of each of ``points`` (N x 3) to the axis aligned box (``lower``, ``upper``) of the same row."""
+  gap = np.maximum(np.maximum(lower - points, points - upper), 0.0)
+  return np.einsum("ij,ij->i", gap, gap)
+
+
+class SurfaceDistanceEngine:
+  """Signed distance from arbitrary points to the surface of a triangle mesh.
+
+  The spatial index is built once in the constructor, so one engine can be queried for
+  many point sets, e.g. every submission aligned to the same ideal model. It is a
+  bounding volume hierarchy: a balanced binary tree over the triangles, split at the
+  median of the longest axis, with LEAF_SIZE triangles per leaf. Every node holds the
+  axis aligned bounding box of its triangles, which bounds the distance to each of them
+  from below, so a large triangle only affects the search of the points near its own
+  box, whatever the size of the other triangles.
+
+  Queries are vectorized over chunks of points: the distance to a triangle of the nearest
+  vertex (from a KD-tree of the vertices) bounds each distance from above, then all
+  (point, node) pairs whose box is closer than that bound are expanded level by level,
+  and the triangles of the remaining leaves whose own bounding box is closer than the
+  bound are evaluated exactly.
+  """
+
+  def __init__(self, polydata):
+    from scipy.spatial import cKDTree
+    self.vertices, triangles = trianglesFromPolyData(polydata)
+    triangleLower = np.empty((len(triangles), 3))
+    triangleUpper = np.empty((len(triangles), 3))
+    triangleNormals = np.empty((len(triangles), 3))
+    # Triangle corners are gathered in blocks, a (triangles x 3 x 3) array would be the largest allocation of the engine
+    for start in range(0, len(triangles), TRIANGLE_BLOCK_SIZE):
+      block = triangles[start:start+TRIANGLE_BLOCK_SIZE]
+      a, b, c = (self.vertices[block[:, corner]] for corner in range(3))
+      triangleLower[start:start+len(block)] = np.minimum(np.minimum(a, b), c)
+      triangleUpper[start:start+len(block)] = np.maximum(np.maximum(a, b), c)
+      triangleNormals[start:start+len(block)] = np.cross(b - a, c - a)
+    # Area weighted vertex normals, interpolated at the closest point to determine the sign
+    vertexNormals = np.zeros_like(self.vertices)
+    for corner in range(3):
+      for axis in range(3):
+        vertexNormals[:, axis] += np.bincount(triangles[:, corner], triangleNormals[:, axis], minlength=len(self.vertices))
+    del triangleNormals
+    lengths = np.linalg.norm(vertexNormals, axis=1)
+    vertexNormals /= np.where(lengths == 0, 1.0, lengths)[:, np.newaxis]
+    self.vertexNormals = vertexNormals
+
+    # Group the triangles by recursive median splits of their box centers, LEAF_SIZE per leaf.
+    # The leaf count is padded to a power of two with empty boxes, which are infinitely far
+    # from any point, and the last leaf is completed by repeating its last triangle.
+    leafCount = -(-len(triangles) // LEAF_SIZE)
+    self.depth = int(np.ceil(np.log2(leafCount)))
+    order = _medianSplitOrder((triangleLower + triangleUpper) / 2, self.depth, LEAF_SIZE)
+    self.triangles = triangles[order]
+    order = np.append(order, np.full(leafCount * LEAF_SIZE - len(triangles), order[-1]))
+    self.lowerBounds = [np.full((2**self.depth, 3), np.inf)]
+    self.upperBounds = [np.full((2**self.depth, 3), -np.inf)]
+    self.lowerBounds[0][:leafCount] = np.minimum.reduce([triangleLower[order[corner::LEAF_SIZE]] for corner in range(LEAF_SIZE)])
+    self.upperBounds[0][:leafCount] = np.maximum.reduce([triangleUpper[order[corner::LEAF_SIZE]] for corner in range(LEAF_SIZE)])
+    del triangleLower, triangleUpper
+    # Node boxes per level, level 0 is the root and level ``depth`` the leaves
+    for level in range(self.depth):
+      self.lowerBounds.insert(0, np.minimum(self.lowerBounds[0][0::2], self.lowerBounds[0][1::2]))
+      self.upperBounds.insert(0, np.maximum(self.upperBounds[0][0::2], self.upperBounds[0][1::2]))
+    # KD-tree of the vertices used by triangles, with one triangle of each: the distance to a triangle
+    # of the nearest vertex bounds the distance to the surface from above
+    vertexTriangles = np.full(len(self.vertices), -1, dtype=np.int64)
+    for corner in range(3):
+      vertexTriangles[self.triangles[:, corner]] = np.arange(len(self.triangles))
+    usedVertices = np.flatnonzero(vertexTriangles >= 0)
+    self.vertexTree = cKDTree(self.vertices[usedVertices], balanced_tree=False, compact_nodes=False)
+    self.vertexTriangles = vertexTriangles[usedVertices]
+
+  @property
+  def nbytes(self):
+    """Memory held by the engine: vertices, normals, sorted triangles, node boxes and vertex KD-tree."""
+    return int(self.vertices.nbytes + self.vertexNormals.nbytes + self.triangles.nbytes
+      + sum(bounds.nbytes for bounds in self.lowerBounds + self.upperBounds)
+      + self.vertexTree.data.nbytes + self.vertexTree.indices.nbytes + self.vertexTriangles.nbytes)
+
+  def _closestPoints(self, points, triangleIndices, corners=None):
+    """Barycentric coordinates, closest points and squared distances of ``points`` to the triangles."""
+    if corners is None:
+      corners = self.vertices[self.triangles[triangleIndices]]
+    barycentric = closestPointsOnTriangles(points, corners[:, 0], corners[:, 1], corners[:, 2])
+    closestPoints = np.einsum("...i,...ij->...j", barycentric, corners)
+    return barycentric, closestPoints, ((points - closestPoints)**2).sum(axis=1)
+
+  def _nodePairs(self, points, squaredBounds):
+    """(point index, leaf index) pairs whose leaf box is within the square root of
+    ``squaredBounds`` of the point, ordered by point index."""
+    pointIndices = np.arange(len(points))
+    nodes = np.zeros(len(points), dtype=np.int64)
+    for level in range(self.depth + 1):
+      if level > 0:
+        # Every remaining node is replaced by its two children, consecutively, so the pairs stay ordered by point
+        pointIndices = np.repeat(pointIndices, 2)
+        nodes = 2 * np.repeat(nodes, 2) + np.tile([0, 1], len(nodes))
+      near = _boxSquaredDistances(points[pointIndices], self.lowerBounds[level][nodes], self.upperBounds[level][nodes]) <= squaredBounds[pointIndices]
+      pointIndices = pointIndices[near]
+      nodes = nodes[near]
+    return pointIndices, nodes
+
+  def _leafTriangles(self, leaves):
+    """Triangle indices (leaves x LEAF_SIZE) of ``leaves``, the last triangle repeated to fill the last leaf."""
+    return np.minimum(leaves[:, np.newaxis] * LEAF_SIZE + np.arange(LEAF_SIZE), len(self.triangles) - 1)
+
+  def _signedDistanceChunk(self, points):
+    points = np.asarray(points, dtype=np.float64)
+    # Upper bound of the distances: a triangle of the nearest vertex
+    closestTriangles = self.vertexTriangles[self.vertexTree.query(points, k=1)[1]]
+    _, _, squaredDistances = self._closestPoints(points, closestTriangles)
+
+    pointIndices, leaves = self._nodePairs(points, squaredDistances)
+    for start in range(0, len(pointIndices), MAX_CANDIDATE_PAIRS // LEAF_SIZE):
+      blockPoints = np.repeat(pointIndices[start:start+MAX_CANDIDATE_PAIRS//LEAF_SIZE], LEAF_SIZE)
+      blockTriangles = self._leafTriangles(leaves[start:start+MAX_CANDIDATE_PAIRS//LEAF_SIZE]).ravel()
+      # Only the triangles whose own box is closer than the bound are evaluated exactly
+      corners = self.vertices[self.triangles[blockTriangles]]
+      lower = np.minimum(np.minimum(corners[:, 0], corners[:, 1]), corners[:, 2])
+      upper = np.maximum(np.maximum(corners[:, 0], corners[:, 1]), corners[:, 2])
+      near = _boxSquaredDistances(points[blockPoints], lower, upper) <= squaredDistances[blockPoints]
+      blockPoints = blockPoints[near]
+      blockTriangles = blockTriangles[near]
+      if len(blockPoints) == 0:
+        continue
+      _, _, candidateDistances = self._closestPoints(points[blockPoints], blockTriangles, corners[near])
+      # The pairs are ordered by point: reduce each run of pairs of a point to its closest candidate
+      first = np.append(True, blockPoints[1:] != blockPoints[:-1])
+      minima = np.minimum.reduceat(candidateDistances, np.flatnonzero(first))
+      closest = (candidateDistances == minima[np.cumsum(first) - 1]) & (candidateDistances < squaredDistances[blockPoints])
+      squaredDistances[blockPoints[closest]] = candidateDistances[closest]
+      closestTriangles[blockPoints[closest]] = blockTriangles[closest]
+
+    barycentric, closestPoints, squaredDistances = self._closestPoints(points, closestTriangles)
+    normals = np.einsum("...i,...ij->...j", barycentric, self.vertexNormals[self.triangles[closestTriangles]])
+    sign = np.where(np.einsum("...i,...i", points - closestPoints, normals) < 0, -1.0, 1.0)
+    return sign * np.sqrt(squaredDistances)
+
+  def signedDistance(self, points, chunkSize=8192, workers=None, stop=None):
+    """Signed distance of each of ``points`` (N x 3) to the surface, computed in parallel chunks
+    (``workers`` threads, by default workerCount()).
+
+    :param stop: optional callable checked before each chunk; if it returns true, the
+      remaining chunks are skipped and DistanceCancelled is raised
+    """
+    def computeChunk(chunk):
+      if stop is not None and stop():
+        raise DistanceCancelled()
+      return self._signedDistanceChunk(chunk)
+    points = np.asarray(points)
+    chunks = [points[start:start+chunkSize] for start in range(0, len(points), chunkSize)]
+    if len(chunks) <= 1:
+      return computeChunk(points)
+    workers = workers or workerCount()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+      return np.concatenate(list(executor.map(computeChunk, chunks)))
+
+
+def engineBytes(vertexCount, triangleCount):
+  """Memory of a SurfaceDistanceEngine of a mesh, for predicting the memory of a run:
+  float64 vertices and normals, int64 triangles, the float64 node boxes (up to four nodes
+  per leaf, as the leaf count is padded to a power of two) and the vertex KD-tree."""
+  return 88 * int(vertexCount) + (24 + 4 * 48 // LEAF_SIZE) * int(triangleCount)
+
+
+def signedDistanceBytes(pointCount, referencePolydata):
+  """Bytes allocated by computeSignedDistance: the engine of the reference mesh, and the
+  distances as numpy and as VTK array."""
+  return engineBytes(referencePolydata.GetNumberOfPoints(), referencePolydata.GetNumberOfPolys()) + 16 * int(pointCount)
+
+
+def addDistanceArray(polydata, distances):
+  """Return a shallow copy of ``polydata`` with ``distances`` as its active 'Distance' point scalars."""
+  import vtk
+  import vtk.util.numpy_support as vtk_np
+  output = vtk.vtkPolyData()
+  output.ShallowCopy(polydata)
+  array = vtk_np.numpy_to_vtk(np.ascontiguousarray(distances, dtype=np.float64), deep=True)
+  array.SetName(DISTANCE_ARRAY_NAME)
+  output.GetPointData().AddArray(array)
+  output.GetPointData().SetActiveScalars(DISTANCE_ARRAY_NAME)
+  return output
+
+
+def computeSignedDistanceVTK(polydata, referencePolydata):
+  """Signed distances using vtkDistancePolyDataFilter (reference implementation)."""
+  import vtk
+  distanceFilter = vtk.vtkDistancePolyDataFilter()
+  distanceFilter.SetInputData(0, polydata)
+  distanceFilter.SetInputData(1, referencePolydata)
+  distanceFilter.ComputeSecondDistanceOff()
+  distanceFilter.Update()
+  return distanceFilter.GetOutput()
+
+
+def computeSignedDistance(polydata, referencePolydata, referenceEngine=None, referenceGrid=None, stop=None):
+  """Return a copy of ``polydata`` with a 'Distance' point array holding the
+  signed distance of every vertex to the surface of ``referencePolydata``.
+
+  :param referenceEngine: optional SurfaceDistanceEngine already built for ``referencePolydata``
+  :param referenceGrid: optional sdf.SignedDistanceGrid of ``referencePolydata``. Distances are
+    interpolated from it where possible, the remaining points are computed exactly.
+  :param stop: optional cancellation check, see SurfaceDistanceEngine.signedDistance
+  """
+  if referenceGrid is not None:
+    import vtk.util.numpy_support as vtk_np
+    points = vtk_np.vtk_to_numpy(polydata.GetPoints().GetData())
+    distances, valid = referenceGrid.interpolate(points)
+    if not valid.all():
+      referenceEngine = referenceEngine or SurfaceDistanceEngine(referencePolydata)
+      distances[~valid] = referenceEngine.signedDistance(points[~valid], stop=stop)
+    return addDistanceArray(polydata, distances)
+  if referenceEngine is None:
+    if not kdTreeAvailable():
+      return computeSignedDistanceVTK(polydata, referencePolydata)
+    referenceEngine = SurfaceDistanceEngine(referencePolydata)
+  import vtk.util.numpy_support as vtk_np
+  points = vtk_np.vtk_to_numpy(polydata.GetPoints().GetData())
+  return addDistanceArray(polydata, referenceEngine.signedDistance(points, stop=stop))
+
+
+def computeSignedDistances(sourcePolydata, targetPolydata, progress=None, targetGrid=None, trace=None, stop=None):
+  """Signed distances in both directions between two aligned meshes.
+
+  :param progress: optional callable(stage, detail) invoked before each direction
+  :param targetGrid: optional precomputed sdf.SignedDistanceGrid of the target
+  :param trace: optional instrumentation.Trace that receives a record per direction
+  :param stop: optional cancellation check, see SurfaceDistanceEngine.signedDistance
+  :return: copies of source and target with a 'Distance' point array
+  """
+  if progress is not None:
+    progress("distances", "prepared")
+  with instrumentation.stage(trace, "distances", "prepared", points=sourcePolydata.GetNumberOfPoints(),
+      referenceTriangles=targetPolydata.GetNumberOfCells(), distanceGrid=targetGrid is not None,
+      allocatedBytes=16 * sourcePolydata.GetNumberOfPoints() if targetGrid is not None else signedDistanceBytes(sourcePolydata.GetNumberOfPoints(), targetPolydata)):
+    sourceWithDistance = computeSignedDistance(sourcePolydata, targetPolydata, referenceGrid=targetGrid, stop=stop)
+  if progress is not None:
+    progress("distances", "ideal")
+  with instrumentation.stage(trace, "distances", "ideal", points=targetPolydata.GetNumberOfPoints(),
+      referenceTriangles=sourcePolydata.GetNumberOfCells(), allocatedBytes=signedDistanceBytes(targetPolydata.GetNumberOfPoints(), sourcePolydata)):
+    targetWithDistance = computeSignedDistance(targetPolydata, sourcePolydata, stop=stop)
+  return sourceWithDistance, targetWithDistance
+
+
+def compareWithVTK(polydata, referencePolydata):
+  """Accuracy of SurfaceDistanceEngine relative to vtkDistancePolyDataFilter on one mesh pair."""
+  engineDistances = distanceArray(computeSignedDistance(polydata, referencePolydata))
+  vtkDistances = distanceArray(computeSignedDistanceVTK(polydata, referencePolydata))
+  difference = np.abs(engineDistances - vtkDistances)
+  return {
+    "maxAbsoluteDifference": float(difference.max()),
+    "meanAbsoluteDifference": float(difference.mean()),
+    "maxAbsoluteValueDifference": float(np.abs(np.abs(engineDistances) - np.abs(vtkDistances)).max()),
+    "signAgreement": float(np.mean(np.sign(engineDistances) == np.sign(vtkDistances))),
+    }
+
+
+def distanceArray(polydata):
+  """Return the 'Distance' point array of ``polydata`` as a numpy array."""
+  import vtk.util.numpy_support as vtk_np
+  array = polydata.GetPointData().GetArray(DISTANCE_ARRAY_NAME)
+  if array is None:
+    raise ValueError("Polydata has no '%s' point array" % DISTANCE_ARRAY_NAME)
+  return vtk_np.vtk_to_numpy(array)
+
+
+def summarizeDistances(distances, tolerance=0.0):
+  """Basic statistics of a signed distance array, as a flat dictionary."""
+  distances = np.asarray(distances, dtype=np.float64)
+  absolute = np.abs(distances)
+  return {
+    "count": int(distances.size),
+    "mean": float(distances.mean()),
+    "meanAbsolute": float(absolute.mean()),
+    "rms": float(np.sqrt(np.mean(distances**2))),
+    "min": float(distances.min()),
+    "max": float(distances.max()),
+    "percentile95": float(np.percentile(absolute, 95)),
+    "fractionAboveTolerance": float(np.count_nonzero(distances > tolerance))/distances.size,
+    "fractionBelowTolerance": float(np.count_nonzero(distances < -tolerance))/distances.size,
+    }
@@ -0,0 +1,409 @@
+"""Watch-folder ingestion: align prepared models as soon as they land in a directory.
+
+Example, from a shell::
+
+  PythonSlicer -m QuickModelAlignLib.ingest /lab/scans --ideal "molar*=ideal_molar.ply" --ideal "*=ideal.ply" \\
+    --queue ingest.sqlite --store results.sqlite -j 4
+
+The service polls the watched directory. A new prepared model is queued once its
+size and modification time have not changed between two polls, so that files the
+scanner is still writing are not read. Each file is paired with the ideal model of
+the first rule whose file name pattern matches it.
+
+Jobs are kept in a persistent queue (a SQLite file, ``JobQueue``), keyed by the
+SHA-256 of the prepared model and the ideal model: completed work is not redone
+after a restart, or when the same scan is copied again under another name. Jobs
+that were running when the service stopped are queued again.
+
+Jobs run the batch pipeline (batch.alignToIdeal: downsampling + FPFH, global
+registration, ICP, distances and metrics) in a bounded pool of worker processes,
+each keeping the ideal models it has preprocessed. Backpressure:
+
+- at most ``maxInFlight`` jobs are submitted to the pool, the others wait in the queue,
+- while more than ``maxQueued`` jobs wait, the directory is not scanned for new files.
+
+Failed jobs are retried up to ``maxAttempts`` times, with an exponentially growing
+delay. Results are added to the results store (store.ResultsStore). Queue depth and
+throughput are returned by ``IngestService.status``, logged, and written as JSON to
+``statusPath`` after each poll.
+"""
+import argparse
+import concurrent.futures
+import fnmatch
+import json
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import traceback
+
+from QuickModelAlignLib import batch
+from QuickModelAlignLib import cache
+from QuickModelAlignLib import parallel
+from QuickModelAlignLib import registration
+from QuickModelAlignLib import store
+
+
+JOB_STATES = ("queued", "running", "done", "failed")
+
+DEFAULT_POLL_SECONDS = 5.0
+DEFAULT_MAX_ATTEMPTS = 3
+# Delay before the first retry of a failed job, doubled for every further attempt
+DEFAULT_RETRY_DELAY_SECONDS = 30.0
+# Jobs completed within this window are used for the throughput
+THROUGHPUT_WINDOW_SECONDS = 600.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+  id INTEGER PRIMARY KEY,
+  prepared TEXT NOT NULL,
+  preparedSize INTEGER,
+  preparedMTime INTEGER,
+  preparedSHA256 TEXT NOT NULL,
+  ideal TEXT NOT NULL,
+  state TEXT NOT NULL,
+  attempts INTEGER NOT NULL DEFAULT 0,
+  error TEXT,
+  queued REAL NOT NULL,
+  notBefore REAL NOT NULL DEFAULT 0,
+  started REAL,
+  finished REAL,
+  UNIQUE (preparedSHA256, ideal)
+);
+CREATE INDEX IF NOT EXISTS jobsByState ON jobs (state, notBefore, id);
+CREATE INDEX IF NOT EXISTS jobsByFile ON jobs (prepared, preparedSize, preparedMTime);
+CREATE INDEX IF NOT EXISTS jobsByFinished ON jobs (finished);
+CREATE TABLE IF NOT EXISTS duplicateFiles (
+  path TEXT NOT NULL,
+  size INTEGER,
+  mtime INTEGER,
+  PRIMARY KEY (path, size, mtime)
+);
+"""
+
+
+class JobQueue:
+  """Persistent queue of (prepared, ideal) alignment jobs in a SQLite file."""
+
+  def __init__(self, path):
+    self.path = path
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    self.connection = sqlite3.connect(path)
+    self.connection.row_factory = sqlite3.Row
+    self.connection.execute("PRAGMA journal_mode=WAL")
+    with self.connection:
+      self.connection.executescript(_SCHEMA)
+
+  def close(self):
+    self.connection.close()
+
+  def isKnownFile(self, path, size, mtime):
+    """Whether a job was already created for this version of the file, or its content was already queued under another name."""
+    return self.connection.execute("SELECT 1 FROM jobs WHERE prepared = ? AND preparedSize = ? AND preparedMTime = ? "
+      "UNION ALL SELECT 1 FROM duplicateFiles WHERE path = ? AND size = ? AND mtime = ? LIMIT 1",
+      (path, size, mtime, path, size, mtime)).fetchone() is not None
+
+  def add(self, preparedPath, idealPath):
+    """Queue a job; returns its id, or None if this content was already queued against this ideal."""
+    stat = os.stat(preparedPath)
+    with self.connection:
+      cursor = self.connection.execute("INSERT OR IGNORE INTO jobs (prepared, preparedSize, preparedMTime, preparedSHA256, ideal, state, queued) "
+        "VALUES (?, ?, ?, ?, ?, 'queued', ?)", (preparedPath, stat.st_size, stat.st_mtime_ns, cache.fileHash(preparedPath), idealPath, time.time()))
+      if not cursor.rowcount:
+        # Recorded so that this version of the file is not hashed again by the next scans
+        self.connection.execute("INSERT OR IGNORE INTO duplicateFiles (path, size, mtime) VALUES (?, ?, ?)",
+          (preparedPath, stat.st_size, stat.st_mtime_ns))
+    return cursor.lastrowid if cursor.rowcount else None
+
+  def requeueInterrupted(self):
+    """Queue the jobs that were running when the previous service stopped. Returns their number."""
+    with self.connection:
+      return self.connection.execute("UPDATE jobs SET state = 'queued', started = NULL WHERE state = 'running'").rowcount
+
+  def take(self, limit):
+    """Mark up to ``limit`` queued jobs that are due as running, and return them (oldest first)."""
+    now = time.time()
+    with self.connection:
+      jobs = [dict(row) for row in self.connection.execute(
+        "SELECT * FROM jobs WHERE state = 'queued' AND notBefore <= ? ORDER BY id LIMIT ?", (now, int(limit)))]
+      self.connection.executemany("UPDATE jobs SET state = 'running', started = ?, attempts = attempts + 1 WHERE id = ?",
+        [(now, job["id"]) for job in jobs])
+    for job in jobs:
+      job["attempts"] += 1
+    return jobs
+
+  def release(self, jobIds):
+    """Queue taken jobs again without counting the attempt, e.g. when they could not be submitted."""
+    with self.connection:
+      self.connection.executemany("UPDATE jobs SET state = 'queued', started = NULL, attempts = attempts - 1 WHERE id = ?",
+        [(jobId,) for jobId in jobIds])
+
+  def finish(self, jobId):
+    with self.connection:
+      self.connection.execute("UPDATE jobs SET state = 'done', error = NULL, finished = ? WHERE id = ?", (time.time(), jobId))
+
+  def fail(self, jobId, error, retry, retryDelaySeconds=0.0):
+    """Record a failed attempt. With ``retry`` the job is queued again after ``retryDelaySeconds``."""
+    now = time.time()
+    with self.connection:
+      if retry:
+        self.connection.execute("UPDATE jobs SET state = 'queued', error = ?, notBefore = ? WHERE id = ?", (error, now + retryDelaySeconds, jobId))
+      else:
+        self.connection.execute("UPDATE jobs SET state = 'failed', error = ?, finished = ? WHERE id = ?", (error, now, jobId))
+
+  def counts(self):
+    """Number of jobs in each state."""
+    counts = dict.fromkeys(JOB_STATES, 0)
+    for state, count in self.connection.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state"):
+      counts[state] = count
+    return counts
+
+  def finishedSince(self, timestamp):
+    """Number of jobs done since ``timestamp`` and their mean duration."""
+    count, meanSeconds = self.connection.execute("SELECT COUNT(*), AVG(finished - started) FROM jobs WHERE state = 'done' AND finished >= ?",
+      (timestamp,)).fetchone()
+    return count, meanSeconds
+
+
+def parseIdealRules(specifications):
+  """(pattern, ideal path) rules from "PATTERN=PATH" strings; a plain path matches every file."""
+  rules = []
+  for specification in specifications:
+    pattern, separator, path = specification.partition("=")
+    rules.append((pattern, path) if separator else ("*", specification))
+  return rules
+
+
+def idealForFile(fileName, idealRules):
+  """Ideal model of the first rule whose pattern matches ``fileName``, or None."""
+  for pattern, idealPath in idealRules:
+    if fnmatch.fnmatch(fileName, pattern):
+      return idealPath
+  return None
+
+
+# Per worker-process state: IdealModel per ideal path, created on first use
+_workerIdeals = {}
+
+
+def _initializeWorker():
+  parallel.limitThreadsPerProcess()
+
+
+def _runJob(preparedPath, idealPath, parameters, cacheDirectory, skipScaling):
+  if idealPath not in _workerIdeals:
+    _workerIdeals[idealPath] = batch.IdealModel(idealPath, parameters, cacheDirectory)
+  try:
+    return batch.alignToIdeal(preparedPath, _workerIdeals[idealPath], skipScaling)
+  except Exception as e:
+    return {
+      "prepared": preparedPath,
+      "ideal": idealPath,
+      "status": "failed",
+      "error": "%s: %s" % (type(e).__name__, e),
+      "traceback": traceback.format_exc(),
+      }
+
+
+class IngestService:
+  """Watches a directory and aligns new prepared models in a pool of worker processes.
+
+  :param watchDirectory: directory the scanner writes prepared models to
+  :param idealRules: list of (file name pattern, ideal model path); the first match is used
+  :param queuePath: persistent job queue (SQLite file)
+  :param storePath: results store the results are added to (default: store.defaultStorePath())
+  :param workers: number of worker processes (default: number of CPU cores)
+  """
+
+  def __init__(self, watchDirectory, idealRules, queuePath, storePath=None, workers=None, parameters=None, skipScaling=True,
+      pattern="*.ply", cacheDirectory=None, pollSeconds=DEFAULT_POLL_SECONDS, maxAttempts=DEFAULT_MAX_ATTEMPTS,
+      retryDelaySeconds=DEFAULT_RETRY_DELAY_SECONDS, maxInFlight=None, maxQueued=1000, statusPath=None):
+    self.watchDirectory = watchDirectory
+    self.idealRules = list(idealRules)
+    self.idealPaths = {os.path.abspath(idealPath) for _, idealPath in self.idealRules}
+    self.queue = JobQueue(queuePath)
+    self.resultsStore = store.ResultsStore(storePath)
+    self.workers = workers or parallel.defaultWorkerCount()
+    self.parameters = registration.completeParameters(parameters)
+    self.skipScaling = skipScaling
+    self.pattern = pattern
+    self.cacheDirectory = cache.defaultCacheDirectory() if cacheDirectory is None else cacheDirectory
+    self.pollSeconds = pollSeconds
+    self.maxAttempts = maxAttempts
+    self.retryDelaySeconds = retryDelaySeconds
+    self.maxInFlight = maxInFlight or 2 * self.workers
+    self.maxQueued = maxQueued
+    self.statusPath = statusPath
+    self.startTime = time.time()
+    self.inFlight = {}
+    self._stopRequested = False
+    # (size, modification time) of files seen in the previous scan, not queued yet
+    self._pendingFiles = {}
+
+  def stop(self):
+    """Stop after the current poll (e.g. from a signal handler or another thread)."""
+    self._stopRequested = True
+
+  def scan(self):
+    """Queue the prepared models that appeared in the watched directory. Returns the number of new jobs."""
+    added = 0
+    currentFiles = {}
+    for entry in os.scandir(self.watchDirectory):
+      if not entry.is_file() or not fnmatch.fnmatch(entry.name, self.pattern) or os.path.abspath(entry.path) in self.idealPaths:
+        continue
+      stat = entry.stat()
+      fileVersion = (stat.st_size, stat.st_mtime_ns)
+      if self.queue.isKnownFile(entry.path, *fileVersion):
+        continue
+      idealPath = idealForFile(entry.name, self.idealRules)
+      if idealPath is None:
+        continue
+      if self._pendingFiles.get(entry.path) != fileVersion:
+        # New or still being written, queued once it is unchanged in the next scan
+        currentFiles[entry.path] = fileVersion
+        continue
+      if self.queue.add(entry.path, idealPath) is not None:
+        added += 1
+        logging.info(f"Queued {entry.path} against {idealPath}")
+    self._pendingFiles = currentFiles
+    return added
+
+  def _submit(self, executor):
+    jobs = self.queue.take(self.maxInFlight - len(self.inFlight))
+    for index, job in enumerate(jobs):
+      try:
+        future = executor.submit(_runJob, job["prepared"], job["ideal"], self.parameters, self.cacheDirectory, self.skipScaling)
+      except concurrent.futures.process.BrokenProcessPool:
+        # The jobs that did not reach the pool are submitted to the next one
+        self.queue.release([job["id"] for job in jobs[index:]])
+        raise
+      self.inFlight[future] = job
+
+  def _jobFailed(self, job, error):
+    retry = job["attempts"] < self.maxAttempts
+    self.queue.fail(job["id"], error, retry, self.retryDelaySeconds * 2**(job["attempts"] - 1))
+    logging.error(f"{job['prepared']} failed (attempt {job['attempts']} of {self.maxAttempts}"
+      f"{', will be retried' if retry else ''}): {error}")
+
+  def _collect(self, doneFutures):
+    results = []
+    for future in doneFutures:
+      job = self.inFlight.pop(future)
+      try:
+        result = future.result()
+      except Exception as e:
+        # The worker process died (e.g. out of memory)
+        self._jobFailed(job, "%s: %s" % (type(e).__name__, e))
+        continue
+      if result["status"] != "ok":
+        self._jobFailed(job, result["error"])
+        continue
+      self.queue.finish(job["id"])
+      results.append(result)
+      logging.info(f"Aligned {job['prepared']}")
+    if results:
+      self.resultsStore.addRuns(results, self.parameters, origin="ingest")
+
+  def status(self):
+    """Queue depth (jobs per state), jobs in the worker pool and throughput over the last minutes."""
+    windowStart = max(self.startTime, time.time() - THROUGHPUT_WINDOW_SECONDS)
+    finished, meanJobSeconds = self.queue.finishedSince(windowStart)
+    windowMinutes = max(time.time() - windowStart, 1.0) / 60.0
+    counts = self.queue.counts()
+    return {
+      "queueDepth": counts["queued"],
+      "jobs": counts,
+      "inFlight": len(self.inFlight),
+      "workers": self.workers,
+      "jobsPerMinute": finished / windowMinutes,
+      "meanJobSeconds": meanJobSeconds,
+      "scanning": counts["queued"] < self.maxQueued,
+      }
+
+  def _writeStatus(self, status):
+    if not self.statusPath:
+      return
+    # Written to a temporary file and renamed, so that monitors never read a partial file
+    fileHandle, temporaryPath = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.statusPath)), suffix=".tmp")
+    with os.fdopen(fileHandle, "w") as f:
+      json.dump(status, f, indent=2)
+    os.replace(temporaryPath, self.statusPath)
+
+  def run(self, stopWhenIdle=False):
+    """Process the watched directory until ``stop`` is called (or, with ``stopWhenIdle``, until no work is left)."""
+    requeued = self.queue.requeueInterrupted()
+    if requeued:
+      logging.info(f"Queued {requeued} interrupted jobs again")
+    logging.info(f"Watching {self.watchDirectory} with {self.workers} worker processes")
+    executor = None
+    try:
+      while not self._stopRequested:
+        if self.queue.counts()["queued"] < self.maxQueued:
+          self.scan()
+        if executor is None:
+          executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, mp_context=parallel.processContext(),
+            initializer=_initializeWorker)
+        try:
+          self._submit(executor)
+        except concurrent.futures.process.BrokenProcessPool:
+          executor = None
+        if self.inFlight:
+          doneFutures, _ = concurrent.futures.wait(self.inFlight, timeout=self.pollSeconds,
+            return_when=concurrent.futures.FIRST_COMPLETED)
+          self._collect(doneFutures)
+          if any(isinstance(future.exception(), concurrent.futures.process.BrokenProcessPool) for future in doneFutures):
+            # A crashed worker breaks the whole pool, the jobs still in it fail as well
+            self._collect(list(self.inFlight))
+            executor.shutdown(wait=False)
+            executor = None
+        else:
+          if stopWhenIdle and not self._pendingFiles and self.queue.counts()["queued"] == 0:
+            break
+          time.sleep(self.pollSeconds)
+        status = self.status()
+        self._writeStatus(status)
+        logging.debug("Ingest status: %s" % status)
+    finally:
+      if executor is not None:
+        executor.shutdown(wait=True, cancel_futures=True)
+      self.queue.close()
+      self.resultsStore.close()
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(prog="QuickModelAlignLib.ingest", description="Align prepared models as they are added to a directory.")
+  parser.add_argument("directory", help="directory the prepared models are written to")
+  parser.add_argument("--ideal", action="append", required=True, metavar="[PATTERN=]PATH",
+    help="ideal model for prepared models whose file name matches PATTERN (default: all); the first matching rule is used")
+  parser.add_argument("--queue", default=None, help="persistent job queue file (default: ingest.sqlite in the directory)")
+  parser.add_argument("--store", default=None, help="SQLite results store the results are added to (default: user data directory)")
+  parser.add_argument("--status", default=None, help="JSON file the queue depth and throughput are written to after each poll")
+  parser.add_argument("-j", "--workers", type=int, default=None, help="number of worker processes (default: number of CPU cores)")
+  parser.add_argument("-p", "--parameters", default=None, help="JSON file with registration parameters")
+  parser.add_argument("--pattern", default="*.ply", help="file name pattern of the prepared models")
+  parser.add_argument("--scaling", action="store_true", help="scale prepared models to the size of the ideal model")
+  parser.add_argument("--poll", type=float, default=DEFAULT_POLL_SECONDS, help="seconds between scans of the directory")
+  parser.add_argument("--max-attempts", type=int, default=DEFAULT_MAX_ATTEMPTS, help="attempts per job before it is marked as failed")
+  parser.add_argument("--max-queued", type=int, default=1000, help="stop scanning for new files while this many jobs are waiting")
+  parser.add_argument("--once", action="store_true", help="exit once all models in the directory are processed")
+  args = parser.parse_args(argv)
+
+  logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+  parameters = {}
+  if args.parameters:
+    with open(args.parameters) as f:
+      parameters = json.load(f)
+  service = IngestService(args.directory, parseIdealRules(args.ideal), args.queue or os.path.join(args.directory, "ingest.sqlite"),
+    args.store, args.workers, parameters, skipScaling=not args.scaling, pattern=args.pattern, pollSeconds=args.poll,
+    maxAttempts=args.max_attempts, maxQueued=args.max_queued, statusPath=args.status)
+  try:
+    service.run(stopWhenIdle=args.once)
+  except KeyboardInterrupt:
+    logging.info("Stopped, interrupted jobs are queued again at the next start")
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,134 @@
+"""Per-stage timing and memory instrumentation of pipeline runs.
+
+A Trace collects one record per pipeline stage, with:
+
+- ``stage`` and ``label`` (e.g. "downsample", "prepared"),
+- ``start``: seconds since the trace was created,
+- ``wallSeconds`` and ``cpuSeconds``: CPU time is process-wide, so stages that run
+  concurrently (source and target preprocessing) include each other's CPU time,
+- ``peakRSSBytes``: peak resident memory of the process at the end of the stage,
+- ``allocatedBytes`` (stages that create large buffers): bytes of the buffers the stage
+  allocates, including temporary copies. Their sum over a run bounds the memory the run
+  needs in addition to the loaded meshes, independently of what else the process holds,
+- stage specific fields, such as ``pointsBefore``/``pointsAfter`` of downsampling.
+
+Every record is also emitted as a log record of the "QuickModelAlign.trace" logger,
+with the record dictionary in its ``trace`` attribute, and the whole trace can be
+written as JSON. Functions of the pipeline take an optional ``trace`` argument and use
+``stage(trace, ...)``, which does nothing when no trace is given.
+"""
+import contextlib
+import json
+import logging
+import sys
+import threading
+import time
+from datetime import datetime
+
+
+logger = logging.getLogger("QuickModelAlign.trace")
+
+
+def peakRSSBytes():
+  """Peak resident set size of this process, or None if it cannot be determined."""
+  try:
+    import resource
+  except ImportError:
+    resource = None
+  if resource is not None:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return int(peak if sys.platform == "darwin" else peak * 1024)
+  try:
+    import psutil
+  except ImportError:
+    return None
+  memoryInfo = psutil.Process().memory_info()
+  return int(getattr(memoryInfo, "peak_wset", memoryInfo.rss))
+
+
+class Trace:
+  """Timing and memory records of the stages of one pipeline run. Thread safe."""
+
+  def __init__(self, name=""):
+    self.name = name
+    self.created = datetime.now().isoformat(timespec="seconds")
+    self.records = []
+    self._startTime = time.perf_counter()
+    self._lock = threading.Lock()
+
+  @contextlib.contextmanager
+  def stage(self, stage, label="", **fields):
+    """Context that records a stage. It yields the record, so that the stage can add
+    fields that are only known at its end (e.g. the number of points it produced)."""
+    record = {"stage": stage, "label": label}
+    record.update(fields)
+    startTime = time.perf_counter()
+    startCPUTime = time.process_time()
+    try:
+      yield record
+    finally:
+      record["start"] = startTime - self._startTime
+      record["wallSeconds"] = time.perf_counter() - startTime
+      record["cpuSeconds"] = time.process_time() - startCPUTime
+      record["peakRSSBytes"] = peakRSSBytes()
+      self.add(record)
+
+  def add(self, record):
+    with self._lock:
+      self.records.append(record)
+    logger.info("%s%s: %.3f s wall, %.3f s CPU", record["stage"], " (%s)" % record["label"] if record["label"] else "",
+      record["wallSeconds"], record["cpuSeconds"], extra={"trace": record})
+
+  def extend(self, trace):
+    """Append the records of another trace (a Trace or its toDict), e.g. from a background process."""
+    records = trace.records if isinstance(trace, Trace) else trace["records"]
+    with self._lock:
+      self.records.extend(records)
+
+  def stageSeconds(self):
+    """Total wall time of each stage, in the order the stages first appear."""
+    totals = {}
+    for record in self.records:
+      totals[record["stage"]] = totals.get(record["stage"], 0.0) + record["wallSeconds"]
+    return totals
+
+  def peakRSSBytes(self):
+    peaks = [record["peakRSSBytes"] for record in self.records if record.get("peakRSSBytes")]
+    return max(peaks) if peaks else None
+
+  def allocatedBytes(self):
+    """Total bytes allocated by the stages of the run."""
+    return sum(record.get("allocatedBytes", 0) for record in self.records)
+
+  def summary(self):
+    """Compact one-line-per-stage timing summary."""
+    lines = ["%-18s %7.2f s" % (stage, seconds) for stage, seconds in self.stageSeconds().items()]
+    allocated = self.allocatedBytes()
+    if allocated:
+      lines.append("%-18s %7.0f MB" % ("allocated", allocated / 1024**2))
+    peak = self.peakRSSBytes()
+    if peak:
+      lines.append("%-18s %7.0f MB" % ("peak memory", peak / 1024**2))
+    return "\n".join(lines)
+
+  def toDict(self):
+    return {
+      "name": self.name,
+      "created": self.created,
+      "stageSeconds": self.stageSeconds(),
+      "peakRSSBytes": self.peakRSSBytes(),
+      "allocatedBytes": self.allocatedBytes(),
+      "records": list(self.records),
+      }
+
+  def write(self, path):
+    with open(path, "w") as f:
+      json.dump(self.toDict(), f, indent=2)
+
+
+def stage(trace, stage, label="", **fields):
+  """``trace.stage(...)``, or a context that does nothing if ``trace`` is None."""
+  if trace is None:
+    return contextlib.nullcontext({})
+  return trace.stage(stage, label, **fields)
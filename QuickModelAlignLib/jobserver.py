@@ -0,0 +1,391 @@
+"""Local HTTP job API, so that lab stations without Slicer can submit comparisons to one workstation.
+
+Start it from a shell::
+
+  PythonSlicer -m QuickModelAlignLib.jobserver --port 8765 -j 4
+
+or from the Slicer Python console with ``QuickModelAlignLogic().startJobServer()``.
+The server only listens on localhost unless ``--host`` is given; with ``--token``,
+requests must send an ``Authorization: Bearer <token>`` header.
+
+Endpoints (JSON responses):
+
+- ``PUT /uploads?name=scan.ply``: upload a mesh file as the request body. The body is
+  streamed to disk. Returns ``{"upload": id, "bytes": n}``; identical files share an id.
+- ``POST /jobs`` with ``{"prepared": id, "ideal": id, "parameters": {...}, "skipScaling": true}``:
+  queue a comparison. ``parameters`` takes the entries of the module's advanced settings
+  (registration.DEFAULT_PARAMETERS); missing entries use the defaults. Returns ``{"id": jobId, ...}``
+  with status 202.
+- ``GET /jobs``: status of all jobs. ``GET /jobs/<id>``: status of one job, "queued",
+  "running", "done" or "failed" (with "error").
+- ``GET /jobs/<id>/result``: transform, scaling, registration quality and tolerance
+  statistics of a finished job (as batch.alignToIdeal).
+- ``GET /jobs/<id>/mesh/prepared`` and ``/mesh/ideal``: binary PLY of the aligned model,
+  decimated and coloured by distance as in the colour map mode.
+
+Jobs run in a pool of worker processes, so several comparisons run concurrently.
+If a worker process dies (e.g. killed when out of memory on a large scan), the jobs in
+the pool fail and a new pool is started for the next jobs. Each job has a folder with its job.json and result files; finished jobs are served
+again after a restart.
+"""
+import argparse
+import collections
+import concurrent.futures
+import hashlib
+import http.server
+import json
+import logging
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import urllib.parse
+import uuid
+
+from QuickModelAlignLib import batch
+from QuickModelAlignLib import cache
+from QuickModelAlignLib import parallel
+from QuickModelAlignLib import registration
+
+
+DEFAULT_PORT = 8765
+
+MESH_EXTENSIONS = (".ply", ".stl", ".obj", ".vtp", ".vtk")
+
+# Uploads larger than this are rejected
+DEFAULT_MAX_UPLOAD_BYTES = 2 * 1024**3
+
+STREAM_BLOCK_SIZE = 1024 * 1024
+
+# Ideal models kept preprocessed per worker process, for different ideal models or parameters
+WORKER_IDEAL_MODELS = 4
+
+
+def defaultJobsDirectory():
+  return os.path.join(tempfile.gettempdir(), "QuickModelAlign", "jobs")
+
+
+# Per worker-process state: least recently used preprocessed ideal models
+_workerIdeals = collections.OrderedDict()
+
+
+def _initializeWorker():
+  parallel.limitThreadsPerProcess()
+
+
+def _runJob(jobDirectory, preparedPath, idealPath, parameters, skipScaling, cacheDirectory):
+  key = (idealPath, json.dumps(parameters, sort_keys=True))
+  if key not in _workerIdeals:
+    _workerIdeals[key] = batch.IdealModel(idealPath, parameters, cacheDirectory)
+    if len(_workerIdeals) > WORKER_IDEAL_MODELS:
+      _workerIdeals.popitem(last=False)
+  _workerIdeals.move_to_end(key)
+  result = batch.alignToIdeal(preparedPath, _workerIdeals[key], skipScaling, displayDirectory=jobDirectory)
+  result.pop("trace")
+  return result
+
+
+class JobError(Exception):
+  """Invalid request, reported to the client with an HTTP status."""
+
+  def __init__(self, status, message):
+    Exception.__init__(self, message)
+    self.status = status
+
+
+class JobServer:
+  """Alignment jobs submitted over HTTP and run in a pool of worker processes.
+
+  :param jobsDirectory: folder of the uploads and of one subfolder per job
+  :param workers: number of worker processes, i.e. concurrently running jobs
+  :param token: if set, clients must send it as a bearer token
+  """
+
+  def __init__(self, jobsDirectory=None, host="127.0.0.1", port=DEFAULT_PORT, workers=None, token=None,
+      maxUploadBytes=DEFAULT_MAX_UPLOAD_BYTES, cacheDirectory=None):
+    self.jobsDirectory = jobsDirectory or defaultJobsDirectory()
+    self.uploadsDirectory = os.path.join(self.jobsDirectory, "uploads")
+    os.makedirs(self.uploadsDirectory, exist_ok=True)
+    self.workers = workers or parallel.defaultWorkerCount()
+    self.token = token
+    self.maxUploadBytes = maxUploadBytes
+    self.cacheDirectory = cache.defaultCacheDirectory() if cacheDirectory is None else cacheDirectory
+    self.jobs = {}
+    self.futures = {}
+    self.lock = threading.Lock()
+    self.executor = self._newExecutor()
+    self._loadJobs()
+    self.httpServer = http.server.ThreadingHTTPServer((host, port), _RequestHandler)
+    self.httpServer.daemon_threads = True
+    self.httpServer.jobServer = self
+    self._thread = None
+
+  @property
+  def url(self):
+    host, port = self.httpServer.server_address[:2]
+    return f"http://{host}:{port}"
+
+  def start(self):
+    """Serve requests in a background thread."""
+    self._thread = threading.Thread(target=self.httpServer.serve_forever, daemon=True)
+    self._thread.start()
+    logging.info(f"QuickModelAlign job server listening on {self.url}")
+
+  def serveForever(self):
+    self.httpServer.serve_forever()
+
+  def stop(self):
+    self.httpServer.shutdown()
+    self.httpServer.server_close()
+    self.executor.shutdown(wait=False, cancel_futures=True)
+
+  def _newExecutor(self):
+    return concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, mp_context=parallel.processContext(),
+      initializer=_initializeWorker)
+
+  def _replaceBrokenExecutor(self, executor):
+    """Start a new worker pool if ``executor`` is the current one; called with the lock held."""
+    if executor is self.executor:
+      logging.warning("A job server worker process died, starting a new worker pool")
+      executor.shutdown(wait=False)
+      self.executor = self._newExecutor()
+
+  def _loadJobs(self):
+    """Jobs of previous sessions; those that had not finished are marked as failed."""
+    for name in os.listdir(self.jobsDirectory):
+      jobPath = os.path.join(self.jobsDirectory, name, "job.json")
+      if not os.path.isfile(jobPath):
+        continue
+      with open(jobPath) as f:
+        job = json.load(f)
+      if job["state"] in ("queued", "running"):
+        job.update(state="failed", error="The job server was stopped before the job finished")
+        self._writeJob(job)
+      self.jobs[job["id"]] = job
+
+  def _writeJob(self, job):
+    jobPath = os.path.join(self.jobsDirectory, job["id"], "job.json")
+    with open(jobPath + ".tmp", "w") as f:
+      json.dump(job, f, indent=2)
+    os.replace(jobPath + ".tmp", jobPath)
+
+  def uploadPath(self, uploadId):
+    if not re.fullmatch(r"[0-9a-f]{64}\.[a-z]+", uploadId or "") or not os.path.isfile(os.path.join(self.uploadsDirectory, uploadId)):
+      raise JobError(400, f"Unknown upload: {uploadId}")
+    return os.path.join(self.uploadsDirectory, uploadId)
+
+  def storeUpload(self, stream, length, name):
+    """Copy ``length`` bytes of ``stream`` to the uploads folder, block by block. Returns the upload id."""
+    extension = os.path.splitext(name or "")[1].lower()
+    if extension not in MESH_EXTENSIONS:
+      raise JobError(400, f"Unsupported mesh file name: {name!r}, expected one of {', '.join(MESH_EXTENSIONS)}")
+    if length > self.maxUploadBytes:
+      raise JobError(413, f"Upload of {length} bytes exceeds the limit of {self.maxUploadBytes} bytes")
+    digest = hashlib.sha256()
+    fileHandle, temporaryPath = tempfile.mkstemp(dir=self.uploadsDirectory, suffix=".part")
+    try:
+      with os.fdopen(fileHandle, "wb") as f:
+        remaining = length
+        while remaining > 0:
+          block = stream.read(min(STREAM_BLOCK_SIZE, remaining))
+          if not block:
+            raise JobError(400, "Upload ended before Content-Length bytes were received")
+          digest.update(block)
+          f.write(block)
+          remaining -= len(block)
+      uploadId = digest.hexdigest() + extension
+      os.replace(temporaryPath, os.path.join(self.uploadsDirectory, uploadId))
+    except BaseException:
+      if os.path.exists(temporaryPath):
+        os.remove(temporaryPath)
+      raise
+    return uploadId
+
+  def submit(self, preparedPath, idealPath, parameters=None, skipScaling=True):
+    """Queue a comparison of two mesh files. Returns the job status."""
+    if parameters is not None and not isinstance(parameters, dict):
+      raise JobError(400, "parameters must be a JSON object")
+    unknown = sorted(set(parameters or {}) - set(registration.DEFAULT_PARAMETERS))
+    if unknown:
+      raise JobError(400, f"Unknown parameters: {', '.join(unknown)}")
+    parameters = registration.completeParameters(parameters)
+    jobId = uuid.uuid4().hex
+    jobDirectory = os.path.join(self.jobsDirectory, jobId)
+    os.makedirs(jobDirectory)
+    job = {
+      "id": jobId,
+      "state": "queued",
+      "prepared": preparedPath,
+      "ideal": idealPath,
+      "parameters": parameters,
+      "skipScaling": bool(skipScaling),
+      "submitted": time.time(),
+      }
+    with self.lock:
+      self.jobs[jobId] = job
+      self._writeJob(job)
+      arguments = (_runJob, jobDirectory, preparedPath, idealPath, parameters, bool(skipScaling), self.cacheDirectory)
+      try:
+        future = self.executor.submit(*arguments)
+      except concurrent.futures.process.BrokenProcessPool:
+        self._replaceBrokenExecutor(self.executor)
+        future = self.executor.submit(*arguments)
+      executor = self.executor
+      self.futures[jobId] = future
+    future.add_done_callback(lambda future, jobId=jobId, executor=executor: self._jobDone(jobId, future, executor))
+    return self.status(jobId)
+
+  def _jobDone(self, jobId, future, executor):
+    with self.lock:
+      job = self.jobs[jobId]
+      job["finished"] = time.time()
+      try:
+        result = future.result()
+      except Exception as e:
+        if isinstance(e, concurrent.futures.process.BrokenProcessPool):
+          # Otherwise every later submit would fail until the server is restarted
+          self._replaceBrokenExecutor(executor)
+        job.update(state="failed", error="%s: %s" % (type(e).__name__, e))
+        logging.error(f"Job {jobId} failed:\n" + "".join(traceback.format_exception(type(e), e, e.__traceback__)))
+      else:
+        with open(os.path.join(self.jobsDirectory, jobId, "result.json"), "w") as f:
+          json.dump(result, f, indent=2)
+        job["state"] = "done"
+      self._writeJob(job)
+      del self.futures[jobId]
+
+  def status(self, jobId):
+    with self.lock:
+      if jobId not in self.jobs:
+        raise JobError(404, f"Unknown job: {jobId}")
+      status = {name: value for name, value in self.jobs[jobId].items() if name != "parameters"}
+      future = self.futures.get(jobId)
+    if future is not None and future.running():
+      status["state"] = "running"
+    return status
+
+  def statuses(self):
+    with self.lock:
+      jobIds = list(self.jobs)
+    return [self.status(jobId) for jobId in jobIds]
+
+  def result(self, jobId):
+    status = self.status(jobId)
+    if status["state"] == "failed":
+      raise JobError(409, f"Job {jobId} failed: {status['error']}")
+    if status["state"] != "done":
+      raise JobError(409, f"Job {jobId} is {status['state']}")
+    with open(os.path.join(self.jobsDirectory, jobId, "result.json")) as f:
+      return json.load(f)
+
+  def meshPath(self, jobId, model):
+    if model not in ("prepared", "ideal"):
+      raise JobError(404, f"Unknown model: {model}")
+    self.result(jobId)
+    return os.path.join(self.jobsDirectory, jobId, model + ".ply")
+
+
+class _RequestHandler(http.server.BaseHTTPRequestHandler):
+
+  protocol_version = "HTTP/1.1"
+
+  def log_message(self, format, *args):
+    logging.debug("%s %s" % (self.address_string(), format % args))
+
+  def _sendJSON(self, status, content):
+    body = json.dumps(content, indent=2).encode()
+    self.send_response(status)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def _sendFile(self, path):
+    self.send_response(200)
+    self.send_header("Content-Type", "application/octet-stream")
+    self.send_header("Content-Length", str(os.path.getsize(path)))
+    self.send_header("Content-Disposition", f'attachment; filename="{os.path.basename(path)}"')
+    self.end_headers()
+    with open(path, "rb") as f:
+      shutil.copyfileobj(f, self.wfile, STREAM_BLOCK_SIZE)
+
+  def _handle(self, method):
+    jobServer = self.server.jobServer
+    try:
+      if jobServer.token and self.headers.get("Authorization") != f"Bearer {jobServer.token}":
+        raise JobError(401, "Missing or invalid token")
+      url = urllib.parse.urlsplit(self.path)
+      parts = [part for part in url.path.split("/") if part]
+      if method == "PUT" and parts == ["uploads"]:
+        name = urllib.parse.parse_qs(url.query).get("name", [""])[0]
+        length = int(self.headers.get("Content-Length") or 0)
+        uploadId = jobServer.storeUpload(self.rfile, length, name)
+        self._sendJSON(201, {"upload": uploadId, "bytes": length})
+      elif method == "POST" and parts == ["jobs"]:
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+          request = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+          raise JobError(400, "Request body is not valid JSON")
+        if not isinstance(request, dict):
+          raise JobError(400, "Request body must be a JSON object")
+        status = jobServer.submit(jobServer.uploadPath(request.get("prepared")), jobServer.uploadPath(request.get("ideal")),
+          request.get("parameters"), request.get("skipScaling", True))
+        self._sendJSON(202, status)
+      elif method == "GET" and parts == ["jobs"]:
+        self._sendJSON(200, jobServer.statuses())
+      elif method == "GET" and len(parts) == 2 and parts[0] == "jobs":
+        self._sendJSON(200, jobServer.status(parts[1]))
+      elif method == "GET" and len(parts) == 3 and parts[0] == "jobs" and parts[2] == "result":
+        self._sendJSON(200, jobServer.result(parts[1]))
+      elif method == "GET" and len(parts) == 4 and parts[0] == "jobs" and parts[2] == "mesh":
+        self._sendFile(jobServer.meshPath(parts[1], parts[3]))
+      else:
+        raise JobError(404, f"No such endpoint: {method} {url.path}")
+    except JobError as e:
+      # Unread request bodies would be taken for the next request of the connection
+      self.close_connection = True
+      self._sendJSON(e.status, {"error": str(e)})
+    except Exception as e:
+      logging.error(traceback.format_exc())
+      self.close_connection = True
+      self._sendJSON(500, {"error": "%s: %s" % (type(e).__name__, e)})
+
+  def do_GET(self):
+    self._handle("GET")
+
+  def do_POST(self):
+    self._handle("POST")
+
+  def do_PUT(self):
+    self._handle("PUT")
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(prog="QuickModelAlignLib.jobserver", description="Serve QuickModelAlign comparisons over HTTP.")
+  parser.add_argument("--host", default="127.0.0.1", help="address to listen on (default: localhost only; 0.0.0.0 for all interfaces)")
+  parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="port to listen on")
+  parser.add_argument("--jobs-dir", default=None, help="folder of uploads and job results")
+  parser.add_argument("-j", "--workers", type=int, default=None, help="number of worker processes (default: number of CPU cores)")
+  parser.add_argument("--token", default=os.environ.get("QUICKMODELALIGN_TOKEN"), help="bearer token clients must send (default: $QUICKMODELALIGN_TOKEN)")
+  parser.add_argument("--cache-dir", default=None, help="feature cache directory (default: user cache directory)")
+  args = parser.parse_args(argv)
+
+  logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+  jobServer = JobServer(args.jobs_dir, args.host, args.port, args.workers, args.token, cacheDirectory=args.cache_dir)
+  logging.info(f"QuickModelAlign job server listening on {jobServer.url}")
+  try:
+    jobServer.serveForever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    jobServer.stop()
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,132 @@
+"""Tolerance statistics of a comparison, fast enough to update while the tolerance slider moves.
+
+Distances are sorted once together with per-vertex area weights, and the cumulative
+sums of area and area*distance are stored. The area and volume beyond any tolerance
+are then found with a binary search instead of a pass over the mesh.
+
+Sign convention (as the 'Distance' arrays): positive distances on the prepared
+model mean it lies outside the ideal surface (excess material, under-prepared),
+negative distances mean it lies inside (deficient material, over-prepared).
+"""
+import csv
+import json
+
+import numpy as np
+
+from QuickModelAlignLib import distance
+
+
+def vertexAreas(vertices, triangles):
+  """Area associated with each vertex: one third of the area of each adjacent triangle."""
+  triangleAreas = np.empty(len(triangles))
+  # Corners are gathered in blocks to bound the temporary memory on large meshes
+  for start in range(0, len(triangles), distance.TRIANGLE_BLOCK_SIZE):
+    corners = vertices[triangles[start:start+distance.TRIANGLE_BLOCK_SIZE]]
+    triangleAreas[start:start+len(corners)] = 0.5 * np.linalg.norm(np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0]), axis=1)
+  triangleAreas /= 3.0
+  areas = np.zeros(len(vertices))
+  for corner in range(3):
+    areas += np.bincount(triangles[:, corner], weights=triangleAreas, minlength=len(vertices))
+  return areas
+
+
+def comparisonBytes(sourcePolydata, targetPolydata):
+  """Bytes allocated by ComparisonMetrics.fromPolyData: for each mesh a float64 vertex copy,
+  vertex and triangle areas, and the sorted and cumulative arrays of SortedDistances."""
+  return sum(88 * int(polydata.GetNumberOfPoints()) + 8 * int(polydata.GetNumberOfPolys()) for polydata in (sourcePolydata, targetPolydata))
+
+
+class SortedDistances:
+  """Area weighted distances of one mesh, sorted for threshold queries."""
+
+  def __init__(self, distances, areas):
+    distances = np.asarray(distances, dtype=np.float64)
+    areas = np.asarray(areas, dtype=np.float64)
+    order = np.argsort(distances, kind="stable")
+    self.sorted = distances[order]
+    sortedAreas = areas[order]
+    # Leading zero so that sums over [i, n) are cumulative[n] - cumulative[i]
+    self.cumulativeArea = np.concatenate([[0.0], np.cumsum(sortedAreas)])
+    self.cumulativeAreaDistance = np.concatenate([[0.0], np.cumsum(sortedAreas * self.sorted)])
+    self.totalArea = self.cumulativeArea[-1]
+
+    absoluteOrder = np.argsort(np.abs(distances), kind="stable")
+    self.sortedAbsolute = np.abs(distances[absoluteOrder])
+    self.cumulativeAbsoluteArea = np.cumsum(areas[absoluteOrder])
+    self.rms = float(np.sqrt(np.sum(areas * distances**2) / self.totalArea)) if self.totalArea else 0.0
+    self.maximumAbsolute = float(self.sortedAbsolute[-1]) if len(self.sortedAbsolute) else 0.0
+
+  def areaAbove(self, threshold):
+    """Area and area*distance integral of the vertices with distance > threshold."""
+    index = np.searchsorted(self.sorted, threshold, side="right")
+    return (self.totalArea - self.cumulativeArea[index],
+      self.cumulativeAreaDistance[-1] - self.cumulativeAreaDistance[index])
+
+  def areaBelow(self, threshold):
+    """Area and area*distance integral of the vertices with distance < threshold."""
+    index = np.searchsorted(self.sorted, threshold, side="left")
+    return self.cumulativeArea[index], self.cumulativeAreaDistance[index]
+
+  def absolutePercentile(self, percent):
+    """Area weighted percentile of the absolute distance."""
+    if not len(self.sortedAbsolute):
+      return 0.0
+    index = np.searchsorted(self.cumulativeAbsoluteArea, self.totalArea * percent / 100.0, side="left")
+    return float(self.sortedAbsolute[min(index, len(self.sortedAbsolute) - 1)])
+
+
+class ComparisonMetrics:
+  """Tolerance statistics of a prepared (source) model compared to an ideal (target) model."""
+
+  def __init__(self, sourceDistances, sourceAreas, targetDistances, targetAreas):
+    self.source = SortedDistances(sourceDistances, sourceAreas)
+    self.target = SortedDistances(targetDistances, targetAreas)
+    self.percentile95 = self.source.absolutePercentile(95)
+    self.hausdorff = max(self.source.maximumAbsolute, self.target.maximumAbsolute)
+
+  @classmethod
+  def fromPolyData(cls, sourcePolydata, targetPolydata):
+    """Metrics of two meshes that have 'Distance' point arrays."""
+    areas = []
+    for polydata in (sourcePolydata, targetPolydata):
+      vertices, triangles = distance.trianglesFromPolyData(polydata)
+      areas.append(vertexAreas(vertices, triangles))
+    return cls(distance.distanceArray(sourcePolydata), areas[0], distance.distanceArray(targetPolydata), areas[1])
+
+  def summary(self, tolerance):
+    """All statistics for the given error tolerance (mm) as a flat dictionary."""
+    excessArea, excessIntegral = self.source.areaAbove(tolerance)
+    deficientArea, deficientIntegral = self.source.areaBelow(-tolerance)
+    totalArea = self.source.totalArea or 1.0
+    return {
+      "tolerance": float(tolerance),
+      "surfaceArea": float(self.source.totalArea),
+      "underPreparedAreaPercent": float(100.0 * excessArea / totalArea),
+      "overPreparedAreaPercent": float(100.0 * deficientArea / totalArea),
+      "excessVolume": float(excessIntegral),
+      "deficientVolume": float(-deficientIntegral),
+      "rms": self.source.rms,
+      "percentile95": self.percentile95,
+      "hausdorff": self.hausdorff,
+      }
+
+  def formatSummary(self, tolerance):
+    summary = self.summary(tolerance)
+    return "\n".join([
+      "Under-prepared (> %(tolerance).2f mm): %(underPreparedAreaPercent).1f %% of surface, %(excessVolume).3f mm³",
+      "Over-prepared (< -%(tolerance).2f mm): %(overPreparedAreaPercent).1f %% of surface, %(deficientVolume).3f mm³",
+      "RMS: %(rms).3f mm   95th percentile: %(percentile95).3f mm   Hausdorff: %(hausdorff).3f mm",
+      ]) % summary
+
+  def export(self, path, tolerance, extraFields=None):
+    """Write the summary to a .json file, or a one-row .csv file for any other extension."""
+    summary = dict(extraFields or {})
+    summary.update(self.summary(tolerance))
+    if path.lower().endswith(".json"):
+      with open(path, "w") as f:
+        json.dump(summary, f, indent=2)
+      return
+    with open(path, "w", newline="") as f:
+      writer = csv.DictWriter(f, fieldnames=list(summary))
+      writer.writeheader()
+      writer.writerow(summary)
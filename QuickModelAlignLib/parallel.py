@@ -0,0 +1,76 @@
+"""Helpers for running pipeline work in worker processes."""
+import ctypes
+import multiprocessing
+import os
+import sys
+
+from QuickModelAlignLib import distance
+
+
+def defaultWorkerCount():
+  return max(1, (os.cpu_count() or 1))
+
+
+def pythonExecutable():
+  """Interpreter that worker processes are started with.
+
+  Inside the Slicer application ``sys.executable`` is the application itself, so
+  workers have to be started with the bundled PythonSlicer launcher instead.
+  """
+  slicer = sys.modules.get("slicer")
+  if slicer is not None and hasattr(slicer, "app"):
+    launcherName = "PythonSlicer.exe" if os.name == "nt" else "PythonSlicer"
+    launcher = os.path.join(slicer.app.slicerHome, "bin", launcherName)
+    if os.path.isfile(launcher):
+      return launcher
+  return sys.executable
+
+
+def processContext():
+  """Spawn-based multiprocessing context that works both inside and outside Slicer."""
+  context = multiprocessing.get_context("spawn")
+  context.set_executable(pythonExecutable())
+  return context
+
+
+def limitThreadsPerProcess(threads=1):
+  """Keep each worker process single-threaded (or at ``threads`` threads) so that N
+  workers use N cores (N * threads).
+
+  Must be called before open3d/numpy spin up their thread pools, i.e. from a
+  pool initializer. The distance computations of the process are limited as well
+  (see distance.setWorkerLimit), as they use Python threads rather than OpenMP.
+  """
+  for variable in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"):
+    os.environ[variable] = str(int(threads))
+  distance.setWorkerLimit(threads)
+
+
+def processThreads():
+  """Threads this process may use: the limit set by limitThreadsPerProcess, or the number of CPU cores."""
+  return distance.workerCount()
+
+
+# OpenMP runtimes open3d is built with (GCC, LLVM, Intel, MSVC)
+_OPENMP_LIBRARIES = ("libgomp.so.1", "libomp.so", "libiomp5.so", "libomp.dylib", "libiomp5.dylib", "vcomp140.dll", "libiomp5md.dll")
+
+
+def setOpenMPThreads(threads):
+  """Limit the OpenMP parallel regions started from the calling thread to ``threads`` threads.
+
+  omp_set_num_threads sets a per-thread value, so concurrent Python threads that each
+  run an OpenMP-parallel open3d function can share the cores instead of each starting
+  one OpenMP thread per core. Only runtimes already loaded in the process (i.e. after
+  open3d is imported) are changed. Returns whether an OpenMP runtime was found; open3d
+  builds that parallelize with TBB instead are not limited.
+  """
+  found = False
+  for name in _OPENMP_LIBRARIES:
+    try:
+      library = ctypes.CDLL(name, mode=getattr(os, "RTLD_NOLOAD", 0))
+      setNumThreads = library.omp_set_num_threads
+    except (OSError, AttributeError):
+      continue
+    setNumThreads(ctypes.c_int(max(1, int(threads))))
+    found = True
+  return found
@@ -0,0 +1,857 @@
+"""Point-cloud based rigid registration (ALPACA style: FPFH + RANSAC + ICP).
+
+These are the Slicer-independent counterparts of the QuickModelAlignLogic
+methods of the same name; the logic delegates to them so that the GUI and the
+headless tools run exactly the same pipeline.
+
+The global (coarse) registration engine is selected with the
+``globalRegistrationEngine`` parameter, one of GLOBAL_REGISTRATION_ENGINES:
+
+- "RANSAC": feature matching RANSAC limited by ``maxRANSAC`` iterations and
+  ``RANSACConfidence``, and optionally by a wall-clock ``globalRegistrationTimeBudget``.
+  With a time budget, RANSAC is repeated until ``RANSACPatience`` consecutive runs bring
+  no improvement.
+- "FGR": Fast Global Registration on the same FPFH features.
+
+A non-negative ``randomSeed`` makes the result repeatable, where the installed
+open3d supports seeding its random generator (``open3d.utility.random``). The pinned
+open3d 0.14.1 (dependencies.REQUIRED_OPEN3D_VERSION) does not: there the seed is
+ignored, with a warning logged once per process.
+
+With ``multiStartRuns`` above 1, that many RANSAC registrations (plus one FGR
+registration if ``multiStartFGR`` is set or FGR is the engine) run concurrently,
+sharing the ``maxRANSAC`` iterations. Each candidate is refined with a short ICP
+and the best by fitness, then inlier RMSE, is kept. Once a candidate reaches
+``multiStartStopFitness`` the other RANSAC runs stop at their next round. This
+guards against a single run ending in a wrong pose (e.g. on symmetric teeth).
+
+With ``fastPath`` set, ICP is first tried from a few cheap initial transforms
+(the last accepted transform, identity, centroid and principal axes alignment).
+Its result replaces the global registration if its fitness and inlier RMSE pass
+``fastPathMinimumFitness`` and ``fastPathMaximumRMSE``; otherwise the global
+registration engine runs as usual.
+
+The result is refined with a coarse-to-fine ICP pyramid: one level per entry of
+``ICPLevels`` (multiples of the downsampling voxel size), each stopping after
+``ICPMaxIterations`` iterations or when fitness and inlier RMSE change less than
+``ICPRelativeFitness`` and ``ICPRelativeRMSE``. These three may be single values or
+one value per level. ``ICPEstimator`` selects point-to-plane or generalized ICP.
+"""
+import concurrent.futures
+import logging
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+from QuickModelAlignLib import instrumentation
+from QuickModelAlignLib import parallel
+
+
+# Defaults of the "Advanced settings" panel of the module widget
+DEFAULT_PARAMETERS = {
+  "projectionFactor": 1,
+  "pointDensity": 0.8,
+  "errorToleranceValue": 0.15,
+  "normalSearchRadius": 2,
+  "FPFHSearchRadius": 5,
+  "distanceThreshold": 1.5,
+  "maxRANSAC": 4000000,
+  "RANSACConfidence": 0.999,
+  "globalRegistrationEngine": "RANSAC",
+  "globalRegistrationTimeBudget": 0,
+  "RANSACPatience": 2,
+  "randomSeed": -1,
+  "multiStartRuns": 1,
+  "multiStartFGR": False,
+  "multiStartStopFitness": 0.95,
+  "multiStartICPIterations": 10,
+  "fastPath": False,
+  "fastPathMinimumFitness": 0.95,
+  "fastPathMaximumRMSE": 0.5,
+  "ICPDistanceThreshold": 0.4,
+  "ICPLevels": (4, 2, 1),
+  "ICPMaxIterations": 30,
+  "ICPRelativeFitness": 1e-6,
+  "ICPRelativeRMSE": 1e-6,
+  "ICPEstimator": "pointToPlane",
+  "alpha": 2,
+  "beta": 2,
+  "CPDIterations": 100,
+  "CPDTolerence": 0.001,
+  "useDistanceGrid": False,
+  }
+
+GLOBAL_REGISTRATION_ENGINES = ("RANSAC", "FGR")
+
+# Initial transforms tried by the fast path, in this order
+FAST_PATH_INITIALIZATIONS = ("last", "identity", "centroid", "PCA")
+
+ICP_ESTIMATORS = ("pointToPlane", "generalized")
+
+# Iterations per RANSAC run when a time budget is set; the budget is checked between runs
+RANSAC_ROUND_ITERATIONS = 20000
+
+# 33 float64 FPFH histogram bins per point
+FPFH_BYTES_PER_POINT = 33 * 8
+
+
+def completeParameters(parameters=None):
+  """Return a copy of ``parameters`` with missing entries filled from DEFAULT_PARAMETERS."""
+  completed = dict(DEFAULT_PARAMETERS)
+  if parameters:
+    completed.update(parameters)
+  return completed
+
+
+def readPolyData(path):
+  """Read a surface mesh file into a vtkPolyData, in the coordinate system stored in the file."""
+  import vtk
+  extension = os.path.splitext(path)[1].lower()
+  readers = {
+    ".ply": vtk.vtkPLYReader,
+    ".stl": vtk.vtkSTLReader,
+    ".obj": vtk.vtkOBJReader,
+    ".vtp": vtk.vtkXMLPolyDataReader,
+    ".vtk": vtk.vtkPolyDataReader,
+    }
+  if extension not in readers:
+    raise ValueError(f"Unsupported mesh file format: {path}")
+  if not os.path.isfile(path):
+    raise IOError(f"Mesh file not found: {path}")
+  reader = readers[extension]()
+  reader.SetFileName(path)
+  reader.Update()
+  polydata = reader.GetOutput()
+  if polydata is None or polydata.GetNumberOfPoints() == 0:
+    raise IOError(f"Failed to read mesh file: {path}")
+  return polydata
+
+
+def pointsFromPolyData(polydata):
+  """Return the points of ``polydata`` as a numpy array sharing memory with the VTK array."""
+  import vtk.util.numpy_support as vtk_np
+  return vtk_np.vtk_to_numpy(polydata.GetPoints().GetData())
+
+
+def makePointCloud(points, scaling=1.0, trace=None, label=""):
+  """open3d point cloud of ``points`` (N x 3), scaled by ``scaling`` about the origin.
+
+  open3d keeps its own float64 copy of the points, and assigning the points copies them
+  into the cloud: the conversion allocates twice that size (three times for float32 input,
+  which is cast first).
+  """
+  from open3d import geometry
+  from open3d import utility
+  points = np.asarray(points)
+  allocatedBytes = 2 * pointCloudBytes(len(points)) + (0 if points.dtype == np.float64 else pointCloudBytes(len(points)))
+  with instrumentation.stage(trace, "pointCloud", label, points=len(points), allocatedBytes=allocatedBytes):
+    pcd = geometry.PointCloud()
+    pcd.points = utility.Vector3dVector(np.asarray(points, dtype=np.float64))
+    if scaling != 1:
+      pcd.scale(scaling, center=(0, 0, 0))
+  return pcd
+
+
+def pointCloudBytes(pointCount):
+  """Memory of N float64 3D vectors (points or normals) of an open3d point cloud."""
+  return 24 * int(pointCount)
+
+
+def computeVoxelSize(targetPoints, pointDensity):
+  """Voxel size used for downsampling, derived from the diagonal of the target bounding box."""
+  targetPoints = np.asarray(targetPoints)
+  targetSize = np.linalg.norm(targetPoints.max(axis=0) - targetPoints.min(axis=0))
+  return targetSize/(55*pointDensity)
+
+
+def computeScaling(sourcePoints, targetPoints, skipScaling):
+  if skipScaling != 0:
+    return 1
+  sourcePoints = np.asarray(sourcePoints)
+  targetPoints = np.asarray(targetPoints)
+  sourceSize = np.linalg.norm(sourcePoints.max(axis=0) - sourcePoints.min(axis=0))
+  targetSize = np.linalg.norm(targetPoints.max(axis=0) - targetPoints.min(axis=0))
+  return targetSize/sourceSize
+
+
+def preprocessedToArrays(pcd_down, pcd_fpfh):
+  """Arrays holding a downsampled point cloud with normals and its FPFH features."""
+  return {
+    "points": np.asarray(pcd_down.points),
+    "normals": np.asarray(pcd_down.normals),
+    "features": np.asarray(pcd_fpfh.data),
+    }
+
+
+def preprocessedFromArrays(points, normals, features):
+  """Inverse of preprocessedToArrays: rebuild the open3d point cloud and Feature objects."""
+  from open3d import pipelines
+  from open3d import utility
+  pcd_down = makePointCloud(points)
+  pcd_down.normals = utility.Vector3dVector(np.asarray(normals, dtype=np.float64))
+  pcd_fpfh = pipelines.registration.Feature()
+  pcd_fpfh.data = np.asarray(features, dtype=np.float64)
+  return pcd_down, pcd_fpfh
+
+
+def preprocessTarget(targetPoints, parameters, targetPath=None, cache=None, progress=None, trace=None):
+  """Downsample the target and compute its FPFH features, using ``cache`` when possible.
+
+  The cache is only used when the mesh file ``targetPath`` is known, since entries
+  are keyed by file content.
+
+  :return: target_down, target_fpfh, voxel_size
+  """
+  key = None
+  if cache is not None and targetPath:
+    with instrumentation.stage(trace, "cacheLoad", "ideal") as record:
+      key = cache.key(targetPath, parameters)
+      entry = cache.load(key)
+      record["hit"] = entry is not None
+      if entry is not None:
+        # The arrays, and the point cloud and features built from them
+        record["allocatedBytes"] = 2 * sum(int(np.asarray(value).nbytes) for value in entry.values())
+    if entry is not None:
+      target_down, target_fpfh = preprocessedFromArrays(entry["points"], entry["normals"], entry["features"])
+      return target_down, target_fpfh, float(entry["voxelSize"])
+  voxel_size = computeVoxelSize(targetPoints, parameters["pointDensity"])
+  target_down, target_fpfh = preprocess_point_cloud(makePointCloud(targetPoints, trace=trace, label="ideal"), voxel_size, parameters["normalSearchRadius"], parameters["FPFHSearchRadius"],
+    progress, "ideal", trace)
+  if key is not None:
+    cache.store(key, voxelSize=np.float64(voxel_size), **preprocessedToArrays(target_down, target_fpfh))
+  return target_down, target_fpfh, voxel_size
+
+
+def runSubsample(sourcePoints, targetPoints, skipScaling, parameters, targetPath=None, cache=None, progress=None, trace=None):
+  """Downsample both point sets and compute their normals and FPFH features.
+
+  The source points are scaled to the size of the target unless ``skipScaling``
+  is set. The input arrays are not modified; callers that keep the full
+  resolution source mesh must apply the returned scaling to it themselves.
+  The target preprocessing is read from ``cache`` if the target file ``targetPath``
+  has been preprocessed with the same parameters before. Source and target are
+  independent and are preprocessed concurrently.
+
+  :return: source_down, target_down, source_fpfh, target_fpfh, voxel_size, scaling
+  """
+  voxel_size = computeVoxelSize(targetPoints, parameters["pointDensity"])
+  scaling = computeScaling(sourcePoints, targetPoints, skipScaling)
+  source = makePointCloud(sourcePoints, scaling, trace, "prepared")
+  with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+    targetFuture = executor.submit(preprocessTarget, targetPoints, parameters, targetPath, cache, progress, trace)
+    sourceFuture = executor.submit(preprocess_point_cloud, source, voxel_size, parameters["normalSearchRadius"], parameters["FPFHSearchRadius"],
+      progress, "prepared", trace)
+    source_down, source_fpfh = sourceFuture.result()
+    target_down, target_fpfh, voxel_size = targetFuture.result()
+  return source_down, target_down, source_fpfh, target_fpfh, voxel_size, scaling
+
+
+def _reportProgress(progress, stage, detail=""):
+  if progress is not None:
+    progress(stage, detail)
+
+
+def preprocess_point_cloud(pcd, voxel_size, radius_normal_factor, radius_feature_factor, progress=None, label="", trace=None):
+  from open3d import geometry
+  from open3d import pipelines
+  registration = pipelines.registration
+  _reportProgress(progress, "downsample", label)
+  with instrumentation.stage(trace, "downsample", label, voxelSize=float(voxel_size), pointsBefore=len(pcd.points)) as record:
+    pcd_down = pcd.voxel_down_sample(voxel_size)
+    record["pointsAfter"] = len(pcd_down.points)
+    record["allocatedBytes"] = pointCloudBytes(len(pcd_down.points))
+  radius_normal = voxel_size * radius_normal_factor
+  _reportProgress(progress, "normals", label)
+  with instrumentation.stage(trace, "normals", label, radius=float(radius_normal), points=len(pcd_down.points),
+      allocatedBytes=pointCloudBytes(len(pcd_down.points))):
+    pcd_down.estimate_normals(
+        geometry.KDTreeSearchParamHybrid(radius=radius_normal, max_nn=30))
+  radius_feature = voxel_size * radius_feature_factor
+  _reportProgress(progress, "FPFH", label)
+  with instrumentation.stage(trace, "FPFH", label, radius=float(radius_feature), points=len(pcd_down.points),
+      allocatedBytes=FPFH_BYTES_PER_POINT * len(pcd_down.points)):
+    pcd_fpfh = registration.compute_fpfh_feature(
+        pcd_down,
+        geometry.KDTreeSearchParamHybrid(radius=radius_feature, max_nn=100))
+  return pcd_down, pcd_fpfh
+
+
+def execute_global_registration(source_down, target_down, source_fpfh,
+                              target_fpfh, voxel_size, distance_threshold_factor, maxIter, confidence, skipScaling):
+  from open3d import pipelines
+  registration = pipelines.registration
+  distance_threshold = voxel_size * distance_threshold_factor
+  result = registration.registration_ransac_based_on_feature_matching(
+      source_down, target_down, source_fpfh, target_fpfh, True,
+      distance_threshold,
+      registration.TransformationEstimationPointToPoint(False),
+      3, [
+          registration.CorrespondenceCheckerBasedOnEdgeLength(
+              0.9),
+          registration.CorrespondenceCheckerBasedOnDistance(
+              distance_threshold)
+      ], registration.RANSACConvergenceCriteria(int(maxIter), float(confidence)))
+  return result
+
+
+def execute_fast_global_registration(source_down, target_down, source_fpfh,
+                                     target_fpfh, voxel_size, distance_threshold_factor):
+  from open3d import pipelines
+  registration = pipelines.registration
+  distance_threshold = voxel_size * distance_threshold_factor
+  result = registration.registration_fgr_based_on_feature_matching(
+      source_down, target_down, source_fpfh, target_fpfh,
+      registration.FastGlobalRegistrationOption(
+          maximum_correspondence_distance=distance_threshold))
+  return result
+
+
+# Whether the missing seeding support of the installed open3d has been reported
+_seedingWarningLogged = False
+
+
+def seedRandomGenerator(seed):
+  """Seed the open3d random generator. Negative seeds and None leave it unseeded.
+
+  open3d versions without ``utility.random`` (such as the pinned 0.14.1) ignore the seed.
+  """
+  global _seedingWarningLogged
+  if seed is None or seed < 0:
+    return
+  from open3d import utility
+  if hasattr(utility, "random"):
+    utility.random.seed(int(seed))
+  elif not _seedingWarningLogged:
+    logging.warning("open3d %s does not support seeding, randomSeed is ignored and global registration is not repeatable"
+      % getattr(sys.modules.get("open3d"), "__version__", ""))
+    _seedingWarningLogged = True
+
+
+def seedingSupported():
+  """Whether the installed open3d can seed its random generator (see seedRandomGenerator)."""
+  from open3d import utility
+  return hasattr(utility, "random")
+
+
+class GlobalRegistrationResult:
+  """Outcome of a global registration engine.
+
+  Fitness and inlier RMSE are evaluated with the same correspondence distance
+  for every engine, so that the results of different engines are comparable.
+  """
+
+  def __init__(self, engine, transformation, fitness, inlierRMSE, seconds, runs=1, starts=1):
+    self.engine = engine
+    self.transformation = np.asarray(transformation)
+    self.fitness = float(fitness)
+    self.inlierRMSE = float(inlierRMSE)
+    self.seconds = float(seconds)
+    self.runs = runs
+    self.starts = starts
+
+  def summary(self):
+    return {
+      "engine": self.engine,
+      "fitness": self.fitness,
+      "inlierRMSE": self.inlierRMSE,
+      "seconds": self.seconds,
+      "runs": self.runs,
+      "starts": self.starts,
+      }
+
+
+def _isBetterRegistration(result, best):
+  return best is None or (result.fitness, -result.inlier_rmse) > (best.fitness, -best.inlier_rmse)
+
+
+def _budgetedRANSAC(source_down, target_down, source_fpfh, target_fpfh, voxel_size, parameters, skipScaling, stopRequested=None,
+                    patience=None):
+  """RANSAC within ``globalRegistrationTimeBudget`` seconds (no time limit if it is 0).
+
+  RANSAC is run repeatedly with RANSAC_ROUND_ITERATIONS iterations and the best result is
+  kept, until the budget or ``maxRANSAC`` iterations are used up, ``patience`` consecutive
+  runs bring no improvement or ``stopRequested()`` returns True. A run that starts within the
+  budget is completed.
+
+  :param patience: defaults to the ``RANSACPatience`` parameter
+
+  :return: best open3d RegistrationResult, number of runs
+  """
+  timeBudget = float(parameters["globalRegistrationTimeBudget"])
+  deadline = time.perf_counter() + timeBudget if timeBudget > 0 else np.inf
+  remainingIterations = int(parameters["maxRANSAC"])
+  seed = parameters["randomSeed"]
+  if patience is None:
+    patience = max(1, int(parameters["RANSACPatience"]))
+  best = None
+  runs = 0
+  runsWithoutImprovement = 0
+  while remainingIterations > 0 and runsWithoutImprovement < patience:
+    if runs and stopRequested is not None and stopRequested():
+      break
+    if seed is not None and seed >= 0:
+      seedRandomGenerator(seed + runs)
+    iterations = min(RANSAC_ROUND_ITERATIONS, remainingIterations)
+    result = execute_global_registration(source_down, target_down, source_fpfh, target_fpfh, voxel_size,
+      parameters["distanceThreshold"], iterations, parameters["RANSACConfidence"], skipScaling)
+    remainingIterations -= iterations
+    runs += 1
+    if _isBetterRegistration(result, best):
+      best = result
+      runsWithoutImprovement = 0
+    else:
+      runsWithoutImprovement += 1
+    if time.perf_counter() >= deadline:
+      break
+  return best, runs
+
+
+def _multiStartCandidate(engine, source_down, target_down, source_fpfh, target_fpfh, voxel_size, skipScaling, parameters, stopRequested,
+                         openMPThreads):
+  from open3d import pipelines
+  registration = pipelines.registration
+  parallel.setOpenMPThreads(openMPThreads)
+  startTime = time.perf_counter()
+  runs = 1
+  if engine == "FGR":
+    result = execute_fast_global_registration(source_down, target_down, source_fpfh, target_fpfh, voxel_size,
+      parameters["distanceThreshold"])
+  else:
+    # Each start gives up after one round without improvement, the other starts cover the rest
+    result, runs = _budgetedRANSAC(source_down, target_down, source_fpfh, target_fpfh, voxel_size, parameters, skipScaling, stopRequested,
+      patience=1)
+  # Short ICP at the correspondence distance of the global registration, so that candidates are compared on refined poses
+  refined = registration.registration_icp(source_down, target_down, voxel_size * parameters["distanceThreshold"], result.transformation,
+    registration.TransformationEstimationPointToPlane(),
+    registration.ICPConvergenceCriteria(max_iteration=int(parameters["multiStartICPIterations"])))
+  return {
+    "engine": engine,
+    "fitness": float(refined.fitness),
+    "inlierRMSE": float(refined.inlier_rmse),
+    "runs": runs,
+    "seconds": time.perf_counter() - startTime,
+    "result": refined,
+    }
+
+
+def multiStartGlobalRegistration(source_down, target_down, source_fpfh, target_fpfh, voxel_size, skipScaling, parameters):
+  """Several global registrations in parallel threads, each refined with a short ICP.
+
+  ``multiStartRuns`` RANSAC runs share the ``maxRANSAC`` iterations, so that the total
+  work matches a single run; an FGR run is added if ``multiStartFGR`` is set or FGR is the
+  selected engine. open3d releases the GIL during registration, so the runs use separate
+  cores. RANSAC is itself OpenMP-parallel in open3d 0.14.1, so each run is limited to its
+  share of the cores of the process (parallel.setOpenMPThreads) rather than every run
+  starting one thread per core; builds that use TBB instead share its single pool. All runs draw from the open3d random generator, which is seeded once with
+  ``randomSeed``; since the runs interleave, the result is not exactly repeatable.
+
+  :return: best candidate, all candidates (dictionaries with "engine", "fitness", "inlierRMSE",
+    "runs", "seconds" and the refined open3d RegistrationResult under "result")
+  """
+  parameters = completeParameters(parameters)
+  starts = int(parameters["multiStartRuns"])
+  engines = ["RANSAC"] * starts
+  if parameters["multiStartFGR"] or parameters["globalRegistrationEngine"] == "FGR":
+    engines.append("FGR")
+  startParameters = dict(parameters, maxRANSAC=max(1, -(-int(parameters["maxRANSAC"]) // starts)), randomSeed=-1)
+  seedRandomGenerator(parameters["randomSeed"])
+  openMPThreads = max(1, parallel.processThreads() // len(engines))
+  stopEvent = threading.Event()
+  candidates = []
+  with concurrent.futures.ThreadPoolExecutor(max_workers=len(engines)) as executor:
+    futures = [executor.submit(_multiStartCandidate, engine, source_down, target_down, source_fpfh, target_fpfh, voxel_size, skipScaling,
+      startParameters, stopEvent.is_set, openMPThreads) for engine in engines]
+    try:
+      for future in concurrent.futures.as_completed(futures):
+        candidate = future.result()
+        candidates.append(candidate)
+        if candidate["fitness"] >= parameters["multiStartStopFitness"]:
+          # Good enough: the other RANSAC runs stop after their current round
+          stopEvent.set()
+    finally:
+      stopEvent.set()
+  best = max(candidates, key=lambda candidate: (candidate["fitness"], -candidate["inlierRMSE"]))
+  logging.info("Multi-start global registration: best of %d starts (%s), fitness %.3f, inlier RMSE %.4f" % (
+    len(candidates), best["engine"], best["fitness"], best["inlierRMSE"]))
+  return best, candidates
+
+
+def globalRegistration(source_down, target_down, source_fpfh, target_fpfh, voxel_size, skipScaling, parameters, trace=None):
+  """Coarse registration with the engine selected by ``parameters["globalRegistrationEngine"]``.
+
+  :return: GlobalRegistrationResult
+  """
+  from open3d import pipelines
+  parameters = completeParameters(parameters)
+  engine = parameters["globalRegistrationEngine"]
+  if engine not in GLOBAL_REGISTRATION_ENGINES:
+    raise ValueError(f"Unknown global registration engine: {engine}")
+  with instrumentation.stage(trace, "globalRegistration", engine, sourcePoints=len(source_down.points),
+      targetPoints=len(target_down.points)) as record:
+    startTime = time.perf_counter()
+    runs = 1
+    starts = 1
+    if parameters["multiStartRuns"] > 1:
+      best, candidates = multiStartGlobalRegistration(source_down, target_down, source_fpfh, target_fpfh, voxel_size, skipScaling, parameters)
+      result = best["result"]
+      # The best candidate may come from the added FGR run
+      engine = best["engine"]
+      runs = sum(candidate["runs"] for candidate in candidates)
+      starts = len(candidates)
+      record["starts"] = [{name: value for name, value in candidate.items() if name != "result"} for candidate in candidates]
+    elif engine == "FGR":
+      seedRandomGenerator(parameters["randomSeed"])
+      result = execute_fast_global_registration(source_down, target_down, source_fpfh, target_fpfh, voxel_size,
+        parameters["distanceThreshold"])
+    elif parameters["globalRegistrationTimeBudget"] > 0:
+      result, runs = _budgetedRANSAC(source_down, target_down, source_fpfh, target_fpfh, voxel_size, parameters, skipScaling)
+    else:
+      seedRandomGenerator(parameters["randomSeed"])
+      result = execute_global_registration(source_down, target_down, source_fpfh, target_fpfh, voxel_size,
+        parameters["distanceThreshold"], parameters["maxRANSAC"], parameters["RANSACConfidence"], skipScaling)
+    seconds = time.perf_counter() - startTime
+    evaluation = pipelines.registration.evaluate_registration(source_down, target_down,
+      voxel_size * parameters["distanceThreshold"], result.transformation)
+    globalResult = GlobalRegistrationResult(engine, result.transformation, evaluation.fitness, evaluation.inlier_rmse, seconds, runs, starts)
+    record.update(fitness=globalResult.fitness, inlierRMSE=globalResult.inlierRMSE, runs=runs)
+  logging.info("Global registration (%s): fitness %.3f, inlier RMSE %.4f, %.2f seconds" % (
+    engine, globalResult.fitness, globalResult.inlierRMSE, globalResult.seconds))
+  return globalResult
+
+
+def compareGlobalRegistrationEngines(source_down, target_down, source_fpfh, target_fpfh, voxel_size, skipScaling, parameters,
+                                     engines=GLOBAL_REGISTRATION_ENGINES):
+  """Run each of ``engines`` on the same input and return their GlobalRegistrationResult summaries."""
+  summaries = []
+  for engine in engines:
+    engineParameters = dict(parameters, globalRegistrationEngine=engine)
+    summaries.append(globalRegistration(source_down, target_down, source_fpfh, target_fpfh, voxel_size, skipScaling,
+      engineParameters).summary())
+  return summaries
+
+
+def refine_registration(source, target, source_fpfh, target_fpfh, voxel_size, result_ransac, ICPThreshold_factor):
+  from open3d import pipelines
+  registration = pipelines.registration
+  distance_threshold = voxel_size * ICPThreshold_factor
+  result = registration.registration_icp(
+      source, target, distance_threshold, result_ransac.transformation,
+      registration.TransformationEstimationPointToPlane())
+  return result
+
+
+class WarmStart:
+  """State carried from one registration to the next against the same ideal model."""
+
+  def __init__(self):
+    # Final transform of the last registration, tried first by the fast path
+    self.lastTransform = None
+    # Duration of the last global registration, the reference for the time saved by the fast path
+    self.globalRegistrationSeconds = None
+
+  def record(self, report, transformation):
+    self.lastTransform = np.asarray(transformation)
+    fastPath = report.get("fastPath")
+    if not (fastPath and fastPath["accepted"]):
+      self.globalRegistrationSeconds = report["globalRegistration"]["seconds"]
+
+
+def initialTransformCandidates(sourcePoints, targetPoints, lastTransform=None, initializations=FAST_PATH_INITIALIZATIONS):
+  """Cheap initial transforms of the source onto the target, as (name, 4x4 matrix) pairs.
+
+  "PCA" aligns the principal axes of the point sets. The axes directions are ambiguous,
+  so it yields the four proper rotations that map one set of axes onto the other.
+  """
+  sourcePoints = np.asarray(sourcePoints)
+  targetPoints = np.asarray(targetPoints)
+  sourceCenter = sourcePoints.mean(axis=0)
+  targetCenter = targetPoints.mean(axis=0)
+  for initialization in initializations:
+    if initialization == "last":
+      if lastTransform is not None:
+        yield "last", np.asarray(lastTransform, dtype=np.float64)
+    elif initialization == "identity":
+      yield "identity", np.eye(4)
+    elif initialization == "centroid":
+      transform = np.eye(4)
+      transform[:3, 3] = targetCenter - sourceCenter
+      yield "centroid", transform
+    elif initialization == "PCA":
+      # Eigenvectors as columns, sorted by increasing eigenvalue
+      sourceAxes = np.linalg.eigh(np.cov((sourcePoints - sourceCenter).T))[1]
+      targetAxes = np.linalg.eigh(np.cov((targetPoints - targetCenter).T))[1]
+      handedness = np.linalg.det(sourceAxes) * np.linalg.det(targetAxes)
+      for flips in ((1, 1, 1), (1, -1, -1), (-1, 1, -1), (-1, -1, 1)):
+        flips = np.array(flips) * (1, 1, handedness)
+        rotation = targetAxes @ np.diag(flips) @ sourceAxes.T
+        transform = np.eye(4)
+        transform[:3, :3] = rotation
+        transform[:3, 3] = targetCenter - rotation @ sourceCenter
+        yield "PCA", transform
+    else:
+      raise ValueError(f"Unknown initial transform: {initialization}")
+
+
+def fastPathRegistration(source_down, target_down, voxel_size, parameters, lastTransform=None, trace=None):
+  """Try ICP from the initial transforms of initialTransformCandidates.
+
+  The first result whose fitness and inlier RMSE (evaluated with the global
+  registration distance threshold) pass the fast path thresholds is accepted.
+
+  :return: accepted GlobalRegistrationResult or None, the list of attempts, and the time spent
+  """
+  from open3d import pipelines
+  registration = pipelines.registration
+  distance_threshold = voxel_size * parameters["distanceThreshold"]
+  maximumRMSE = voxel_size * parameters["fastPathMaximumRMSE"]
+  startTime = time.perf_counter()
+  attempts = []
+  for initialization, initialTransform in initialTransformCandidates(source_down.points, target_down.points, lastTransform):
+    with instrumentation.stage(trace, "fastPath", initialization, points=len(source_down.points)) as record:
+      result = registration.registration_icp(source_down, target_down, distance_threshold, initialTransform,
+        registration.TransformationEstimationPointToPlane())
+      record.update(fitness=float(result.fitness), inlierRMSE=float(result.inlier_rmse))
+    accepted = result.fitness >= parameters["fastPathMinimumFitness"] and result.inlier_rmse <= maximumRMSE
+    attempts.append({
+      "initialization": initialization,
+      "fitness": float(result.fitness),
+      "inlierRMSE": float(result.inlier_rmse),
+      "accepted": bool(accepted),
+      })
+    if accepted:
+      seconds = time.perf_counter() - startTime
+      return GlobalRegistrationResult("fast path (%s)" % initialization, result.transformation, result.fitness, result.inlier_rmse,
+        seconds, len(attempts)), attempts, seconds
+  return None, attempts, time.perf_counter() - startTime
+
+
+def _levelParameter(value, level):
+  """Value of a pyramid parameter given either for all levels or as one value per level."""
+  if isinstance(value, (list, tuple)):
+    return value[min(level, len(value) - 1)]
+  return value
+
+
+def _downsampleLevel(pcd, voxel_size):
+  level = pcd.voxel_down_sample(voxel_size)
+  if level.has_normals():
+    # Averaged normals are not unit length
+    level.normalize_normals()
+  return level
+
+
+def _runICP(source, target, distance_threshold, transformation, estimator, maxIterations, relativeFitness, relativeRMSE):
+  """ICP of one level in a single open3d call, stopped by ICPConvergenceCriteria.
+
+  open3d does not report how many iterations were run, so they are estimated from the
+  time of the call and of one correspondence search (evaluate_registration at the result),
+  which dominates the cost of an iteration.
+
+  :return: open3d RegistrationResult, estimated number of iterations
+  """
+  from open3d import pipelines
+  registration = pipelines.registration
+  criteria = registration.ICPConvergenceCriteria(relative_fitness=relativeFitness, relative_rmse=relativeRMSE, max_iteration=maxIterations)
+  startTime = time.perf_counter()
+  if estimator == "generalized":
+    result = registration.registration_generalized_icp(source, target, distance_threshold, transformation,
+      registration.TransformationEstimationForGeneralizedICP(), criteria)
+  else:
+    result = registration.registration_icp(source, target, distance_threshold, transformation,
+      registration.TransformationEstimationPointToPlane(), criteria)
+  icpSeconds = time.perf_counter() - startTime
+  startTime = time.perf_counter()
+  registration.evaluate_registration(source, target, distance_threshold, result.transformation)
+  iterationSeconds = time.perf_counter() - startTime
+  estimatedIterations = int(round(icpSeconds / iterationSeconds)) if iterationSeconds > 0 else maxIterations
+  return result, min(max(estimatedIterations, 1), maxIterations)
+
+
+def multiScaleICP(source, target, voxel_size, initialTransformation, parameters, progress=None, trace=None):
+  """Refine ``initialTransformation`` with ICP at progressively finer voxel sizes.
+
+  Levels with a voxel size multiple above 1 work on further downsampled copies of
+  ``source`` and ``target``. The correspondence distance of each level is
+  ``ICPDistanceThreshold`` times its voxel size.
+
+  :return: open3d RegistrationResult of the finest level, and a list with the
+    voxel size, estimated iterations, seconds, fitness and inlier RMSE of each level
+  """
+  from open3d import pipelines
+  estimator = parameters["ICPEstimator"]
+  if estimator not in ICP_ESTIMATORS:
+    raise ValueError(f"Unknown ICP estimator: {estimator}")
+  if estimator == "generalized" and not hasattr(pipelines.registration, "registration_generalized_icp"):
+    raise RuntimeError("Generalized ICP is not available in this open3d version")
+  factors = parameters["ICPLevels"]
+  transformation = np.asarray(initialTransformation)
+  levels = []
+  for index, factor in enumerate(factors):
+    _reportProgress(progress, "ICP", "level %d/%d" % (index + 1, len(factors)))
+    with instrumentation.stage(trace, "ICP", "level %d" % (index + 1)) as record:
+      startTime = time.perf_counter()
+      levelVoxelSize = voxel_size * factor
+      if factor > 1:
+        levelSource = _downsampleLevel(source, levelVoxelSize)
+        levelTarget = _downsampleLevel(target, levelVoxelSize)
+      else:
+        levelSource, levelTarget = source, target
+      distance_threshold = levelVoxelSize * parameters["ICPDistanceThreshold"]
+      result, estimatedIterations = _runICP(levelSource, levelTarget, distance_threshold, transformation, estimator,
+        int(_levelParameter(parameters["ICPMaxIterations"], index)),
+        float(_levelParameter(parameters["ICPRelativeFitness"], index)),
+        float(_levelParameter(parameters["ICPRelativeRMSE"], index)))
+      transformation = result.transformation
+      level = {
+        "voxelSize": float(levelVoxelSize),
+        "points": len(levelSource.points),
+        "estimatedIterations": estimatedIterations,
+        "seconds": time.perf_counter() - startTime,
+        "fitness": float(result.fitness),
+        "inlierRMSE": float(result.inlier_rmse),
+        }
+      record.update(level)
+    levels.append(level)
+  return result, levels
+
+
+def registerPointClouds(sourcePoints, targetPoints, sourceFeatures, targetFeatures, voxelSize, skipScaling, parameters, progress=None,
+                        report=None, warmStart=None, trace=None):
+  """Global registration (or the fast path, if enabled) followed by multi-scale ICP.
+  Returns the open3d RegistrationResult of the finest ICP level.
+
+  :param report: optional dictionary that receives the summary of the global registration
+    under the key "globalRegistration", of the fast path under "fastPath" and the
+    ICP levels under "ICP"
+  :param warmStart: WarmStart of previous registrations against the same target, used
+    by the fast path and updated with the result
+  :param trace: optional instrumentation.Trace that receives the stage records
+  """
+  parameters = completeParameters(parameters)
+  if report is None:
+    report = {}
+  lastTransform = warmStart.lastTransform if warmStart else None
+  referenceGlobalSeconds = warmStart.globalRegistrationSeconds if warmStart else None
+  coarse = None
+  if parameters["fastPath"]:
+    _reportProgress(progress, "ICP", "fast path")
+    coarse, attempts, fastPathSeconds = fastPathRegistration(sourcePoints, targetPoints, voxelSize, parameters, lastTransform, trace)
+    accepted = coarse is not None
+  if coarse is None:
+    _reportProgress(progress, "RANSAC", parameters["globalRegistrationEngine"])
+    coarse = globalRegistration(sourcePoints, targetPoints, sourceFeatures, targetFeatures, voxelSize, skipScaling, parameters, trace)
+  report["globalRegistration"] = coarse.summary()
+  if parameters["fastPath"]:
+    if accepted:
+      secondsSaved = referenceGlobalSeconds - fastPathSeconds if referenceGlobalSeconds else None
+    else:
+      # The rejected attempts only cost time
+      secondsSaved = -fastPathSeconds
+    report["fastPath"] = {
+      "accepted": accepted,
+      "path": coarse.engine,
+      "attempts": attempts,
+      "seconds": fastPathSeconds,
+      "secondsSaved": secondsSaved,
+      }
+  # Refine the initial registration using an Iterative Closest Point (ICP) registration
+  icp, report["ICP"] = multiScaleICP(sourcePoints, targetPoints, voxelSize, coarse.transformation, parameters, progress, trace)
+  if warmStart is not None:
+    warmStart.record(report, icp.transformation)
+  return icp
+
+
+def estimateTransform(sourcePoints, targetPoints, sourceFeatures, targetFeatures, voxelSize, skipScaling, parameters):
+  icp = registerPointClouds(sourcePoints, targetPoints, sourceFeatures, targetFeatures, voxelSize, skipScaling, parameters)
+  return icp.transformation
+
+
+def transformPolyData(polydata, matrix):
+  """Return a transformed copy of ``polydata``. ``matrix`` is a 4x4 numpy array or vtkMatrix4x4."""
+  import vtk
+  transform = vtk.vtkTransform()
+  if isinstance(matrix, vtk.vtkMatrix4x4):
+    transform.SetMatrix(matrix)
+  else:
+    transform.SetMatrix(np.asarray(matrix, dtype=float).ravel().tolist())
+  transformFilter = vtk.vtkTransformPolyDataFilter()
+  transformFilter.SetTransform(transform)
+  transformFilter.SetInputData(polydata)
+  transformFilter.Update()
+  return transformFilter.GetOutput()
+
+
+def scalePolyData(polydata, scaling):
+  """Scale the points of ``polydata`` in place about the origin."""
+  if scaling == 1:
+    return
+  points = pointsFromPolyData(polydata)
+  points *= scaling
+  polydata.GetPoints().GetData().Modified()
+
+
+# Slicer displays models in RAS coordinates, the models and the registration are in LPS
+RAS_TO_LPS = np.diag([-1.0, -1.0, 1.0, 1.0])
+
+# Rows transformed at once by transformPointsInPlace, bounds its temporary memory
+TRANSFORM_CHUNK_SIZE = 65536
+
+
+def scalingMatrix(scaling):
+  """4x4 matrix of a uniform scaling about the origin."""
+  return np.diag([scaling, scaling, scaling, 1.0])
+
+
+def composeTransforms(*matrices):
+  """Single 4x4 matrix equivalent to applying ``matrices`` one after the other (the first one first)."""
+  composed = np.eye(4)
+  for matrix in matrices:
+    composed = np.asarray(matrix, dtype=np.float64) @ composed
+  return composed
+
+
+def transformPointsInPlace(points, matrix):
+  """Apply the 4x4 ``matrix`` to the N x 3 array ``points`` in place.
+
+  Works on blocks of TRANSFORM_CHUNK_SIZE rows, so that a view of a VTK point array can
+  be transformed without a copy of the whole array.
+  """
+  matrix = np.asarray(matrix, dtype=np.float64)
+  linear, translation = matrix[:3, :3], matrix[:3, 3]
+  if np.count_nonzero(linear - np.diag(np.diagonal(linear))) == 0:
+    # Scaling and axis flips: elementwise, no temporaries at all
+    points *= np.diagonal(linear).astype(points.dtype)
+    if translation.any():
+      points += translation.astype(points.dtype)
+    return points
+  for start in range(0, len(points), TRANSFORM_CHUNK_SIZE):
+    block = points[start:start + TRANSFORM_CHUNK_SIZE]
+    block[:] = block @ linear.T + translation
+  return points
+
+
+def transformPolyDataInPlace(polydata, matrix):
+  """Apply the 4x4 ``matrix`` to the points and point normals of ``polydata`` in place.
+
+  In place counterpart of transformPolyData: one pass over the points, no copy of the mesh.
+  """
+  matrix = np.asarray(matrix, dtype=np.float64)
+  if np.array_equal(matrix, np.eye(4)):
+    return polydata
+  transformPointsInPlace(pointsFromPolyData(polydata), matrix)
+  polydata.GetPoints().GetData().Modified()
+  normalsArray = polydata.GetPointData().GetNormals()
+  if normalsArray is not None:
+    import vtk.util.numpy_support as vtk_np
+    normals = vtk_np.vtk_to_numpy(normalsArray)
+    normalMatrix = np.eye(4)
+    normalMatrix[:3, :3] = np.linalg.inv(matrix[:3, :3]).T
+    transformPointsInPlace(normals, normalMatrix)
+    lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+    np.divide(normals, lengths, out=normals, where=lengths > 0)
+    normalsArray.Modified()
+  polydata.Modified()
+  return polydata
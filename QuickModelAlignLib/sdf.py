@@ -0,0 +1,250 @@
+"""Precomputed narrow-band signed distance grid of an ideal model.
+
+When many prepared models are compared against the same ideal model, the signed
+distance field of the ideal surface can be sampled once on a regular grid and the
+source->target distances of every submission obtained by trilinear interpolation.
+
+The grid spacing is derived from the error tolerance: the signed distance is
+1-Lipschitz, so trilinear interpolation deviates from it by at most
+``spacing * sqrt(3) / 2``. With the default ``accuracyFraction`` of 0.5 the
+interpolation error is guaranteed to be below half of the error tolerance.
+
+Only voxels within ``bandWidth`` of the surface are evaluated, and only they are
+stored: the grid is divided into bricks of BRICK_SIZE³ voxels, and a brick is kept
+only if it can reach into the band. Candidate bricks are those covered by the bounding
+box of a triangle grown by ``bandWidth``; of these, bricks whose center is further from
+the surface than ``bandWidth`` plus half the brick diagonal are dropped (the distance
+is 1-Lipschitz). The kept bricks are computed exactly with a
+distance.SurfaceDistanceEngine. A coarse index array maps brick coordinates to the
+stored bricks, so memory grows with the surface area rather than with the volume of
+the bounding box. Points whose interpolation cell is not fully inside the band are
+computed exactly instead.
+
+Grids above MAX_GRID_VOXELS stored voxels (e.g. whole-arch scans at a tight tolerance)
+are not built, as they would not fit in the feature cache; their distances are computed
+exactly.
+
+The error bound needs a closed surface: the signed distance of an open mesh jumps
+across the extension of its borders, where interpolated values can be wrong by up to
+twice the band width. loadOrBuildGrid therefore returns no grid for open meshes, and
+their distances are all computed exactly.
+"""
+import logging
+import math
+import time
+
+import numpy as np
+
+from QuickModelAlignLib import distance
+
+
+GRID_KEY_NAMES = ("kind", "spacing", "bandWidth")
+
+# Voxels per side of the bricks the grid is stored in
+BRICK_SIZE = 4
+
+# Largest number of stored voxels (float32) of a grid, a quarter of the default feature cache size
+MAX_GRID_VOXELS = 2**26
+
+# Voxels whose signed distance is computed at once when the grid is built
+VOXEL_BLOCK_SIZE = 2**20
+
+
+class GridTooLargeError(ValueError):
+  """Raised by SignedDistanceGrid.build when the band needs more than the voxel budget."""
+
+
+def gridSpacingForTolerance(tolerance, accuracyFraction=0.5):
+  """Largest grid spacing whose interpolation error is below ``accuracyFraction * tolerance``."""
+  if tolerance <= 0:
+    raise ValueError("Error tolerance must be positive to derive the distance grid spacing")
+  return 2.0 * accuracyFraction * tolerance / math.sqrt(3)
+
+
+def isClosedSurface(triangles):
+  """Whether every edge of ``triangles`` (M x 3 vertex indices) is shared by exactly two
+  triangles. Edges of degenerate triangles that join a vertex to itself are ignored."""
+  triangles = np.asarray(triangles, dtype=np.int64)
+  edges = np.concatenate([triangles[:, [0, 1]], triangles[:, [1, 2]], triangles[:, [2, 0]]])
+  edges = np.sort(edges[edges[:, 0] != edges[:, 1]], axis=1)
+  if len(edges) == 0:
+    return False
+  _, counts = np.unique(edges[:, 0] * (int(triangles.max()) + 1) + edges[:, 1], return_counts=True)
+  return bool(np.all(counts == 2))
+
+
+def _bandBricks(engine, origin, spacing, brickDimensions, bandWidth):
+  """Mask of the bricks that intersect the bounding box of a triangle grown by ``bandWidth``,
+  which includes every brick with a voxel within ``bandWidth`` of the surface.
+
+  The boxes are added to a 3D difference array (+1/-1 at their corners) whose cumulative
+  sums along the three axes count the boxes covering each brick.
+  """
+  brickDimensions = np.asarray(brickDimensions)
+  coverage = np.zeros(brickDimensions + 1, dtype=np.int32)
+  for start in range(0, len(engine.triangles), distance.TRIANGLE_BLOCK_SIZE):
+    corners = engine.vertices[engine.triangles[start:start+distance.TRIANGLE_BLOCK_SIZE]]
+    lower = np.maximum(np.ceil((corners.min(axis=1) - bandWidth - origin) / spacing), 0).astype(np.int64) // BRICK_SIZE
+    upper = np.floor((corners.max(axis=1) + bandWidth - origin) / spacing).astype(np.int64) // BRICK_SIZE
+    upper = np.minimum(upper, brickDimensions - 1) + 1
+    # Boxes between two grid planes cover no voxel
+    upper = np.maximum(upper, lower)
+    for corner in range(8):
+      picks = [(corner >> axis) & 1 for axis in range(3)]
+      index = tuple(upper[:, axis] if pick else lower[:, axis] for axis, pick in enumerate(picks))
+      np.add.at(coverage, index, -1 if sum(picks) % 2 else 1)
+  for axis in range(3):
+    np.cumsum(coverage, axis=axis, out=coverage)
+  return coverage[:-1, :-1, :-1] > 0
+
+
+class SignedDistanceGrid:
+  """Signed distances sampled on a regular grid of ``dimensions`` voxels, stored in bricks.
+
+  ``brickIndex[bi, bj, bk]`` is the index in ``bricks`` (N x BRICK_SIZE³, indexed as
+  [brick, x, y, z]) of the brick of voxels [bi*BRICK_SIZE, (bi+1)*BRICK_SIZE) x ..., or -1
+  if it is not stored. Voxels outside the narrow band, stored or not, are NaN.
+  """
+
+  def __init__(self, origin, spacing, dimensions, brickIndex, bricks, bandWidth):
+    self.origin = np.asarray(origin, dtype=np.float64)
+    self.spacing = float(spacing)
+    self.dimensions = np.asarray(dimensions, dtype=np.int64)
+    self.brickIndex = brickIndex
+    self.bricks = bricks
+    self.bandWidth = float(bandWidth)
+
+  @property
+  def maximumInterpolationError(self):
+    return self.spacing * math.sqrt(3) / 2
+
+  @property
+  def nbytes(self):
+    return int(self.brickIndex.nbytes + self.bricks.nbytes)
+
+  @classmethod
+  def build(cls, polydata, spacing, bandWidth, engine=None, stop=None, maxVoxels=MAX_GRID_VOXELS):
+    """Sample the signed distance to the surface of ``polydata`` in a band around it.
+
+    :param stop: optional cancellation check, see distance.SurfaceDistanceEngine.signedDistance
+    :raises GridTooLargeError: if more than ``maxVoxels`` voxels would be stored
+    """
+    startTime = time.perf_counter()
+    engine = engine or distance.SurfaceDistanceEngine(polydata)
+    margin = bandWidth + spacing
+    origin = engine.vertices.min(axis=0) - margin
+    dimensions = np.ceil((engine.vertices.max(axis=0) + margin - origin) / spacing).astype(np.int64) + 1
+    brickDimensions = -(-dimensions // BRICK_SIZE)
+    brickCoordinates = np.argwhere(_bandBricks(engine, origin, spacing, brickDimensions, bandWidth))
+    # Bricks whose center is too far from the surface for any of their voxels to be in the band
+    centers = origin + (brickCoordinates * BRICK_SIZE + (BRICK_SIZE - 1) / 2.0) * spacing
+    halfDiagonal = (BRICK_SIZE - 1) * spacing * math.sqrt(3) / 2
+    brickCoordinates = brickCoordinates[np.abs(engine.signedDistance(centers, stop=stop)) <= bandWidth + halfDiagonal]
+    voxelCount = len(brickCoordinates) * BRICK_SIZE**3
+    if voxelCount > maxVoxels:
+      raise GridTooLargeError(f"The distance grid band needs {voxelCount} voxels (spacing {spacing:.4f}), more than the limit of {maxVoxels}")
+
+    brickIndex = np.full(brickDimensions, -1, dtype=np.int32)
+    brickIndex[tuple(brickCoordinates.T)] = np.arange(len(brickCoordinates))
+    bricks = np.empty((len(brickCoordinates), BRICK_SIZE, BRICK_SIZE, BRICK_SIZE), dtype=np.float32)
+    brickVoxels = np.stack(np.meshgrid(*[np.arange(BRICK_SIZE)] * 3, indexing="ij"), axis=-1).reshape(-1, 3)
+    bricksPerBlock = max(1, VOXEL_BLOCK_SIZE // BRICK_SIZE**3)
+    for start in range(0, len(brickCoordinates), bricksPerBlock):
+      if stop is not None and stop():
+        raise distance.DistanceCancelled()
+      block = brickCoordinates[start:start+bricksPerBlock]
+      points = origin + (block[:, np.newaxis, :] * BRICK_SIZE + brickVoxels).reshape(-1, 3) * spacing
+      signedDistances = engine.signedDistance(points, stop=stop)
+      signedDistances[np.abs(signedDistances) > bandWidth] = np.nan
+      bricks[start:start+len(block)] = signedDistances.reshape(-1, BRICK_SIZE, BRICK_SIZE, BRICK_SIZE)
+    logging.info(f"Signed distance grid {tuple(dimensions)} (spacing {spacing:.4f}, {len(bricks)} bricks of {BRICK_SIZE}³ voxels) "
+      f"computed in {time.perf_counter()-startTime:.2f} seconds")
+    return cls(origin, spacing, dimensions, brickIndex, bricks, bandWidth)
+
+  def voxelValues(self, index):
+    """Values of the voxels ``index`` (N x 3, within the grid); NaN where no brick is stored."""
+    brick = self.brickIndex[tuple((index // BRICK_SIZE).T)]
+    local = index % BRICK_SIZE
+    values = self.bricks[np.maximum(brick, 0), local[:, 0], local[:, 1], local[:, 2]] if len(self.bricks) else np.zeros(len(index), dtype=np.float32)
+    return np.where(brick >= 0, values, np.nan)
+
+  def interpolate(self, points):
+    """Trilinear interpolation at ``points`` (N x 3).
+
+    :return: values, and a boolean mask of the points that could be interpolated
+    """
+    points = np.asarray(points, dtype=np.float64)
+    continuousIndex = (points - self.origin) / self.spacing
+    lowerIndex = np.floor(continuousIndex).astype(np.int64)
+    fraction = continuousIndex - lowerIndex
+    inside = np.all((lowerIndex >= 0) & (lowerIndex < self.dimensions - 1), axis=1)
+    lowerIndex = np.clip(lowerIndex, 0, self.dimensions - 2)
+    result = np.zeros(len(points))
+    for corner in range(8):
+      offset = np.array([(corner >> 2) & 1, (corner >> 1) & 1, corner & 1])
+      weight = np.prod(np.where(offset, fraction, 1.0 - fraction), axis=1)
+      result += weight * self.voxelValues(lowerIndex + offset)
+    valid = inside & np.isfinite(result)
+    return result, valid
+
+  def signedDistance(self, points, fallbackEngine=None):
+    """Signed distances at ``points``. Points outside the band are computed with
+    ``fallbackEngine``, or are NaN if it is not given."""
+    values, valid = self.interpolate(points)
+    if not valid.all():
+      if fallbackEngine is not None:
+        values[~valid] = fallbackEngine.signedDistance(np.asarray(points)[~valid])
+      else:
+        values[~valid] = np.nan
+    return values
+
+  def toArrays(self):
+    return {
+      "origin": self.origin,
+      "spacing": np.float64(self.spacing),
+      "dimensions": self.dimensions,
+      "brickIndex": self.brickIndex,
+      "bricks": self.bricks,
+      "bandWidth": np.float64(self.bandWidth),
+      }
+
+  @classmethod
+  def fromArrays(cls, origin, spacing, dimensions, brickIndex, bricks, bandWidth):
+    return cls(origin, float(spacing), dimensions, brickIndex, bricks, float(bandWidth))
+
+
+def loadOrBuildGrid(polydata, path, tolerance, featureCache=None, bandWidth=None, engine=None, accuracyFraction=0.5, stop=None):
+  """Signed distance grid of the ideal model ``polydata`` read from ``path``.
+
+  The grid is read from ``featureCache`` if it has been computed before for the same
+  file and tolerance, otherwise it is computed and stored there. ``polydata`` must be
+  in the coordinate system stored in the file.
+
+  Returns None if the surface is not closed (see isClosedSurface), since the interpolation
+  error bound does not hold, or if the grid would exceed MAX_GRID_VOXELS. The distances
+  are then computed exactly.
+
+  :param bandWidth: half-width of the narrow band, defaults to 3 times the tolerance
+  :param stop: optional cancellation check, see SignedDistanceGrid.build
+  """
+  triangles = engine.triangles if engine is not None else distance.trianglesFromPolyData(polydata)[1]
+  if not isClosedSurface(triangles):
+    logging.info(f"{path} is not a closed surface, its distances are computed exactly instead of from a distance grid")
+    return None
+  spacing = gridSpacingForTolerance(tolerance, accuracyFraction)
+  if bandWidth is None:
+    bandWidth = 3 * tolerance
+  key = None
+  if featureCache is not None and path:
+    key = featureCache.key(path, {"kind": "signedDistanceBricks", "spacing": spacing, "bandWidth": bandWidth}, GRID_KEY_NAMES)
+    entry = featureCache.load(key)
+    if entry is not None:
+      return SignedDistanceGrid.fromArrays(**entry)
+  try:
+    grid = SignedDistanceGrid.build(polydata, spacing, bandWidth, engine, stop)
+  except GridTooLargeError as e:
+    logging.info(f"{e}; the distances to {path} are computed exactly")
+    return None
+  if key is not None:
+    featureCache.store(key, **grid.toArrays())
+  return grid
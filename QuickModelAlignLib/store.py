@@ -0,0 +1,206 @@
+"""Local SQLite store of comparison results, for queries across many runs and semesters.
+
+Every comparison (batch or interactive) is one row of the ``runs`` table: inputs and
+their hashes, parameters, transform, registration fitness, the tolerance statistics
+(metrics.ComparisonMetrics.summary) and the total time and memory. The wall time of
+each stage is a row of the ``stages`` table. Indexes cover the most common queries:
+
+- the history of a student (``studentHistory``),
+- the worst over-preparations of an ideal model (``worstOverPreparations``),
+- timing trends, overall or per stage (``timingTrend``).
+
+The student of a run is the file name of the prepared model without extension,
+unless the result has a "student" entry. Inserts of many results are grouped in one
+transaction (``addRuns``), which keeps up with a parallel batch run; the database
+is in WAL mode, so it can be queried while a batch is writing.
+
+Example::
+
+  with ResultsStore("results.sqlite") as store:
+    for run in store.worstOverPreparations("ideal.ply", limit=10):
+      print(run["student"], run["deficientVolume"])
+"""
+import json
+import os
+import sqlite3
+from datetime import datetime
+
+
+SCHEMA_VERSION = 1
+
+# Tolerance statistics columns, as returned by metrics.ComparisonMetrics.summary
+METRIC_COLUMNS = ("tolerance", "surfaceArea", "underPreparedAreaPercent", "overPreparedAreaPercent",
+  "excessVolume", "deficientVolume", "rms", "percentile95", "hausdorff")
+
+# Over-preparation measures that worstOverPreparations can rank by
+OVER_PREPARATION_COLUMNS = ("deficientVolume", "overPreparedAreaPercent")
+
+TIMING_PERIODS = {
+  "day": "%Y-%m-%d",
+  "week": "%Y-%W",
+  "month": "%Y-%m",
+  }
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+  id INTEGER PRIMARY KEY,
+  created TEXT NOT NULL,
+  origin TEXT,
+  student TEXT,
+  prepared TEXT,
+  preparedSHA256 TEXT,
+  ideal TEXT,
+  idealSHA256 TEXT,
+  status TEXT,
+  error TEXT,
+  scaling REAL,
+  fitness REAL,
+  inlierRMSE REAL,
+  globalRegistrationEngine TEXT,
+  transform TEXT,
+  parameters TEXT,
+  %s,
+  seconds REAL,
+  peakRSSBytes INTEGER,
+  allocatedBytes INTEGER
+);
+CREATE TABLE IF NOT EXISTS stages (
+  run INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+  stage TEXT NOT NULL,
+  seconds REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runsByStudent ON runs (student, created);
+CREATE INDEX IF NOT EXISTS runsByIdealDeficientVolume ON runs (ideal, deficientVolume);
+CREATE INDEX IF NOT EXISTS runsByIdealOverPreparedArea ON runs (ideal, overPreparedAreaPercent);
+CREATE INDEX IF NOT EXISTS runsByCreated ON runs (created, seconds);
+CREATE INDEX IF NOT EXISTS stagesByStage ON stages (stage, run);
+""" % ",\n  ".join(f"{name} REAL" for name in METRIC_COLUMNS)
+
+RUN_COLUMNS = ("created", "origin", "student", "prepared", "preparedSHA256", "ideal", "idealSHA256", "status", "error",
+  "scaling", "fitness", "inlierRMSE", "globalRegistrationEngine", "transform", "parameters") + METRIC_COLUMNS + (
+  "seconds", "peakRSSBytes", "allocatedBytes")
+
+
+def defaultStorePath():
+  """Store location used outside of Slicer (``QUICKMODELALIGN_RESULTS_DB`` overrides it)."""
+  path = os.environ.get("QUICKMODELALIGN_RESULTS_DB")
+  if path:
+    return path
+  if os.name == "nt":
+    base = os.environ.get("LOCALAPPDATA", os.path.expanduser("~"))
+  else:
+    base = os.environ.get("XDG_DATA_HOME", os.path.join(os.path.expanduser("~"), ".local", "share"))
+  return os.path.join(base, "QuickModelAlign", "results.sqlite")
+
+
+def studentFromPath(path):
+  return os.path.splitext(os.path.basename(path))[0] if path else None
+
+
+def runRow(result, parameters=None, origin="batch"):
+  """Column values of the ``runs`` table for a result dictionary as returned by batch.alignToIdeal."""
+  toleranceMetrics = result.get("toleranceMetrics") or {}
+  transform = result.get("transform")
+  globalRegistration = result.get("globalRegistration") or {}
+  row = {
+    "created": result.get("created") or datetime.now().isoformat(timespec="seconds"),
+    "origin": origin,
+    "student": result.get("student") or studentFromPath(result.get("prepared")),
+    "prepared": result.get("prepared"),
+    "preparedSHA256": result.get("preparedSHA256"),
+    "ideal": result.get("ideal"),
+    "idealSHA256": result.get("idealSHA256"),
+    "status": result.get("status", "ok"),
+    "error": result.get("error"),
+    "scaling": result.get("scaling"),
+    "fitness": result.get("fitness"),
+    "inlierRMSE": result.get("inlierRMSE"),
+    "globalRegistrationEngine": globalRegistration.get("engine"),
+    "transform": None if transform is None else json.dumps([float(element) for row in transform for element in row]),
+    "parameters": None if parameters is None else json.dumps(parameters, sort_keys=True, default=float),
+    "seconds": result.get("seconds"),
+    "peakRSSBytes": result.get("peakRSSBytes"),
+    "allocatedBytes": result.get("allocatedBytes"),
+    }
+  for name in METRIC_COLUMNS:
+    row[name] = toleranceMetrics.get(name)
+  return row
+
+
+class ResultsStore:
+  """Comparison results in a local SQLite database."""
+
+  def __init__(self, path=None):
+    self.path = path or defaultStorePath()
+    directory = os.path.dirname(os.path.abspath(self.path))
+    os.makedirs(directory, exist_ok=True)
+    self.connection = sqlite3.connect(self.path)
+    self.connection.row_factory = sqlite3.Row
+    self.connection.execute("PRAGMA journal_mode=WAL")
+    self.connection.execute("PRAGMA foreign_keys=ON")
+    with self.connection:
+      self.connection.executescript(_SCHEMA)
+      self.connection.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exceptionInfo):
+    self.close()
+
+  def close(self):
+    self.connection.close()
+
+  def addRun(self, result, parameters=None, origin="batch"):
+    """Insert one result; returns its run id."""
+    return self.addRuns([result], parameters, origin)[0]
+
+  def addRuns(self, results, parameters=None, origin="batch"):
+    """Insert results in a single transaction; returns their run ids."""
+    insertRun = "INSERT INTO runs (%s) VALUES (%s)" % (", ".join(RUN_COLUMNS), ", ".join("?" * len(RUN_COLUMNS)))
+    runIds = []
+    stageRows = []
+    with self.connection:
+      for result in results:
+        row = runRow(result, parameters, origin)
+        runId = self.connection.execute(insertRun, [row[name] for name in RUN_COLUMNS]).lastrowid
+        runIds.append(runId)
+        stageRows += [(runId, stage, float(seconds)) for stage, seconds in (result.get("stageSeconds") or {}).items()]
+      self.connection.executemany("INSERT INTO stages (run, stage, seconds) VALUES (?, ?, ?)", stageRows)
+    return runIds
+
+  def _query(self, sql, parameters=()):
+    return [dict(row) for row in self.connection.execute(sql, parameters)]
+
+  def studentHistory(self, student):
+    """All runs of a student, oldest first."""
+    return self._query("SELECT * FROM runs WHERE student = ? ORDER BY created, id", (student,))
+
+  def worstOverPreparations(self, ideal, limit=10, orderBy="deficientVolume"):
+    """Successful runs against the ideal model file ``ideal`` with the largest over-preparation.
+
+    :param orderBy: "deficientVolume" (mm³ below the tolerance) or "overPreparedAreaPercent"
+    """
+    if orderBy not in OVER_PREPARATION_COLUMNS:
+      raise ValueError(f"Unsupported over-preparation measure: {orderBy}")
+    return self._query(f"SELECT * FROM runs WHERE ideal = ? AND {orderBy} IS NOT NULL AND status = 'ok' "
+      f"ORDER BY {orderBy} DESC LIMIT ?", (ideal, int(limit)))
+
+  def timingTrend(self, period="day", stage=None):
+    """Number of runs and mean and maximum wall time per period ("day", "week" or "month").
+
+    :param stage: a stage name (e.g. "RANSAC") for the time of that stage instead of whole runs
+    """
+    if period not in TIMING_PERIODS:
+      raise ValueError(f"Unsupported period: {period}")
+    if stage is None:
+      return self._query("SELECT strftime(?, created) AS period, COUNT(*) AS runs, AVG(seconds) AS meanSeconds, "
+        "MAX(seconds) AS maximumSeconds FROM runs WHERE seconds IS NOT NULL GROUP BY period ORDER BY period",
+        (TIMING_PERIODS[period],))
+    # A stage can be recorded several times per run (e.g. per ICP level), its times are summed per run
+    return self._query("SELECT strftime(?, runs.created) AS period, COUNT(*) AS runs, AVG(stageSeconds) AS meanSeconds, "
+      "MAX(stageSeconds) AS maximumSeconds FROM (SELECT run, SUM(seconds) AS stageSeconds FROM stages WHERE stage = ? GROUP BY run) "
+      "JOIN runs ON runs.id = run GROUP BY period ORDER BY period", (TIMING_PERIODS[period], stage))
+
+  def runCount(self):
+    return self.connection.execute("SELECT COUNT(*) FROM runs").fetchone()[0]
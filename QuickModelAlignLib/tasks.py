@@ -0,0 +1,305 @@
+"""Running pipeline stages in the background, with progress reporting and cancellation.
+
+Task functions take a ``progress`` keyword argument: a callable ``progress(stage, detail)``
+that is invoked when a stage of the pipeline starts. ``stage`` is one of STAGES.
+
+Two task runners share the same interface (start, poll, cancel):
+
+- ProcessTask runs the function in a separate process. Cancelling terminates the
+  process, so even a long RANSAC run stops immediately.
+- ThreadTask runs the function in a thread of the current process. This is used
+  for work on VTK objects that cannot be sent to another process cheaply. Cancelling
+  is cooperative: the next ``progress`` call raises TaskCancelled. Task functions with a
+  ``stop`` keyword argument also get a callable that returns true once the task is
+  cancelled, which the distance computations check between chunks.
+
+The owner of a task calls ``poll`` periodically (e.g. from a QTimer), which returns the
+progress events received since the last call and updates ``state``.
+
+The results of the task functions include the instrumentation trace of their stages
+under "trace" (see instrumentation.Trace.toDict).
+"""
+import inspect
+import queue
+import threading
+import traceback
+
+import numpy as np
+
+from QuickModelAlignLib import cache
+from QuickModelAlignLib import display
+from QuickModelAlignLib import distance
+from QuickModelAlignLib import instrumentation
+from QuickModelAlignLib import metrics
+from QuickModelAlignLib import parallel
+from QuickModelAlignLib import registration
+from QuickModelAlignLib import sdf
+from QuickModelAlignLib import templates
+
+
+STAGES = ("downsample", "normals", "FPFH", "RANSAC", "ICP", "distances")
+
+
+class TaskCancelled(Exception):
+  pass
+
+
+def _runFunction(messageQueue, function, args, kwargs, isCancelled=None):
+  def progress(stage, detail=""):
+    if isCancelled is not None and isCancelled():
+      raise TaskCancelled()
+    messageQueue.put(("progress", stage, detail))
+  if isCancelled is not None and "stop" in inspect.signature(function).parameters:
+    kwargs = dict(kwargs, stop=isCancelled)
+  try:
+    result = function(*args, progress=progress, **kwargs)
+    messageQueue.put(("finished", result))
+  except (TaskCancelled, distance.DistanceCancelled):
+    messageQueue.put(("cancelled", None))
+  except Exception:
+    messageQueue.put(("failed", traceback.format_exc()))
+
+
+class _Task:
+
+  def __init__(self, function, *args, **kwargs):
+    self.function = function
+    self.args = args
+    self.kwargs = kwargs
+    self.state = "pending"
+    self.stage = None
+    self.result = None
+    self.error = None
+
+  def isDone(self):
+    return self.state in ("finished", "failed", "cancelled")
+
+  def poll(self):
+    """Process messages from the task. Returns the list of (stage, detail) progress events."""
+    events = []
+    while not self.isDone():
+      try:
+        message = self.messageQueue.get_nowait()
+      except queue.Empty:
+        self._checkAlive()
+        break
+      kind = message[0]
+      if kind == "progress":
+        self.stage = message[1]
+        events.append((message[1], message[2]))
+      elif kind == "finished":
+        self.result = message[1]
+        self.state = "finished"
+      elif kind == "failed":
+        self.error = message[1]
+        self.state = "failed"
+      elif kind == "cancelled":
+        self.state = "cancelled"
+    return events
+
+  def wait(self):
+    """Block until the task is done and return its result (for scripting and testing)."""
+    while not self.isDone():
+      self._join(0.05)
+      self.poll()
+    if self.state == "failed":
+      raise RuntimeError(self.error)
+    return self.result
+
+  def _checkAlive(self):
+    pass
+
+  def _join(self, timeout):
+    pass
+
+
+class ProcessTask(_Task):
+  """Runs a module level function in a worker process."""
+
+  def start(self):
+    context = parallel.processContext()
+    self.messageQueue = context.Queue()
+    self.process = context.Process(target=_runFunction, args=(self.messageQueue, self.function, self.args, self.kwargs), daemon=True)
+    self.process.start()
+    self.state = "running"
+
+  def cancel(self):
+    if self.isDone():
+      return
+    self.process.terminate()
+    self.process.join()
+    self.state = "cancelled"
+
+  def _checkAlive(self):
+    if self.state == "running" and not self.process.is_alive() and self.messageQueue.empty():
+      self.error = f"Background process exited unexpectedly (exit code {self.process.exitcode})"
+      self.state = "failed"
+
+  def _join(self, timeout):
+    self.process.join(timeout)
+
+
+class ThreadTask(_Task):
+  """Runs a function in a background thread, with cooperative cancellation."""
+
+  def start(self):
+    self.messageQueue = queue.Queue()
+    self.cancelRequested = threading.Event()
+    self.thread = threading.Thread(target=_runFunction,
+      args=(self.messageQueue, self.function, self.args, self.kwargs, self.cancelRequested.is_set), daemon=True)
+    self.thread.start()
+    self.state = "running"
+
+  def cancel(self):
+    if self.isDone():
+      return
+    # The thread stops at the start of its next stage (or distance chunk); its result is discarded
+    self.cancelRequested.set()
+    self.state = "cancelled"
+
+  def _checkAlive(self):
+    if self.state == "running" and not self.thread.is_alive() and self.messageQueue.empty():
+      self.error = "Background thread exited unexpectedly"
+      self.state = "failed"
+
+  def _join(self, timeout):
+    self.thread.join(timeout)
+
+
+#
+# Task functions. They take and return numpy arrays so that the results can be sent between processes.
+#
+
+def subsampleTask(sourcePoints, targetPoints, skipScaling, parameters, targetPath=None, cacheDirectory=None, progress=None):
+  """registration.runSubsample for a ProcessTask. Source and target are preprocessed concurrently."""
+  trace = instrumentation.Trace("subsample")
+  featureCache = cache.FeatureCache(cacheDirectory) if cacheDirectory else None
+  source_down, target_down, source_fpfh, target_fpfh, voxel_size, scaling = registration.runSubsample(
+    sourcePoints, targetPoints, skipScaling, parameters, targetPath, featureCache, progress=progress, trace=trace)
+  return {
+    "source": registration.preprocessedToArrays(source_down, source_fpfh),
+    "target": registration.preprocessedToArrays(target_down, target_fpfh),
+    "voxelSize": voxel_size,
+    "scaling": scaling,
+    "cacheStatistics": featureCache.statistics() if featureCache else None,
+    "trace": trace.toDict(),
+    }
+
+
+def registrationTask(source, target, voxelSize, skipScaling, parameters, warmStart=None, progress=None):
+  """registration.registerPointClouds for a ProcessTask.
+
+  :param source: preprocessed source arrays, as returned by registration.preprocessedToArrays
+  :param target: preprocessed target arrays
+  :param warmStart: registration.WarmStart of previous registrations; the updated copy is
+    returned under "warmStart"
+  """
+  sourceDown, sourceFeatures = registration.preprocessedFromArrays(**source)
+  targetDown, targetFeatures = registration.preprocessedFromArrays(**target)
+  trace = instrumentation.Trace("registration")
+  report = {}
+  icp = registration.registerPointClouds(sourceDown, targetDown, sourceFeatures, targetFeatures, voxelSize, skipScaling, parameters,
+    progress=progress, report=report, warmStart=warmStart, trace=trace)
+  return {
+    "transformation": np.asarray(icp.transformation),
+    "fitness": float(icp.fitness),
+    "inlierRMSE": float(icp.inlier_rmse),
+    "globalRegistration": report["globalRegistration"],
+    "fastPath": report.get("fastPath"),
+    "ICP": report["ICP"],
+    "warmStart": warmStart,
+    "trace": trace.toDict(),
+    }
+
+
+def templateMatchingTask(sourcePoints, idealPaths, skipScaling, parameters, cacheDirectory=None, idealMatrix=None, workers=None,
+    progress=None):
+  """templates.matchTemplates for a ThreadTask.
+
+  The candidates are aligned in a pool of worker processes owned by the thread (a
+  ProcessTask cannot start processes of its own); cancelling terminates the pool.
+  The best candidate is returned under "best", with its transform as a numpy array
+  under "transformation", and all ranked candidates under "candidates".
+  """
+  trace = instrumentation.Trace("templateMatching")
+  with instrumentation.stage(trace, "templateMatching", ideals=len(idealPaths)) as record:
+    candidates = templates.matchTemplates(sourcePoints, idealPaths, skipScaling, parameters, cacheDirectory, idealMatrix,
+      workers, progress)
+    record["best"] = candidates[0]["ideal"]
+  if candidates[0]["status"] != "ok":
+    # Failed candidates are ranked last, so all of them failed
+    raise RuntimeError("No ideal model could be aligned: " + candidates[0]["error"])
+  best = dict(candidates[0], transformation=np.asarray(candidates[0]["transform"]))
+  return {
+    "best": best,
+    "candidates": candidates,
+    "trace": trace.toDict(),
+    }
+
+
+def levelOfDetailTask(sourcePolydata, targetPolydata, triangleBudget, progress=None, stop=None):
+  """Decimated display meshes (display.decimateToBudget) for a ThreadTask.
+
+  The distances between the two decimated meshes are computed as well, for a preview
+  colour map until the full resolution distances are available. Meshes within the
+  budget are returned unchanged.
+  """
+  trace = instrumentation.Trace("levelOfDetail")
+  if progress is not None:
+    progress("distances", "display meshes")
+  displayPolydata = []
+  for label, polydata in (("prepared", sourcePolydata), ("ideal", targetPolydata)):
+    with instrumentation.stage(trace, "levelOfDetail", label, triangles=polydata.GetNumberOfPolys(), triangleBudget=triangleBudget) as record:
+      displayPolydata.append(display.decimateToBudget(polydata, triangleBudget))
+      record["displayTriangles"] = displayPolydata[-1].GetNumberOfPolys()
+      if displayPolydata[-1] is not polydata:
+        record["allocatedBytes"] = displayPolydata[-1].GetActualMemorySize() * 1024
+  sourceDisplay, targetDisplay = displayPolydata
+  if progress is not None:
+    progress("distances", "preview")
+  with instrumentation.stage(trace, "previewDistances", allocatedBytes=distance.signedDistanceBytes(sourceDisplay.GetNumberOfPoints(), targetDisplay)
+      + distance.signedDistanceBytes(targetDisplay.GetNumberOfPoints(), sourceDisplay)):
+    sourceDisplay = distance.computeSignedDistance(sourceDisplay, targetDisplay, stop=stop)
+    targetDisplay = distance.computeSignedDistance(targetDisplay, sourceDisplay, stop=stop)
+  return {
+    "source": sourceDisplay,
+    "target": targetDisplay,
+    "trace": trace.toDict(),
+    }
+
+
+def distancesTask(sourcePolydata, targetPolydata, targetPath=None, tolerance=None, cacheDirectory=None,
+    sourceDisplay=None, targetDisplay=None, progress=None, stop=None):
+  """distance.computeSignedDistances for a ThreadTask, followed by the tolerance metrics.
+
+  If ``targetPath`` and ``tolerance`` are given, source->target distances are interpolated
+  from the precomputed signed distance grid of the target, which is computed and cached on
+  first use.
+
+  If level of detail meshes ``sourceDisplay`` and ``targetDisplay`` are given, the distances
+  are carried over to them and the copies are returned under "sourceDisplay" and "targetDisplay".
+  """
+  trace = instrumentation.Trace("distances")
+  targetGrid = None
+  if targetPath and tolerance:
+    if progress is not None:
+      progress("distances", "ideal distance grid")
+    featureCache = cache.FeatureCache(cacheDirectory) if cacheDirectory else None
+    with instrumentation.stage(trace, "distanceGrid", "ideal") as record:
+      targetGrid = sdf.loadOrBuildGrid(targetPolydata, targetPath, tolerance, featureCache, stop=stop)
+      record["allocatedBytes"] = targetGrid.nbytes if targetGrid is not None else 0
+  sourceWithDistance, targetWithDistance = distance.computeSignedDistances(sourcePolydata, targetPolydata, progress, targetGrid, trace, stop)
+  with instrumentation.stage(trace, "metrics", allocatedBytes=metrics.comparisonBytes(sourceWithDistance, targetWithDistance)):
+    comparisonMetrics = metrics.ComparisonMetrics.fromPolyData(sourceWithDistance, targetWithDistance)
+  result = {
+    "source": sourceWithDistance,
+    "target": targetWithDistance,
+    "metrics": comparisonMetrics,
+    }
+  if sourceDisplay is not None and targetDisplay is not None:
+    with instrumentation.stage(trace, "transferDistances", allocatedBytes=display.transferDistancesBytes(sourceWithDistance, sourceDisplay)
+        + display.transferDistancesBytes(targetWithDistance, targetDisplay)):
+      result["sourceDisplay"] = display.transferDistances(sourceWithDistance, sourceDisplay)
+      result["targetDisplay"] = display.transferDistances(targetWithDistance, targetDisplay)
+  result["trace"] = trace.toDict()
+  return result
@@ -0,0 +1,137 @@
+"""Multi-template matching: align a prepared model to several ideal models and pick the best.
+
+Some exercises accept several ideal preparations (e.g. different tooth morphologies).
+The prepared model is aligned to each of them (preprocessing, global registration and
+ICP, as for a single ideal model) in a pool of worker processes, one ideal model per
+process, with the cores shared between the processes. The preprocessed ideal models are
+read from the feature cache, so that after the first comparison only the prepared model is
+preprocessed (once per ideal model, since the voxel size and scaling depend on it). Candidates are ranked by ICP fitness, then inlier RMSE;
+distances are then only computed against the best ideal model.
+
+Points and transforms are in the coordinate system of the ideal mesh files (as read by
+registration.readPolyData), unless an ``idealMatrix`` is given that maps the ideal models
+to the coordinate system of the prepared points (e.g. registration.RAS_TO_LPS for points
+of a Slicer model node). The feature cache must only be shared with callers that work in
+the same coordinate system.
+"""
+import os
+import time
+import traceback
+
+import numpy as np
+
+from QuickModelAlignLib import cache
+from QuickModelAlignLib import instrumentation
+from QuickModelAlignLib import parallel
+from QuickModelAlignLib import registration
+
+
+# Seconds between progress reports (and cancellation checks) while the candidates are aligned
+POLL_SECONDS = 0.2
+
+
+def alignToTemplate(sourcePoints, idealPath, skipScaling, parameters, cacheDirectory=None, idealMatrix=None):
+  """Align prepared model points to one ideal model file.
+
+  :param idealMatrix: optional 4x4 matrix applied to the ideal model points
+  :return: dictionary with the "ideal" path, "scaling", "transform", "fitness", "inlierRMSE",
+    registration reports and "trace"
+  """
+  trace = instrumentation.Trace(os.path.basename(idealPath))
+  startTime = time.perf_counter()
+  with instrumentation.stage(trace, "read", "ideal"):
+    idealPolydata = registration.readPolyData(idealPath)
+    idealPoints = registration.pointsFromPolyData(idealPolydata)
+    if idealMatrix is not None:
+      idealPoints = registration.transformPointsInPlace(idealPoints, idealMatrix)
+  featureCache = cache.FeatureCache(cacheDirectory) if cacheDirectory else None
+  sourceDown, targetDown, sourceFeatures, targetFeatures, voxelSize, scaling = registration.runSubsample(
+    sourcePoints, idealPoints, skipScaling, parameters, idealPath, featureCache, trace=trace)
+  report = {}
+  icp = registration.registerPointClouds(sourceDown, targetDown, sourceFeatures, targetFeatures, voxelSize, skipScaling, parameters,
+    report=report, trace=trace)
+  return {
+    "ideal": idealPath,
+    "status": "ok",
+    "scaling": float(scaling),
+    "voxelSize": float(voxelSize),
+    "transform": np.asarray(icp.transformation).tolist(),
+    "fitness": float(icp.fitness),
+    "inlierRMSE": float(icp.inlier_rmse),
+    "globalRegistration": report["globalRegistration"],
+    "ICP": report["ICP"],
+    "cacheStatistics": featureCache.statistics() if featureCache else None,
+    "seconds": time.perf_counter() - startTime,
+    "trace": trace.toDict(),
+    }
+
+
+def _initializeWorker(threads):
+  parallel.limitThreadsPerProcess(threads)
+
+
+def _alignInWorker(sourcePoints, idealPath, skipScaling, parameters, cacheDirectory, idealMatrix):
+  try:
+    return alignToTemplate(sourcePoints, idealPath, skipScaling, parameters, cacheDirectory, idealMatrix)
+  except Exception as e:
+    return {
+      "ideal": idealPath,
+      "status": "failed",
+      "error": "%s: %s" % (type(e).__name__, e),
+      "traceback": traceback.format_exc(),
+      }
+
+
+def rankCandidates(candidates):
+  """Candidates sorted best first: highest fitness, then lowest inlier RMSE; failed ones last.
+  Each candidate gets its 1-based "rank"."""
+  ranked = sorted(candidates, key=lambda candidate: (candidate["status"] != "ok",
+    -candidate.get("fitness", 0.0), candidate.get("inlierRMSE", np.inf)))
+  for rank, candidate in enumerate(ranked, 1):
+    candidate["rank"] = rank
+  return ranked
+
+
+def formatRanking(candidates):
+  """One line per ranked candidate, for display."""
+  lines = []
+  for candidate in candidates:
+    name = os.path.basename(candidate["ideal"])
+    if candidate["status"] == "ok":
+      lines.append("%d. %s: fitness %.3f, inlier RMSE %.4f" % (candidate["rank"], name, candidate["fitness"], candidate["inlierRMSE"]))
+    else:
+      lines.append("%d. %s: failed (%s)" % (candidate["rank"], name, candidate["error"]))
+  return "\n".join(lines)
+
+
+def matchTemplates(sourcePoints, idealPaths, skipScaling, parameters, cacheDirectory=None, idealMatrix=None, workers=None, progress=None):
+  """Align the prepared model points to every ideal model concurrently.
+
+  ``progress`` is called regularly while the candidates are aligned; if it raises (e.g.
+  tasks.TaskCancelled), the worker processes are terminated.
+
+  :return: the candidates, ranked by rankCandidates
+  """
+  if not idealPaths:
+    raise ValueError("No ideal models to match")
+  parameters = registration.completeParameters(parameters)
+  sourcePoints = np.asarray(sourcePoints)
+  workers = min(workers or parallel.defaultWorkerCount(), len(idealPaths))
+  threads = max(1, parallel.defaultWorkerCount() // workers)
+  pool = parallel.processContext().Pool(workers, _initializeWorker, (threads,))
+  try:
+    asyncResults = [pool.apply_async(_alignInWorker, (sourcePoints, idealPath, skipScaling, parameters, cacheDirectory, idealMatrix))
+      for idealPath in idealPaths]
+    while True:
+      pending = [asyncResult for asyncResult in asyncResults if not asyncResult.ready()]
+      if progress is not None:
+        progress("RANSAC", f"{len(asyncResults) - len(pending)} of {len(asyncResults)} ideal models")
+      if not pending:
+        break
+      pending[0].wait(POLL_SECONDS)
+    candidates = [asyncResult.get() for asyncResult in asyncResults]
+  finally:
+    # Stops the remaining alignments if the caller was cancelled
+    pool.terminate()
+    pool.join()
+  return rankCandidates(candidates)
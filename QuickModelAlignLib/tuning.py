@@ -0,0 +1,378 @@
+"""Automatic tuning of the downsampling and feature parameters, saved as named presets.
+
+Example, from a shell::
+
+  PythonSlicer -m QuickModelAlignLib.tuning --pair prepared1.ply ideal.ply --pair prepared2.ply ideal.ply --preset molars -j 8
+
+A small grid of ``pointDensity``, ``normalSearchRadius``, ``FPFHSearchRadius``,
+``distanceThreshold`` and ``ICPDistanceThreshold`` values (DEFAULT_GRID) is swept over
+representative (prepared, ideal) pairs in a pool of single-threaded worker processes.
+For every pair, a reference alignment is computed first (default parameters, several
+global registration starts). The aligned prepared model is then moved by known poses
+(POSES), and each setting has to recover them: its registration error is the RMS
+displacement of the prepared model points between the estimated and the true pose, as
+in the benchmark. Without pairs, the synthetic teeth of the benchmark are used.
+
+Every setting is run with ``randomSeed`` 0, so that all settings see the same random
+sampling. open3d versions that cannot be seeded (such as the pinned 0.14.1) give a
+different result on every run: there each (setting, pair, pose) run is repeated
+DEFAULT_REPEATS times and settings are ranked on their worst run, and the sweep
+record states that the results are not repeatable.
+
+The fastest setting (mean time of preprocessing and registration) whose largest error
+stays within the target error is chosen, and can be saved as a named preset: a JSON file
+in the preset directory holding the chosen parameters and how they were found. Presets
+are loaded over the default parameters by the module logic (``preset`` argument of
+runSubsample and estimateTransform), the batch tool (``--preset``) and the widget.
+"""
+import argparse
+import concurrent.futures
+import itertools
+import json
+import logging
+import os
+import re
+import sys
+import tempfile
+import time
+import traceback
+from datetime import datetime
+
+import numpy as np
+
+from QuickModelAlignLib import benchmark
+from QuickModelAlignLib import parallel
+from QuickModelAlignLib import registration
+
+
+# Values swept for each parameter; every combination is evaluated
+DEFAULT_GRID = {
+  "pointDensity": (0.5, 0.8, 1.2),
+  "normalSearchRadius": (2, 3),
+  "FPFHSearchRadius": (5, 7),
+  "distanceThreshold": (1.0, 1.5),
+  "ICPDistanceThreshold": (0.4, 0.8),
+  }
+
+# Largest acceptable registration error RMS (mm) of a setting
+DEFAULT_TARGET_ERROR = 0.05
+
+# Known pose changes (rotation axis, angle in degrees, translation in mm) each setting has to recover
+POSES = tuple({name: case[name] for name in ("name", "axis", "angle", "translation")} for case in benchmark.CASES[:2])
+
+# Vertex count of the synthetic teeth used when no pairs are given
+SYNTHETIC_VERTICES = 50000
+
+# Global registration starts of the reference alignment of each pair
+REFERENCE_STARTS = 4
+
+# Runs of every (setting, pair, pose) when open3d cannot be seeded
+DEFAULT_REPEATS = 2
+
+PRESET_EXTENSION = ".json"
+
+
+# Per worker-process state, filled by _initializeWorker
+_workerState = {}
+
+
+def defaultPresetDirectory():
+  """Preset location, shared by the module and the command line tools (``QUICKMODELALIGN_PRESET_DIR`` overrides it)."""
+  directory = os.environ.get("QUICKMODELALIGN_PRESET_DIR")
+  if directory:
+    return directory
+  if os.name == "nt":
+    base = os.environ.get("APPDATA", os.path.expanduser("~"))
+  else:
+    base = os.environ.get("XDG_CONFIG_HOME", os.path.join(os.path.expanduser("~"), ".config"))
+  return os.path.join(base, "QuickModelAlign", "presets")
+
+
+def presetPath(name, directory=None):
+  if not re.match(r"^[\w\- ]+$", name or ""):
+    raise ValueError(f"Invalid preset name: {name!r} (use letters, digits, spaces, '-' and '_')")
+  return os.path.join(directory or defaultPresetDirectory(), name + PRESET_EXTENSION)
+
+
+def listPresets(directory=None):
+  """Names of the saved presets, sorted."""
+  directory = directory or defaultPresetDirectory()
+  if not os.path.isdir(directory):
+    return []
+  return sorted(os.path.splitext(name)[0] for name in os.listdir(directory) if name.endswith(PRESET_EXTENSION))
+
+
+def savePreset(name, parameters, directory=None, sweep=None):
+  """Write the preset ``name``, atomically. Only parameters known to the pipeline are kept.
+
+  :param sweep: optional description of how the parameters were chosen
+  :return: path of the preset file
+  """
+  path = presetPath(name, directory)
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  preset = {
+    "name": name,
+    "created": datetime.now().isoformat(timespec="seconds"),
+    "parameters": {key: value for key, value in parameters.items() if key in registration.DEFAULT_PARAMETERS},
+    "sweep": sweep,
+    }
+  fileHandle, temporaryPath = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+  try:
+    with os.fdopen(fileHandle, "w") as f:
+      json.dump(preset, f, indent=2, default=float)
+    os.replace(temporaryPath, path)
+  except Exception:
+    if os.path.exists(temporaryPath):
+      os.remove(temporaryPath)
+    raise
+  return path
+
+
+def loadPreset(name, directory=None):
+  """Parameters of the preset ``name``, to be applied over the defaults (see applyPreset)."""
+  path = presetPath(name, directory)
+  if not os.path.isfile(path):
+    raise ValueError(f"Unknown preset: {name} (no {path})")
+  with open(path) as f:
+    parameters = json.load(f)["parameters"]
+  unknown = set(parameters) - set(registration.DEFAULT_PARAMETERS)
+  if unknown:
+    raise ValueError(f"Preset {name} has unknown parameters: {', '.join(sorted(unknown))}")
+  return parameters
+
+
+def applyPreset(parameters, name, directory=None):
+  """Copy of ``parameters`` with the entries of the preset ``name`` (no change if ``name`` is empty)."""
+  if not name:
+    return dict(parameters)
+  return dict(parameters, **loadPreset(name, directory))
+
+
+def parameterGrid(grid=None):
+  """All combinations of the grid values, as parameter dictionaries."""
+  grid = grid or DEFAULT_GRID
+  unknown = set(grid) - set(registration.DEFAULT_PARAMETERS)
+  if unknown:
+    raise ValueError(f"Unknown parameters in grid: {', '.join(sorted(unknown))}")
+  names = list(grid)
+  return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+
+def syntheticCases(vertexCount=SYNTHETIC_VERTICES):
+  """Benchmark tooth with its prepared model in the true pose."""
+  pair = benchmark.syntheticPair(vertexCount, dict(benchmark.CASES[0], angle=0.0, translation=(0.0, 0.0, 0.0), scale=1.0))
+  return [{
+    "name": "synthetic tooth",
+    "prepared": np.array(registration.pointsFromPolyData(pair["prepared"])),
+    "ideal": np.array(registration.pointsFromPolyData(pair["ideal"])),
+    }]
+
+
+def referenceCase(preparedPath, idealPath, parameters=None):
+  """Prepared model points of a pair, aligned to the ideal model with the reference parameters."""
+  parameters = registration.completeParameters(parameters)
+  parameters = dict(parameters, multiStartRuns=max(REFERENCE_STARTS, parameters["multiStartRuns"]))
+  preparedPoints = np.array(registration.pointsFromPolyData(registration.readPolyData(preparedPath)))
+  idealPoints = np.array(registration.pointsFromPolyData(registration.readPolyData(idealPath)))
+  sourceDown, targetDown, sourceFeatures, targetFeatures, voxelSize, scaling = registration.runSubsample(
+    preparedPoints, idealPoints, True, parameters)
+  icp = registration.registerPointClouds(sourceDown, targetDown, sourceFeatures, targetFeatures, voxelSize, True, parameters)
+  logging.info("Reference alignment of %s: fitness %.3f, inlier RMSE %.4f" % (preparedPath, icp.fitness, icp.inlier_rmse))
+  return {
+    "name": os.path.basename(preparedPath),
+    "prepared": registration.transformPointsInPlace(preparedPoints, np.asarray(icp.transformation)),
+    "ideal": idealPoints,
+    "referenceFitness": float(icp.fitness),
+    }
+
+
+def evaluate(case, pose, parameters):
+  """Time and registration error of ``parameters`` on ``case`` moved by ``pose``."""
+  rotation = benchmark.rotationMatrix(pose["axis"], pose["angle"])
+  translation = np.asarray(pose["translation"], dtype=np.float64)
+  movedPoints = case["prepared"] @ rotation.T + translation
+  startTime = time.perf_counter()
+  sourceDown, targetDown, sourceFeatures, targetFeatures, voxelSize, scaling = registration.runSubsample(
+    movedPoints, case["ideal"], True, parameters)
+  icp = registration.registerPointClouds(sourceDown, targetDown, sourceFeatures, targetFeatures, voxelSize, True, parameters)
+  result = {
+    "seconds": time.perf_counter() - startTime,
+    "downsampledPoints": len(sourceDown.points),
+    "fitness": float(icp.fitness),
+    "inlierRMSE": float(icp.inlier_rmse),
+    }
+  result.update(benchmark.transformationError(icp.transformation, rotation, translation, movedPoints))
+  return result
+
+
+def _initializeWorker(cases):
+  parallel.limitThreadsPerProcess()
+  _workerState["cases"] = cases
+
+
+def _evaluateInWorker(combination, caseIndex, poseIndex, repeat, parameters):
+  case = _workerState["cases"][caseIndex]
+  pose = POSES[poseIndex]
+  run = {"combination": combination, "case": case["name"], "pose": pose["name"], "repeat": repeat}
+  try:
+    run.update(evaluate(case, pose, parameters), status="ok")
+  except Exception as e:
+    run.update(status="failed", error="%s: %s" % (type(e).__name__, e), traceback=traceback.format_exc())
+  return run
+
+
+def summarizeRuns(combinations, runs):
+  """Mean and largest time and error of every combination over all cases, poses and repeats."""
+  summaries = []
+  for index, combination in enumerate(combinations):
+    combinationRuns = [run for run in runs if run["combination"] == index]
+    succeeded = [run for run in combinationRuns if run["status"] == "ok"]
+    errors = [run["registrationErrorRMS"] for run in succeeded]
+    seconds = [run["seconds"] for run in succeeded]
+    summaries.append({
+      "combination": index,
+      "parameters": combination,
+      "runs": len(combinationRuns),
+      "failures": len(combinationRuns) - len(succeeded),
+      "meanSeconds": float(np.mean(seconds)) if seconds else None,
+      "maximumSeconds": float(np.max(seconds)) if seconds else None,
+      "meanError": float(np.mean(errors)) if errors else None,
+      "maximumError": float(np.max(errors)) if errors else None,
+      })
+  return summaries
+
+
+def chooseSetting(summaries, targetError=DEFAULT_TARGET_ERROR):
+  """Fastest combination without failures whose largest error is within ``targetError``, or None."""
+  accepted = [summary for summary in summaries if summary["failures"] == 0 and summary["maximumError"] is not None
+    and summary["maximumError"] <= targetError]
+  return min(accepted, key=lambda summary: summary["meanSeconds"]) if accepted else None
+
+
+def runSweep(pairs=None, grid=None, targetError=DEFAULT_TARGET_ERROR, workers=None, parameters=None, presetName=None,
+    presetDirectory=None, outputPath=None, progress=None, repeats=None):
+  """Evaluate every grid combination on the pairs and choose the fastest accurate one.
+
+  :param pairs: (prepared path, ideal path) tuples; the synthetic benchmark tooth if empty
+  :param parameters: parameters that are not swept (default parameters for missing entries)
+  :param presetName: if set and a setting meets the target error, it is saved as this preset
+  :param repeats: runs of every (setting, pair, pose); default 1 if open3d can be seeded, DEFAULT_REPEATS otherwise
+  :param progress: called as ``progress(stage, detail)`` while the runs complete; if it raises
+    (e.g. tasks.TaskCancelled), the remaining runs are cancelled
+  :return: dictionary with the grid, the combination summaries, all runs, and the chosen
+    combination under "best" (None if no setting meets the target error)
+  """
+  parameters = registration.completeParameters(parameters)
+  # Same random sampling for every setting where open3d can be seeded. Otherwise the runs
+  # are repeated, and the largest error of a setting covers its worst run.
+  if parameters["randomSeed"] < 0:
+    parameters["randomSeed"] = 0
+  repeatable = registration.seedingSupported()
+  if repeats is None:
+    repeats = 1 if repeatable else DEFAULT_REPEATS
+  combinations = parameterGrid(grid)
+  workers = workers or parallel.defaultWorkerCount()
+  startTime = time.perf_counter()
+
+  if pairs:
+    logging.info(f"Parameter sweep: reference alignment of {len(pairs)} pairs")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(pairs)), mp_context=parallel.processContext(),
+        initializer=parallel.limitThreadsPerProcess) as executor:
+      cases = list(executor.map(referenceCase, *zip(*pairs), [parameters] * len(pairs)))
+  else:
+    cases = syntheticCases()
+
+  jobs = [(combination, caseIndex, poseIndex, repeat) for combination in range(len(combinations))
+    for caseIndex in range(len(cases)) for poseIndex in range(len(POSES)) for repeat in range(repeats)]
+  logging.info(f"Parameter sweep: {len(combinations)} settings, {len(jobs)} runs using {workers} worker processes")
+  runs = []
+  executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=parallel.processContext(),
+    initializer=_initializeWorker, initargs=(cases,))
+  try:
+    futures = [executor.submit(_evaluateInWorker, combination, caseIndex, poseIndex, repeat, dict(parameters, **combinations[combination]))
+      for combination, caseIndex, poseIndex, repeat in jobs]
+    for future in concurrent.futures.as_completed(futures):
+      runs.append(future.result())
+      if progress is not None:
+        progress("RANSAC", f"{len(runs)} of {len(jobs)} parameter sweep runs")
+  except BaseException:
+    executor.shutdown(wait=False, cancel_futures=True)
+    raise
+  executor.shutdown()
+
+  summaries = summarizeRuns(combinations, runs)
+  best = chooseSetting(summaries, targetError)
+  sweep = {
+    "created": datetime.now().isoformat(timespec="seconds"),
+    "environment": benchmark.environment(),
+    "pairs": [list(pair) for pair in pairs or []],
+    "targetError": targetError,
+    "grid": grid or DEFAULT_GRID,
+    "parameters": parameters,
+    "repeatable": repeatable,
+    "repeats": repeats,
+    "seconds": time.perf_counter() - startTime,
+    "combinations": summaries,
+    "runs": runs,
+    "best": best,
+    }
+  if best is None:
+    logging.warning(f"Parameter sweep: no setting meets the target error of {targetError} mm")
+  else:
+    logging.info("Parameter sweep: best setting %s, %.2f seconds, error up to %.4f mm" % (
+      best["parameters"], best["meanSeconds"], best["maximumError"]))
+    if presetName:
+      path = savePreset(presetName, best["parameters"], presetDirectory, sweep={
+        "created": sweep["created"],
+        "pairs": sweep["pairs"],
+        "targetError": targetError,
+        "repeatable": repeatable,
+        "repeats": repeats,
+        "meanSeconds": best["meanSeconds"],
+        "maximumError": best["maximumError"],
+        })
+      logging.info(f"Preset {presetName} written to {path}")
+  if outputPath:
+    with open(outputPath, "w") as f:
+      json.dump(sweep, f, indent=2, default=float)
+  return sweep
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(prog="QuickModelAlignLib.tuning",
+    description="Sweep the downsampling and feature parameters and save the fastest accurate setting as a preset.")
+  parser.add_argument("--pair", nargs=2, action="append", metavar=("PREPARED", "IDEAL"),
+    help="representative prepared and ideal model files (repeat for several pairs; default: a synthetic tooth)")
+  parser.add_argument("--preset", default=None, help="name of the preset the chosen parameters are saved as")
+  parser.add_argument("--preset-dir", default=None, help="preset directory (default: user configuration directory)")
+  parser.add_argument("--target-error", type=float, default=DEFAULT_TARGET_ERROR,
+    help="largest acceptable registration error RMS, in mm")
+  parser.add_argument("--grid", default=None, help="JSON file mapping parameter names to the values to sweep")
+  parser.add_argument("-p", "--parameters", default=None, help="JSON file with the parameters that are not swept")
+  parser.add_argument("-j", "--workers", type=int, default=None, help="number of worker processes (default: number of CPU cores)")
+  parser.add_argument("-o", "--output", default=None, help="output .json file with the results of every run")
+  parser.add_argument("--repeats", type=int, default=None,
+    help=f"runs of every setting, pair and pose (default: 1 if open3d can be seeded, otherwise {DEFAULT_REPEATS})")
+  args = parser.parse_args(argv)
+
+  logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+  grid = None
+  if args.grid:
+    with open(args.grid) as f:
+      grid = json.load(f)
+  parameters = {}
+  if args.parameters:
+    with open(args.parameters) as f:
+      parameters = json.load(f)
+  sweep = runSweep(args.pair, grid, args.target_error, args.workers, parameters, args.preset, args.preset_dir, args.output,
+    repeats=args.repeats)
+  for summary in sorted(sweep["combinations"], key=lambda summary: summary["meanSeconds"] or np.inf):
+    print("%8s s  error %8s mm  failures %d  %s" % (
+      "%.2f" % summary["meanSeconds"] if summary["meanSeconds"] is not None else "-",
+      "%.4f" % summary["maximumError"] if summary["maximumError"] is not None else "-",
+      summary["failures"], json.dumps(summary["parameters"])))
+  return 0 if sweep["best"] is not None else 1
+
+
+if __name__ == "__main__":
+  sys.exit(main())